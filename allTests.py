@@ -25,6 +25,14 @@ from jobTree.test.jobTest import TestCase as jobTest
 from jobTree.test.scriptTreeTest import TestCase as scriptTreeTest
 from jobTree.test.sort.sortTest import TestCase as sortTest
 from jobTree.test.statsTest import TestCase as statsTest
+from jobTree.test.masterTest import TestCase as masterTest
+from jobTree.test.jobStoreTest import TestCase as jobStoreTest
+from jobTree.test.deleterTest import TestCase as deleterTest
+from jobTree.test.garbageCollectorTest import TestCase as garbageCollectorTest
+from jobTree.test.warmSlaveTest import TestCase as warmSlaveTest
+from jobTree.test.jobTreeSlaveTest import TestCase as jobTreeSlaveTest
+from jobTree.test.resourceMonitorTest import TestCase as resourceMonitorTest
+from jobTree.test.batchSystemsTest import TestCase as batchSystemsTest
 #import jobTree.test.jobTreeParasolCrashTest.TestCase as jobTreeParasolCrashTest
 
 from sonLib.bioio import parseSuiteTestOptions, getBasicOptionParser
@@ -41,6 +49,22 @@ def allSuites(options):
         tests.append(unittest.makeSuite(sortTest, 'test'))
     if 'stats' in options.tests:
         tests.append(unittest.makeSuite(statsTest, 'test'))
+    if 'master' in options.tests:
+        tests.append(unittest.makeSuite(masterTest, 'test'))
+    if 'jobStore' in options.tests:
+        tests.append(unittest.makeSuite(jobStoreTest, 'test'))
+    if 'deleter' in options.tests:
+        tests.append(unittest.makeSuite(deleterTest, 'test'))
+    if 'garbageCollector' in options.tests:
+        tests.append(unittest.makeSuite(garbageCollectorTest, 'test'))
+    if 'warmSlave' in options.tests:
+        tests.append(unittest.makeSuite(warmSlaveTest, 'test'))
+    if 'jobTreeSlave' in options.tests:
+        tests.append(unittest.makeSuite(jobTreeSlaveTest, 'test'))
+    if 'resourceMonitor' in options.tests:
+        tests.append(unittest.makeSuite(resourceMonitorTest, 'test'))
+    if 'batchSystems' in options.tests:
+        tests.append(unittest.makeSuite(batchSystemsTest, 'test'))
     allTests = unittest.TestSuite(tests)
     return allTests
 
@@ -48,10 +72,10 @@ def initializeOptions(parser):
     parser.add_option('--tests',
                       help=('comma separated list of tests. omit to test all. '
                             'possbile tests: '
-                            '[job, jobTree, scriptTree, sort, stats]'))
+                            '[job, jobTree, scriptTree, sort, stats, master, jobStore, deleter, garbageCollector, warmSlave, jobTreeSlave, resourceMonitor, batchSystems]'))
 
 def checkOptions(options, parser):
-    tests = ['job', 'jobTree', 'scriptTree', 'sort', 'stats']
+    tests = ['job', 'jobTree', 'scriptTree', 'sort', 'stats', 'master', 'jobStore', 'deleter', 'garbageCollector', 'warmSlave', 'jobTreeSlave', 'resourceMonitor', 'batchSystems']
     if options.tests is None:
         options.tests = tests
     else:
@@ -22,6 +22,12 @@
 
 from Queue import Empty
 
+#The states of jobs published by batch systems that support job events
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_VANISHED = "vanished"
+
 class AbstractBatchSystem:
     """An abstract (as far as python currently allows) base class
     to represent the interface the batch system must provide to the jobTree.
@@ -46,6 +52,14 @@ class AbstractBatchSystem:
         if memory > self.maxMemory:
             raise RuntimeError("Requesting more memory than available. Requested: %s, Available: %s" % (memory, self.maxMemory))
     
+    def getResourcePool(self, command, memory, cpu):
+        """Returns the batch system whose max cpus and max memory limit the given job. 
+        The master issues jobs to each resource pool only while the cpus and memory 
+        requested by the jobs issued to the pool are within its limits. Batch systems that 
+        combine other batch systems should override this.
+        """
+        return self
+    
     def issueJob(self, command, memory, cpu):
         """Issues the following command returning a unique jobID. Command
         is the string to run, memory is an int giving
@@ -54,6 +68,13 @@ class AbstractBatchSystem:
         """
         raise RuntimeError("Abstract method")
     
+    def issueJobs(self, jobs):
+        """Issues a list of (command, memory, cpu) tuples, returning the list of their 
+        jobIDs, in the same order. Batch systems should override this to issue many jobs
+        per round trip to the underlying scheduler.
+        """
+        return [ self.issueJob(command, memory, cpu) for command, memory, cpu in jobs ]
+    
     def killJobs(self, jobIDs):
         """Kills the given job IDs.
         """
@@ -79,6 +100,37 @@ class AbstractBatchSystem:
         """
         raise RuntimeError("Abstract method")
     
+    def getUpdatedJobs(self, maxWait, maxCount):
+        """Gets up to maxCount jobs that have updated their status, as a list
+        of (jobID, exitValue) tuples. Max wait gives the number of seconds to pause 
+        waiting for the first result, the remaining results are those available 
+        without waiting. If no result is available returns an empty list.
+        """
+        updatedJobs = []
+        updatedJob = self.getUpdatedJob(maxWait)
+        while updatedJob != None:
+            updatedJobs.append(updatedJob)
+            if len(updatedJobs) >= maxCount:
+                break
+            updatedJob = self.getUpdatedJob(0)
+        return updatedJobs
+    
+    def supportsJobEvents(self):
+        """Returns True if the batch system publishes the changes in the states of its 
+        jobs with getJobEvents. If so, the master uses the running events to find 
+        overlong jobs and the vanished events to find lost jobs, rather than querying the
+        batch system for its issued and running jobs.
+        """
+        return False
+    
+    def getJobEvents(self):
+        """Returns the changes in the states of the issued jobs since the last call, as a 
+        list of (jobID, state, time) tuples, in the order they happened, where state is one of 
+        JOB_QUEUED, JOB_RUNNING, JOB_FINISHED and JOB_VANISHED, the last meaning the job 
+        was lost by the batch system and will not be reported by getUpdatedJob(s).
+        """
+        raise RuntimeError("Abstract method")
+    
     def getRescueJobFrequency(self):
         """Gets the period of time to wait (floating point, in seconds) between checking for 
         missing/overlong jobs.
@@ -98,6 +150,19 @@ class AbstractBatchSystem:
             return queue.get(timeout=maxWait)
         except Empty:
             return None
+    
+    def getAllFromQueueSafely(self, queue, maxWait, maxCount):
+        """Returns a list of up to maxCount objects from the given queue, waiting at most
+        maxWait seconds for the first object and not at all for the remainder.
+        """
+        objects = []
+        i = self.getFromQueueSafely(queue, maxWait)
+        while i != None:
+            objects.append(i)
+            if len(objects) >= maxCount:
+                break
+            i = self.getFromQueueSafely(queue, 0)
+        return objects
 
 def main():
     pass
@@ -50,12 +50,31 @@ class CombinedBatchSystem(AbstractBatchSystem):
     def _strip(self, id):
         return id[1]
 
+    def getResourcePool(self, command, memory, cpu):
+        if self.batchSystemChoiceFn(command, memory, cpu):
+            return self.batchSystem1.getResourcePool(command, memory, cpu)
+        return self.batchSystem2.getResourcePool(command, memory, cpu)
+
     def issueJob(self, command, memory, cpu):
         if self.batchSystemChoiceFn(command, memory, cpu):
             return self._jobIDForBatchSystem1(self.batchSystem1.issueJob(command, memory, cpu))
         else:
             return self._jobIDForBatchSystem2(self.batchSystem2.issueJob(command, memory, cpu))
         
+    def issueJobs(self, jobs):
+        jobs1, jobs2 = [], []
+        for index, (command, memory, cpu) in enumerate(jobs):
+            if self.batchSystemChoiceFn(command, memory, cpu):
+                jobs1.append((index, (command, memory, cpu)))
+            else:
+                jobs2.append((index, (command, memory, cpu)))
+        jobIDs = [ None ] * len(jobs)
+        for index, jobID in zip([ index for index, job in jobs1 ], self.batchSystem1.issueJobs([ job for index, job in jobs1 ])):
+            jobIDs[index] = self._jobIDForBatchSystem1(jobID)
+        for index, jobID in zip([ index for index, job in jobs2 ], self.batchSystem2.issueJobs([ job for index, job in jobs2 ])):
+            jobIDs[index] = self._jobIDForBatchSystem2(jobID)
+        return jobIDs
+        
     def killJobs(self, jobIDs):
         l, l2 = [], []
         for jobID in jobIDs:
@@ -87,5 +106,25 @@ class CombinedBatchSystem(AbstractBatchSystem):
                 return None
             time.sleep(0.01)
     
+    def getUpdatedJobs(self, maxWait, maxCount):
+        endTime = time.time() + maxWait
+        while 1:
+            updatedJobs = [ (self._jobIDForBatchSystem2(jobID), exitValue) for jobID, exitValue in self.batchSystem2.getUpdatedJobs(0, maxCount) ]
+            if len(updatedJobs) < maxCount:
+                updatedJobs += [ (self._jobIDForBatchSystem1(jobID), exitValue) for jobID, exitValue in self.batchSystem1.getUpdatedJobs(0, maxCount - len(updatedJobs)) ]
+            if len(updatedJobs) > 0:
+                return updatedJobs
+            remaining = endTime - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(0.01)
+    
+    def supportsJobEvents(self):
+        return self.batchSystem1.supportsJobEvents() and self.batchSystem2.supportsJobEvents()
+    
+    def getJobEvents(self):
+        return [ (self._jobIDForBatchSystem1(jobID), state, eventTime) for jobID, state, eventTime in self.batchSystem1.getJobEvents() ] + \
+               [ (self._jobIDForBatchSystem2(jobID), state, eventTime) for jobID, state, eventTime in self.batchSystem2.getJobEvents() ]
+    
     def getRescueJobFrequency(self):
         return min(self.batchSystem1.getRescueJobFrequency(), self.batchSystem2.getRescueJobFrequency())
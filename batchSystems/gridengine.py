@@ -30,7 +30,9 @@ from threading import Thread
 
 from sonLib.bioio import logger
 from sonLib.bioio import system
+from sonLib.bioio import TempFileTree
 from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
 from jobTree.src.master import getParasolResultsFileName
 
 from jobTree.batchSystems.multijob import MultiTarget
@@ -84,6 +86,9 @@ def qsub(qsubline):
     logger.debug("Got the job id: %s" % (str(result)))
     return result
 
+def qdel(sgeJobString):
+    subprocess.Popen(["qdel", sgeJobString])
+
 def getjobexitcode(sgeJobID):
         job, task = sgeJobID
         args = ["qacct", "-j", str(job)]
@@ -110,6 +115,7 @@ class Worker(Thread):
         self.boss = boss
         self.allocatedCpus = dict()
         self.sgeJobIDs = dict()
+        self.arrayJobFiles = dict()
 
     def getRunningJobIDs(self):
         times = {}
@@ -139,7 +145,11 @@ class Worker(Thread):
     def forgetJob(self, jobID):
         self.runningJobs.remove(jobID)
         del self.allocatedCpus[jobID]
-        del self.sgeJobIDs[jobID]
+        sgeJobID, task = self.sgeJobIDs.pop(jobID)
+        if sgeJobID in self.arrayJobFiles: #Remove the array job's pickle once all its tasks are done
+            self.arrayJobFiles[sgeJobID][1] -= 1
+            if self.arrayJobFiles[sgeJobID][1] == 0:
+                os.remove(self.arrayJobFiles.pop(sgeJobID)[0])
 
     def killJobs(self):
         # Load hit list:
@@ -150,7 +160,7 @@ class Worker(Thread):
         # Do the dirty job
         for jobID in list(killList):
             if jobID in self.runningJobs:
-                process = subprocess.Popen(["qdel", self.getSgeID(jobID)])
+                qdel(self.getSgeID(jobID))
             else:
                 if jobID in self.waitingJobs:
                     self.waitingJobs.remove(jobID)
@@ -174,14 +184,31 @@ class Worker(Thread):
         while not self.newJobsQueue.empty():
             self.waitingJobs.append(self.newJobsQueue.get())
 
-        # Launch jobs as necessary:
-        while len(self.waitingJobs) > 0 and sum(self.allocatedCpus.values()) < int(self.boss.maxCpus):
+        # Launch jobs as necessary, grouping jobs with the same requirements into array jobs:
+        usedCpus = sum(self.allocatedCpus.values())
+        jobsToLaunch = {}
+        while len(self.waitingJobs) > 0 and usedCpus < int(self.boss.maxCpus):
             jobID, cpu, memory, command = self.waitingJobs.pop(0)
-            qsubline = prepareQsub(cpu, memory) + [command]
-            sgeJobID = qsub(qsubline)
-            self.sgeJobIDs[jobID] = (sgeJobID, None)
-            self.runningJobs.add(jobID)
-            self.allocatedCpus[jobID] = cpu
+            usedCpus += cpu
+            if (cpu, memory) not in jobsToLaunch:
+                jobsToLaunch[(cpu, memory)] = []
+            jobsToLaunch[(cpu, memory)].append((jobID, command))
+        for (cpu, memory), jobs in jobsToLaunch.items():
+            if len(jobs) == 1:
+                jobID, command = jobs[0]
+                sgeJobID = qsub(prepareQsub(cpu, memory) + [command])
+                self.sgeJobIDs[jobID] = (sgeJobID, None)
+            else:
+                multiTarget = MultiTarget([ (command, None) for jobID, command in jobs ])
+                multiTargetCommand = multiTarget.makeRunnable(self.boss.arrayJobTempFileTree)
+                sgeJobID = qsub(prepareQsub(cpu, memory) + [ "-t", "1-%i" % len(jobs) ] + multiTargetCommand.split())
+                self.arrayJobFiles[sgeJobID] = [ multiTargetCommand.split()[1], len(jobs) ]
+                for task, (jobID, command) in enumerate(jobs):
+                    self.sgeJobIDs[jobID] = (sgeJobID, task+1) #Array job tasks are numbered from 1
+            for jobID, command in jobs:
+                self.runningJobs.add(jobID)
+                self.allocatedCpus[jobID] = cpu
+                self.boss.jobEventQueue.put((jobID, JOB_RUNNING, time.time())) #The time it was submitted, as the worker does not see it start
 
     def checkOnJobs(self):
         for jobID in list(self.runningJobs):
@@ -210,9 +237,17 @@ class GridengineBatchSystem(AbstractBatchSystem):
         self.currentjobs = set()
         self.obtainSystemConstants()
         self.nextJobID = 0
+        self.arrayJobTempFileTree = TempFileTree(os.path.join(config.attrib["job_tree"], "arrayJobs"))
+        self.jobEvents = [] #The job events not yet returned by getJobEvents
+        self.jobEventQueue = Queue() #The worker puts the jobs it submits on this queue
 
-        self.newJobsQueue = Queue()
         self.updatedJobsQueue = Queue()
+        self.startWorker()
+    
+    def startWorker(self):
+        """Starts a worker, with new queues of jobs to submit and to kill, sharing the queue of updated jobs.
+        """
+        self.newJobsQueue = Queue()
         self.killQueue = Queue()
         self.killedJobsQueue = Queue()
         self.worker = Worker(self.newJobsQueue, self.updatedJobsQueue, self.killQueue, self.killedJobsQueue, self)
@@ -230,8 +265,24 @@ class GridengineBatchSystem(AbstractBatchSystem):
 
         self.currentjobs.add(jobID)
         self.newJobsQueue.put((jobID, cpu, memory, command))
+        self.jobEvents.append((jobID, JOB_QUEUED, time.time()))
         logger.debug("Issued the job command: %s with job id: %s " % (command, str(jobID)))
         return jobID
+    
+    def issueJobs(self, jobs):
+        """Issues a batch of jobs, the worker submits the jobs in the batch with the
+        same requirements as a single array job.
+        """
+        jobIDs = []
+        for command, memory, cpu in jobs:
+            self.checkResourceRequest(memory, cpu)
+            jobIDs.append(self.nextJobID)
+            self.currentjobs.add(self.nextJobID)
+            self.newJobsQueue.put((self.nextJobID, cpu, memory, command))
+            self.jobEvents.append((self.nextJobID, JOB_QUEUED, time.time()))
+            self.nextJobID += 1
+        logger.debug("Issued %i job commands" % len(jobs))
+        return jobIDs
 
     def killJobs(self, jobIDs):
         """Kills the given jobs, represented as Job ids, then checks they are dead by checking
@@ -267,9 +318,56 @@ class GridengineBatchSystem(AbstractBatchSystem):
             return None
         jobID, retcode = i
         self.updatedJobsQueue.task_done()
-        self.currentjobs.remove(jobID)
+        self._processJobEvents() #The submission of the job must be processed before it is finished
+        self._finishJob(jobID)
         return i
     
+    def getUpdatedJobs(self, maxWait, maxCount):
+        updatedJobs = self.getAllFromQueueSafely(self.updatedJobsQueue, maxWait, maxCount)
+        self._processJobEvents()
+        for jobID, retcode in updatedJobs:
+            self.updatedJobsQueue.task_done()
+            self._finishJob(jobID)
+        return updatedJobs
+    
+    def _finishJob(self, jobID):
+        if jobID in self.currentjobs: #Else the job was vanished
+            self.currentjobs.remove(jobID)
+            self.jobEvents.append((jobID, JOB_FINISHED, time.time()))
+    
+    def _processJobEvents(self):
+        """Processes the submissions of jobs put on the event queue by the worker.
+        """
+        while True:
+            try:
+                jobID, state, eventTime = self.jobEventQueue.get(block=False)
+            except Empty:
+                break
+            if jobID in self.currentjobs:
+                self.jobEvents.append((jobID, state, eventTime))
+    
+    def supportsJobEvents(self):
+        return True
+    
+    def getJobEvents(self):
+        """Returns the job events, checking that the worker is alive. If it has died the jobs 
+        it had not finished are vanished, those it submitted are deleted, and a new worker is started.
+        """
+        self._processJobEvents()
+        if not self.worker.is_alive():
+            finishedJobIDs = set([ jobID for jobID, retcode in self.updatedJobsQueue.queue ]) #Their results are still to be returned
+            jobIDs = [ jobID for jobID in self.currentjobs if jobID not in finishedJobIDs ]
+            logger.critical("The worker submitting the jobs died, losing the jobs %s" % jobIDs)
+            for jobID in jobIDs:
+                if jobID in self.worker.runningJobs:
+                    qdel(self.worker.getSgeID(jobID))
+                self.currentjobs.remove(jobID)
+                self.jobEvents.append((jobID, JOB_VANISHED, time.time()))
+            self.startWorker()
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+    
     def getWaitDuration(self):
         """We give parasol a second to catch its breath (in seconds)
         """
@@ -32,9 +32,12 @@ from threading import Thread
 from datetime import date
 
 from sonLib.bioio import logger
+from sonLib.bioio import TempFileTree
 from sonLib.bioio import system
 from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
 from jobTree.src.master import getParasolResultsFileName
+from jobTree.batchSystems.multijob import MultiTarget
 
 class MemoryString:
     def __init__(self, string):
@@ -79,11 +82,22 @@ def bsub(bsubline):
     logger.debug("Got the job id: %s" % (str(result)))
     return result
 
+def getLsfJobString(lsfJobID):
+    """Returns the string used to refer to a job, or a task of an array job, in lsf commands.
+    """
+    job, task = lsfJobID
+    if task is None:
+        return str(job)
+    return '"%s[%s]"' % (job, task) #Quoted as the commands are run by the shell
+
+def bkill(lsfJobID):
+    subprocess.Popen("bkill %s" % getLsfJobString(lsfJobID), shell=True)
+
 def getjobexitcode(lsfJobID):
         job, task = lsfJobID
         
         #first try bjobs to find out job state
-        args = ["bjobs", "-l", str(job)]
+        args = ["bjobs", "-l", getLsfJobString(lsfJobID)]
         logger.info("Checking job exit code for job via bjobs: " + str(job))
         process = subprocess.Popen(" ".join(args), shell=True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
         started = 0
@@ -110,7 +124,7 @@ def getjobexitcode(lsfJobID):
         #if not found in bjobs, then try bacct (slower than bjobs)
         logger.info("bjobs failed to detect job - trying bacct: " + str(job))
         
-        args = ["bacct", "-l", str(job)]
+        args = ["bacct", "-l", getLsfJobString(lsfJobID)]
         logger.info("Checking job exit code for job via bacct:" + str(job))
         process = subprocess.Popen(" ".join(args), shell=True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
         for line in process.stdout:
@@ -131,28 +145,52 @@ class Worker(Thread):
         self.currentjobs = list()
         self.runningjobs = set()
         self.boss = boss
+        self.arrayJobFiles = dict()
+        
+    def createJobs(self):
+        # Load new job ids:
+        while not self.newJobsQueue.empty():
+            self.currentjobs.append(self.newJobsQueue.get())
+
+        # Launch jobs as necessary, grouping jobs with the same requirements into array jobs:
+        jobsToLaunch = {}
+        while len(self.currentjobs) > 0:
+            jobID, bsubline = self.currentjobs.pop()
+            requirements = tuple(bsubline[:-1])
+            if requirements not in jobsToLaunch:
+                jobsToLaunch[requirements] = []
+            jobsToLaunch[requirements].append((jobID, bsubline[-1]))
+        for requirements, jobs in jobsToLaunch.items():
+            if len(jobs) == 1:
+                jobID, command = jobs[0]
+                lsfJobIDs = [ (bsub(list(requirements) + [command]), None) ]
+            else:
+                multiTargetCommand = MultiTarget([ (command, None) for jobID, command in jobs ]).makeRunnable(self.boss.arrayJobTempFileTree)
+                lsfJobID = bsub(list(requirements) + [ '-J "jobTree[1-%i]"' % len(jobs), multiTargetCommand ])
+                self.arrayJobFiles[lsfJobID] = [ multiTargetCommand.split()[1], len(jobs) ]
+                lsfJobIDs = [ (lsfJobID, task+1) for task in xrange(len(jobs)) ] #Array job tasks are numbered from 1
+            for (jobID, command), lsfJobID in zip(jobs, lsfJobIDs):
+                self.boss.jobIDs[lsfJobID] = jobID
+                self.boss.lsfJobIDs[jobID] = lsfJobID
+                self.runningjobs.add(lsfJobID)
+                self.boss.jobEventQueue.put((jobID, JOB_RUNNING, time.time())) #The time it was submitted, as the worker does not see it start
+
+    def checkOnJobs(self):
+        # Test known job list
+        for lsfJobID in list(self.runningjobs):
+            exit = getjobexitcode(lsfJobID)
+            if exit is not None:
+                self.updatedJobsQueue.put((lsfJobID, exit))
+                self.runningjobs.remove(lsfJobID)
+                if lsfJobID[0] in self.arrayJobFiles: #Remove the array job's pickle once all its tasks are done
+                    self.arrayJobFiles[lsfJobID[0]][1] -= 1
+                    if self.arrayJobFiles[lsfJobID[0]][1] == 0:
+                        os.remove(self.arrayJobFiles.pop(lsfJobID[0])[0])
         
     def run(self):
         while True:
-            # Load new job ids:
-            while not self.newJobsQueue.empty():
-                self.currentjobs.append(self.newJobsQueue.get())
-
-            # Launch jobs as necessary:
-            while len(self.currentjobs) > 0:
-                jobID, bsubline = self.currentjobs.pop()
-                lsfJobID = bsub(bsubline)
-                self.boss.jobIDs[(lsfJobID, None)] = jobID
-                self.boss.lsfJobIDs[jobID] = (lsfJobID, None)
-                self.runningjobs.add((lsfJobID, None))
-
-            # Test known job list
-            for lsfJobID in list(self.runningjobs):
-                exit = getjobexitcode(lsfJobID)
-                if exit is not None:
-                    self.updatedJobsQueue.put((lsfJobID, exit))
-                    self.runningjobs.remove(lsfJobID)
-
+            self.createJobs()
+            self.checkOnJobs()
             time.sleep(10)
 
 class LSFBatchSystem(AbstractBatchSystem):
@@ -170,9 +208,17 @@ class LSFBatchSystem(AbstractBatchSystem):
         self.jobIDs = dict()
         self.lsfJobIDs = dict()
         self.nextJobID = 0
+        self.arrayJobTempFileTree = TempFileTree(os.path.join(config.attrib["job_tree"], "arrayJobs"))
+        self.jobEvents = [] #The job events not yet returned by getJobEvents
+        self.jobEventQueue = Queue() #The worker puts the jobs it submits on this queue
 
-        self.newJobsQueue = Queue()
         self.updatedJobsQueue = Queue()
+        self.startWorker()
+    
+    def startWorker(self):
+        """Starts a worker, with a new queue of jobs to submit, sharing the queue of updated jobs.
+        """
+        self.newJobsQueue = Queue()
         self.worker = Worker(self.newJobsQueue, self.updatedJobsQueue, self)
         self.worker.setDaemon(True)
         self.worker.start()
@@ -187,18 +233,29 @@ class LSFBatchSystem(AbstractBatchSystem):
         self.currentjobs.add(jobID)
         bsubline = prepareBsub(cpu, memory) + [command]
         self.newJobsQueue.put((jobID, bsubline))
+        self.jobEvents.append((jobID, JOB_QUEUED, time.time()))
         logger.info("Issued the job command: %s with job id: %s " % (command, str(jobID)))
         return jobID
+    
+    def issueJobs(self, jobs):
+        """Issues a batch of jobs, the worker submits the jobs in the batch with the
+        same requirements as a single array job.
+        """
+        jobIDs = []
+        for command, memory, cpu in jobs:
+            jobIDs.append(self.nextJobID)
+            self.currentjobs.add(self.nextJobID)
+            self.newJobsQueue.put((self.nextJobID, prepareBsub(cpu, memory) + [command]))
+            self.jobEvents.append((self.nextJobID, JOB_QUEUED, time.time()))
+            self.nextJobID += 1
+        logger.info("Issued %i job commands" % len(jobs))
+        return jobIDs
         
     def getLsfID(self, jobID):
         if not jobID in self.lsfJobIDs:
              RuntimeError("Unknown jobID, could not be converted")
 
-        (job,task) = self.lsfJobIDs[jobID]
-        if task is None:
-             return str(job) 
-        else:
-             return str(job) + "." + str(task)   
+        return getLsfJobString(self.lsfJobIDs[jobID])   
     
     def killJobs(self, jobIDs):
         """Kills the given job IDs.
@@ -206,7 +263,7 @@ class LSFBatchSystem(AbstractBatchSystem):
         for jobID in jobIDs:
             logger.info("DEL: " + str(self.getLsfID(jobID)))
             self.currentjobs.remove(jobID)
-            process = subprocess.Popen(["bkill", self.getLsfID(jobID)])
+            bkill(self.lsfJobIDs[jobID])
             del self.jobIDs[self.lsfJobIDs[jobID]]
             del self.lsfJobIDs[jobID]
 
@@ -250,12 +307,61 @@ class LSFBatchSystem(AbstractBatchSystem):
             sgeJobID, retcode = self.updatedJobsQueue.get(timeout=maxWait)
             self.updatedJobsQueue.task_done()
             i = (self.jobIDs[sgeJobID], retcode)
-            self.currentjobs -= set([self.jobIDs[sgeJobID]])
+            self._processJobEvents() #The submission of the job must be processed before it is finished
+            self._finishJob(self.jobIDs[sgeJobID])
         except Empty:
             pass
 
         return i
     
+    def getUpdatedJobs(self, maxWait, maxCount):
+        updatedJobs = []
+        lsfUpdatedJobs = self.getAllFromQueueSafely(self.updatedJobsQueue, maxWait, maxCount)
+        self._processJobEvents()
+        for sgeJobID, retcode in lsfUpdatedJobs:
+            self.updatedJobsQueue.task_done()
+            updatedJobs.append((self.jobIDs[sgeJobID], retcode))
+            self._finishJob(self.jobIDs[sgeJobID])
+        return updatedJobs
+    
+    def _finishJob(self, jobID):
+        if jobID in self.currentjobs: #Else the job was vanished
+            self.currentjobs.remove(jobID)
+            self.jobEvents.append((jobID, JOB_FINISHED, time.time()))
+    
+    def _processJobEvents(self):
+        """Processes the submissions of jobs put on the event queue by the worker.
+        """
+        while True:
+            try:
+                jobID, state, eventTime = self.jobEventQueue.get(block=False)
+            except Empty:
+                break
+            if jobID in self.currentjobs:
+                self.jobEvents.append((jobID, state, eventTime))
+    
+    def supportsJobEvents(self):
+        return True
+    
+    def getJobEvents(self):
+        """Returns the job events, checking that the worker is alive. If it has died the jobs 
+        it had not finished are vanished, those it submitted are killed, and a new worker is started.
+        """
+        self._processJobEvents()
+        if not self.worker.is_alive():
+            finishedJobIDs = set([ self.jobIDs.get(lsfJobID) for lsfJobID, retcode in self.updatedJobsQueue.queue ]) #Their results are still to be returned
+            jobIDs = [ jobID for jobID in self.currentjobs if jobID not in finishedJobIDs ]
+            logger.critical("The worker submitting the jobs died, losing the jobs %s" % jobIDs)
+            for jobID in jobIDs:
+                if jobID in self.lsfJobIDs and self.lsfJobIDs[jobID] in self.worker.runningjobs:
+                    bkill(self.lsfJobIDs[jobID])
+                self.currentjobs.remove(jobID)
+                self.jobEvents.append((jobID, JOB_VANISHED, time.time()))
+            self.startWorker()
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+    
     def getWaitDuration(self):
         """We give parasol a second to catch its breath (in seconds)
         """
@@ -34,7 +34,10 @@ class MultiTarget:
         self.commands = commands
 
     def execute(self):
-        task_id = int(os.environ['SGE_TASK_ID'])
+        task_id = None
+        for task_variable in ('SGE_TASK_ID', 'LSB_JOBINDEX'): #Array task index under gridengine and lsf
+            if task_variable in os.environ:
+                task_id = int(os.environ[task_variable])
         if task_id is None:
              RuntimeError("Multi-target launched without task id") 
         if task_id < 1 or task_id > len(self.commands):
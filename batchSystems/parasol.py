@@ -26,7 +26,6 @@ import sys
 import subprocess
 import time
 
-from Queue import Empty
 from sonLib.bioio import logger
 from multiprocessing import Process
 from multiprocessing import JoinableQueue as Queue
@@ -36,6 +35,7 @@ from multiprocessing import JoinableQueue as Queue
 
 from sonLib.bioio import logger
 from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
 from jobTree.src.master import getParasolResultsFileName
 
 def popenParasolCommand(command, runUntilSuccessful=True):
@@ -57,7 +57,7 @@ def popenParasolCommand(command, runUntilSuccessful=True):
         time.sleep(10)
         logger.critical("Waited for a few seconds, will try again")
 
-def getUpdatedJob(parasolResultsFile, outputQueue1, outputQueue2):
+def getUpdatedJob(parasolResultsFile, outputQueue):
     """We use the parasol results to update the status of jobs, adding them
     to the list of updated jobs.
     
@@ -84,8 +84,7 @@ def getUpdatedJob(parasolResultsFile, outputQueue1, outputQueue2):
             results = line.split()
             result = int(results[0])
             jobID = int(results[2])
-            outputQueue1.put(jobID)
-            outputQueue2.put((jobID, result))
+            outputQueue.put((jobID, result))
         else:
             time.sleep(0.01) #Go to sleep to avoid churning
 
@@ -94,14 +93,22 @@ class ParasolBatchSystem(AbstractBatchSystem):
     """
     def __init__(self, config, maxCpus, maxMemory):
         AbstractBatchSystem.__init__(self, config, maxCpus, maxMemory) #Call the parent constructor
-        if maxMemory != sys.maxint:
-            logger.critical("A max memory has been specified for the parasol batch system class of %i, but currently this batchsystem interface does not support such limiting" % maxMemory)
         #Keep the name of the results file for the pstat2 command..
         self.parasolCommand = config.attrib["parasol_command"]
         self.parasolResultsFile = getParasolResultsFileName(config.attrib["job_tree"])
         #Reset the job queue and results (initially, we do this again once we've killed the jobs)
         self.queuePattern = re.compile("q\s+([0-9]+)")
         self.runningPattern = re.compile("r\s+([0-9]+)\s+[\S]+\s+[\S]+\s+([0-9]+)\s+[\S]+")
+        self.addJobPattern = re.compile("your job ([0-9]+).*")
+        self.jobIndexPattern = re.compile("job index ([0-9]+)$")
+        self.parasolJobFile = os.path.join(config.attrib["job_tree"], "parasol_jobs.sh")
+        self.maxJobsPerJobFile = 1000
+        self.jobIDs = set() #The issued jobs whose results have not been returned
+        self.runningJobIDs = set() #Those reported running by the status queries
+        self.missingJobIDs = set() #Those missing from the last status query
+        self.jobEvents = [] #The job events not yet returned by getJobEvents
+        self.statusFrequency = 300 #The seconds between the status queries that find running and vanished jobs
+        self.timeStatusLastQueried = time.time()
         self.killJobs(self.getIssuedJobIDs()) #Kill any jobs on the current stack
         logger.info("Going to sleep for a few seconds to kill any existing jobs")
         time.sleep(5) #Give batch system a second to sort itself out.
@@ -115,53 +122,81 @@ class ParasolBatchSystem(AbstractBatchSystem):
             logger.critical("Could not flush the parasol batch %s" % self.parasolResultsFile)
         open(self.parasolResultsFile, 'w').close()
         logger.info("Reset the results queue")
-        #Stuff to allow max cpus to be work
-        self.outputQueue1 = Queue()
-        self.outputQueue2 = Queue()
-        #worker = Thread(target=getUpdatedJob, args=(self.parasolResultsFileHandle, self.outputQueue1, self.outputQueue2))
+        #The max cpus are enforced by the master, which holds back jobs rather than issuing them
+        self.outputQueue = Queue()
+        #worker = Thread(target=getUpdatedJob, args=(self.parasolResultsFileHandle, self.outputQueue))
         #worker.setDaemon(True)
-        worker = Process(target=getUpdatedJob, args=(self.parasolResultsFile, self.outputQueue1, self.outputQueue2))
+        worker = Process(target=getUpdatedJob, args=(self.parasolResultsFile, self.outputQueue))
         worker.daemon = True
         worker.start()
-        self.usedCpus = 0
-        self.jobIDsToCpu = {}
          
+    def getAddJobCommand(self, command, memory, cpu):
+        return "%s -verbose -ram=%i -cpu=%i -results=%s add job '%s'" % (self.parasolCommand, memory, cpu, self.parasolResultsFile, command)
+    
     def issueJob(self, command, memory, cpu):
         """Issues parasol with job commands.
         """
         self.checkResourceRequest(memory, cpu)
-        pattern = re.compile("your job ([0-9]+).*")
-        parasolCommand = "%s -verbose -ram=%i -cpu=%i -results=%s add job '%s'" % (self.parasolCommand, memory, cpu, self.parasolResultsFile, command)
-        #Deal with the cpus
-        self.usedCpus += cpu
-        while True: #Process finished results with no wait
-            try:
-               jobID = self.outputQueue1.get_nowait()
-               self.usedCpus -= self.jobIDsToCpu.pop(jobID)
-               assert self.usedCpus >= 0
-               self.outputQueue1.task_done()
-            except Empty:
-                break
-        while self.usedCpus > self.maxCpus: #If we are still waiting
-            self.usedCpus -= self.jobIDsToCpu.pop(self.outputQueue1.get())
-            assert self.usedCpus >= 0
-            self.outputQueue1.task_done()
-        #Now keep going
+        parasolCommand = self.getAddJobCommand(command, memory, cpu)
         while True:
             #time.sleep(0.1) #Sleep to let parasol catch up #Apparently unnecessary
             line = popenParasolCommand(parasolCommand)[1][0]
-            match = pattern.match(line)
+            match = self.addJobPattern.match(line)
             if match != None: #This is because parasol add job will return success, even if the job was not properly issued!
                 break
             else:
                 logger.info("We failed to properly add the job, we will try again after a sleep")
                 time.sleep(5)
         jobID = int(match.group(1))
-        self.jobIDsToCpu[jobID] = cpu
         logger.debug("Got the parasol job id: %s from line: %s" % (jobID, line))
         logger.debug("Issued the job command: %s with (parasol) job id: %i " % (parasolCommand, jobID))
+        self._queueJob(jobID)
         return jobID
     
+    def issueJobs(self, jobs):
+        """Issues parasol with a batch of job commands. Jobs are written to a job file
+        that is run by a single shell, rather than starting a process per job.
+        """
+        jobIDs = []
+        for command, memory, cpu in jobs:
+            self.checkResourceRequest(memory, cpu)
+        for i in xrange(0, len(jobs), self.maxJobsPerJobFile):
+            jobIDs += self.addJobs(jobs[i:i+self.maxJobsPerJobFile])
+        return jobIDs
+    
+    def addJobs(self, jobs):
+        """Adds the jobs to parasol using one job file, returning their parasol job ids.
+        """
+        if len(jobs) == 0:
+            return []
+        fileHandle = open(self.parasolJobFile, 'w')
+        for index, (command, memory, cpu) in enumerate(jobs):
+            #The echo marks which job the following output line belongs to
+            fileHandle.write("echo 'job index %i'\n%s\n" % (index, self.getAddJobCommand(command, memory, cpu)))
+        fileHandle.write("exit 0\n") #Failed adds are detected below, so the job file must not be rerun
+        fileHandle.close()
+        jobIDs = [ None ] * len(jobs)
+        index = None
+        for line in popenParasolCommand("sh %s" % self.parasolJobFile)[1]:
+            indexMatch = self.jobIndexPattern.match(line)
+            if indexMatch != None:
+                index = int(indexMatch.group(1))
+                continue
+            match = self.addJobPattern.match(line)
+            if match != None and index != None:
+                jobIDs[index] = int(match.group(1))
+                index = None
+        os.remove(self.parasolJobFile)
+        for index in xrange(len(jobs)):
+            if jobIDs[index] == None: #Parasol add job can fail silently, so we reissue these one at a time
+                logger.info("We failed to properly add a job from the job file, we will try again alone")
+                command, memory, cpu = jobs[index]
+                jobIDs[index] = self.issueJob(command, memory, cpu)
+            else:
+                self._queueJob(jobIDs[index])
+        logger.debug("Issued %i jobs to parasol with a job file" % len(jobs))
+        return jobIDs
+    
     def killJobs(self, jobIDs):
         """Kills the given jobs, represented as Job ids, then checks they are dead by checking
         they are not in the list of issued jobs.
@@ -172,6 +207,8 @@ class ParasolBatchSystem(AbstractBatchSystem):
                 logger.info("Tried to remove jobID: %i, with exit value: %i" % (jobID, exitValue))
             runningJobs = self.getIssuedJobIDs()
             if set(jobIDs).difference(set(runningJobs)) == set(jobIDs):
+                for jobID in jobIDs:
+                    self._forgetJob(jobID)
                 return
             time.sleep(5)
             logger.critical("Tried to kill some jobs, but something happened and they are still going, so I'll try again")
@@ -209,14 +246,71 @@ class ParasolBatchSystem(AbstractBatchSystem):
         return runningJobs
     
     def getUpdatedJob(self, maxWait):
-        jobID = self.getFromQueueSafely(self.outputQueue2, maxWait)
+        jobID = self.getFromQueueSafely(self.outputQueue, maxWait)
         if jobID != None:
-            self.outputQueue2.task_done()
+            self.outputQueue.task_done()
+            self._finishJob(jobID[0])
         return jobID
     
+    def getUpdatedJobs(self, maxWait, maxCount):
+        updatedJobs = self.getAllFromQueueSafely(self.outputQueue, maxWait, maxCount)
+        for i in updatedJobs:
+            self.outputQueue.task_done()
+            self._finishJob(i[0])
+        return updatedJobs
+    
+    def _queueJob(self, jobID):
+        self.jobIDs.add(jobID)
+        self.jobEvents.append((jobID, JOB_QUEUED, time.time()))
+    
+    def _finishJob(self, jobID):
+        if jobID in self.jobIDs: #Else the job was vanished or killed
+            self._forgetJob(jobID)
+            self.jobEvents.append((jobID, JOB_FINISHED, time.time()))
+    
+    def _forgetJob(self, jobID):
+        self.jobIDs.discard(jobID)
+        self.runningJobIDs.discard(jobID)
+        self.missingJobIDs.discard(jobID)
+    
+    def supportsJobEvents(self):
+        return True
+    
+    def getJobEvents(self):
+        """Returns the job events. Every statusFrequency seconds the jobs of the batch are listed 
+        with pstat2, giving the start times of those running. A job missing from two lists in a row 
+        whose result has not been read from the results file is vanished. This replaces the 
+        periodic listing of all the jobs of parasol, see getIssuedJobIDs.
+        """
+        if time.time() - self.timeStatusLastQueried >= self.statusFrequency:
+            self.timeStatusLastQueried = time.time()
+            listedJobIDs = set()
+            for line in popenParasolCommand("%s -results=%s pstat2 " % (self.parasolCommand, self.parasolResultsFile))[1]:
+                match = self.runningPattern.match(line)
+                if match != None:
+                    jobID = int(match.group(1))
+                    listedJobIDs.add(jobID)
+                    if jobID in self.jobIDs and jobID not in self.runningJobIDs:
+                        self.runningJobIDs.add(jobID)
+                        self.jobEvents.append((jobID, JOB_RUNNING, float(match.group(2))))
+                    continue
+                match = self.queuePattern.match(line)
+                if match != None:
+                    listedJobIDs.add(int(match.group(1)))
+            missingJobIDs = self.jobIDs.difference(listedJobIDs)
+            vanishedJobIDs = missingJobIDs.intersection(self.missingJobIDs)
+            for jobID in vanishedJobIDs:
+                logger.critical("The job %i is missing from parasol, so has vanished" % jobID)
+                self._forgetJob(jobID)
+                self.jobEvents.append((jobID, JOB_VANISHED, time.time()))
+            self.missingJobIDs = missingJobIDs.difference(vanishedJobIDs)
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+    
     def getRescueJobFrequency(self):
-        """Parasol leaks jobs, but rescuing jobs involves calls to parasol list jobs and pstat2,
-        making it expensive. 
+        """Parasol leaks jobs, which are found from the job events, see getJobEvents, so the 
+        rescue only looks for overlong jobs, from the running events. 
         """
         return 5400 #Once every 90 minutes
         
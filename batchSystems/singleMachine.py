@@ -33,23 +33,27 @@ from Queue import Empty
 from sonLib.bioio import logger
 from multiprocessing import Process
 from multiprocessing import JoinableQueue as Queue
+from multiprocessing import Queue as EventQueue
 
 from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
 from sonLib.bioio import getTempFile
 from sonLib.bioio import system
 
 from jobTree.src.jobTreeSlave import main as slaveMain
    
-def worker(inputQueue, outputQueue):
+def worker(inputQueue, outputQueue, eventQueue):
     while True:
         args = inputQueue.get()
         if args == None: #Case where we are reducing threads for max number of CPUs
             inputQueue.task_done()
             return
-        command, jobID, threadsToStart = args
-        sys.argv = command.split()[2:]
-        slaveMain()
-        outputQueue.put((jobID, 0, threadsToStart))
+        eventQueue.put((os.getpid(), [ jobID for command, jobID, threadsToStart in args ], None)) #Claims the jobs, so they are known to be lost if the worker dies
+        for command, jobID, threadsToStart in args: #Each item is a list of jobs to run in series
+            eventQueue.put((os.getpid(), jobID, time.time()))
+            sys.argv = command.split()[2:]
+            slaveMain()
+            outputQueue.put((jobID, 0, threadsToStart))
         inputQueue.task_done()
         
 class SingleMachineBatchSystem(AbstractBatchSystem):
@@ -71,11 +75,21 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
         assert self.memoryPerThread >= 1
         self.inputQueue = Queue()
         self.outputQueue = Queue()
+        self.eventQueue = EventQueue() #Workers put the jobs they claim and start on this queue
+        self.jobEvents = [] #The job events not yet returned by getJobEvents
+        self.workers = {} #Process ids of the workers to their processes
+        self.workersToJobIDs = {} #Process ids of the workers to the set of jobs they have claimed but not finished
+        self.jobIDsToWorkers = {}
+        self.jobThreadsToStart = {} #Jobs using more than one thread, to the number of extra threads
         self.workerFn = workerFn
         for i in xrange(self.maxThreads): #Setup the threads
-            worker = Process(target=workerFn, args=(self.inputQueue, self.outputQueue))
-            worker.daemon = True
-            worker.start()
+            self.startWorker()
+
+    def startWorker(self):
+        worker = Process(target=self.workerFn, args=(self.inputQueue, self.outputQueue, self.eventQueue))
+        worker.daemon = True
+        worker.start()
+        self.workers[worker.pid] = worker
 
     def issueJob(self, command, memory, cpu):
         """Runs the jobs right away.
@@ -92,10 +106,39 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
             memory -= self.memoryPerThread
             k += 1
         assert k < self.maxThreads
-        self.inputQueue.put((command, self.jobIndex, k))
+        if k > 0:
+            self.jobThreadsToStart[self.jobIndex] = k
+        self.inputQueue.put([ (command, self.jobIndex, k) ])
+        self.jobEvents.append((self.jobIndex, JOB_QUEUED, time.time()))
         self.jobIndex += 1
         return i
     
+    def issueJobs(self, jobs):
+        """Runs the jobs right away. Jobs that fit in a single thread are put on the
+        queue in chunks, so that a large batch of jobs costs a few queue puts, while 
+        still leaving several chunks per thread to balance the load.
+        """
+        jobIDs = []
+        chunk = []
+        chunkSize = max(1, len(jobs) / (4 * self.maxThreads))
+        for command, memory, cpu in jobs:
+            if cpu > self.cpusPerThread or memory > self.memoryPerThread:
+                jobIDs.append(self.issueJob(command, memory, cpu))
+                continue
+            self.checkResourceRequest(memory, cpu)
+            self.jobs[self.jobIndex] = command
+            chunk.append((command, self.jobIndex, 0))
+            self.jobEvents.append((self.jobIndex, JOB_QUEUED, time.time()))
+            jobIDs.append(self.jobIndex)
+            self.jobIndex += 1
+            if len(chunk) >= chunkSize:
+                self.inputQueue.put(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            self.inputQueue.put(chunk)
+        logger.debug("Issued %i jobs" % len(jobs))
+        return jobIDs
+    
     def killJobs(self, jobIDs):
         """As jobs are already run, this method has no effect.
         """
@@ -117,23 +160,78 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
         i = self.getFromQueueSafely(self.outputQueue, maxWait)
         if i == None:
             return None
+        return self._processUpdatedJob(i)
+    
+    def getUpdatedJobs(self, maxWait, maxCount):
+        """Returns the run jobs and the return values of their processes, draining
+        the output queue of up to maxCount results at a time.
+        """
+        return [ self._processUpdatedJob(i) for i in self.getAllFromQueueSafely(self.outputQueue, maxWait, maxCount) ]
+    
+    def _processUpdatedJob(self, i):
         jobID, exitValue, threadsToStart = i
+        self.outputQueue.task_done()
+        if jobID not in self.jobs: #The job was vanished, so its threads have been restarted
+            return (jobID, exitValue)
         self.jobs.pop(jobID)
+        self.jobThreadsToStart.pop(jobID, None)
+        self._processJobEvents() #Any claim and start of the job must be processed before it is forgotten
+        self.jobEvents.append((jobID, JOB_FINISHED, time.time()))
+        if jobID in self.jobIDsToWorkers:
+            self.workersToJobIDs[self.jobIDsToWorkers.pop(jobID)].remove(jobID)
         logger.debug("Ran jobID: %s with exit value: %i" % (jobID, exitValue))
         for j in xrange(threadsToStart):
-            worker = Process(target=self.workerFn, args=(self.inputQueue, self.outputQueue))
-            worker.daemon = True
-            worker.start()
-        self.outputQueue.task_done()
+            self.startWorker()
         return (jobID, exitValue)
     
+    def _processJobEvents(self):
+        """Processes the claims and starts of jobs put on the event queue by the workers.
+        """
+        while True:
+            try:
+                pid, jobIDs, startTime = self.eventQueue.get(block=False)
+            except Empty:
+                break
+            if startTime == None: #The jobs have been claimed
+                jobIDs = [ jobID for jobID in jobIDs if jobID in self.jobs ]
+                self.workersToJobIDs.setdefault(pid, set()).update(jobIDs)
+                for jobID in jobIDs:
+                    self.jobIDsToWorkers[jobID] = pid
+            elif jobIDs in self.jobs:
+                self.jobEvents.append((jobIDs, JOB_RUNNING, startTime))
+    
+    def supportsJobEvents(self):
+        return True
+    
+    def getJobEvents(self):
+        """Returns the job events, checking that the workers are alive. The jobs claimed by a 
+        worker that has died are vanished, and a new worker is started in its place.
+        """
+        self._processJobEvents()
+        for pid, worker in self.workers.items():
+            if not worker.is_alive():
+                self.workers.pop(pid)
+                jobIDs = [ jobID for jobID in self.workersToJobIDs.pop(pid, set()) if jobID in self.jobs ]
+                if len(jobIDs) > 0:
+                    logger.critical("A worker died with exit code %s, losing the jobs %s" % (worker.exitcode, jobIDs))
+                    self.startWorker()
+                    for jobID in jobIDs:
+                        self.jobs.pop(jobID)
+                        self.jobIDsToWorkers.pop(jobID)
+                        self.jobEvents.append((jobID, JOB_VANISHED, time.time()))
+                        for i in xrange(self.jobThreadsToStart.pop(jobID, 0)): #The threads reserved for the job
+                            self.startWorker()
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+    
     def getRescueJobFrequency(self):
         """This should not really occur, wihtout an error. To exercise the 
         system we allow it every 90 minutes. 
         """
         return 5400  
     
-def badWorker(inputQueue, outputQueue):
+def badWorker(inputQueue, outputQueue, eventQueue):
     """This is used to test what happens if we fail and restart jobs
     """
     fnull = open(os.devnull, 'w') #Pipe the output to dev/null (it is caught by the slave and will be reported if there is an error)
@@ -142,15 +240,17 @@ def badWorker(inputQueue, outputQueue):
         if args == None: #Case where we are reducing threads for max number of CPUs
             inputQueue.task_done()
             return
-        command, jobID, threadsToStart = args
-        #Run to first calculate the runtime..
-        process = subprocess.Popen(command, shell=True, stdout = fnull, stderr = fnull)
-        if random.choice((False, True)):
-            time.sleep(random.random())
-            process.kill()
-            process.wait()
-            outputQueue.put((jobID, 1, threadsToStart))
-        else:
-            process.wait()
-            outputQueue.put((jobID, process.returncode, threadsToStart))
+        eventQueue.put((os.getpid(), [ jobID for command, jobID, threadsToStart in args ], None))
+        for command, jobID, threadsToStart in args:
+            eventQueue.put((os.getpid(), jobID, time.time()))
+            #Run to first calculate the runtime..
+            process = subprocess.Popen(command, shell=True, stdout = fnull, stderr = fnull)
+            if random.choice((False, True)):
+                time.sleep(random.random())
+                process.kill()
+                process.wait()
+                outputQueue.put((jobID, 1, threadsToStart))
+            else:
+                process.wait()
+                outputQueue.put((jobID, process.returncode, threadsToStart))
         inputQueue.task_done()
@@ -0,0 +1,234 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+import os
+import sys
+import time
+import uuid
+
+from sonLib.bioio import logger
+from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
+from jobTree.src.bioio import workflowRootPath
+from jobTree.src.deleter import deletePath
+from jobTree.src.jobTreeWorker import writeSpoolFile, listSpoolDir, minPollInterval
+
+defaultWarmSlaveIdleTimeout = 60 #The default seconds a worker waits for a job before exiting
+runningJobsPollInterval = 10 #The min seconds between the listings of the workers' directories for the jobs they have claimed
+
+def getSpoolDirName(jobTreePath):
+    return os.path.join(jobTreePath, "spool")
+
+class WarmSlaveBatchSystem(AbstractBatchSystem):
+    """Runs the jobs with long lived slaves (workers, see jobTreeWorker), issued to another 
+    batch system, each of which runs many jobs one after another, so that the start up of 
+    a slave process is not paid for each job. 
+    
+    Jobs are passed to the workers through a spool directory in the jobTree. Each job issued 
+    has a ticket, holding its job file, in the queue of jobs with its memory and cpu, which 
+    a worker claims by moving it into its own directory. A worker writes the exit value of a job 
+    to the done directory, and exits once it has waited idleTimeout seconds without a job. Workers 
+    are issued to the other batch system, with the memory and cpu of their queue, whenever a 
+    queue has more jobs than workers. If a worker finishes leaving a ticket in its directory, 
+    the job is failed.
+    """
+    def __init__(self, config, batchSystem, idleTimeout=defaultWarmSlaveIdleTimeout):
+        AbstractBatchSystem.__init__(self, config, batchSystem.maxCpus, batchSystem.maxMemory) #Call the parent constructor
+        self.batchSystem = batchSystem
+        self.idleTimeout = idleTimeout
+        self.jobTree = config.attrib["job_tree"]
+        self.workerPath = os.path.join(workflowRootPath(), "src", "jobTreeWorker.py")
+        self.rootPath = os.path.split(workflowRootPath())[0]
+        deletePath(getSpoolDirName(self.jobTree)) #The workers left from a previous run exit once their spool is gone
+        self.spoolDir = os.path.join(getSpoolDirName(self.jobTree), uuid.uuid4().hex)
+        for dirName in ("queue", "workers", "done"):
+            os.makedirs(os.path.join(self.spoolDir, dirName))
+        self.jobIndex = 0
+        self.jobs = {} #Issued jobs to the queues of their tickets
+        self.queues = {} #Queue names to the number of jobs issued to them, the number of workers and the memory and cpu of the workers
+        self.workers = {} #The workers' ids in the other batch system to their names and queues
+        self.workerIndex = 0
+        self.updatedJobs = [] #Jobs found finished and not yet returned
+        self.jobEvents = [] #The job events not yet returned by getJobEvents
+        self.runningJobIDs = set() #The jobs reported running by the job events
+        self.timeWorkersLastListed = 0
+        
+    def getResourcePool(self, command, memory, cpu):
+        return self.batchSystem.getResourcePool(command, memory, cpu)
+    
+    def issueJob(self, command, memory, cpu):
+        return self.issueJobs([ (command, memory, cpu) ])[0]
+    
+    def issueJobs(self, jobs):
+        """Writes the tickets of the jobs, then issues any workers needed to run them.
+        """
+        jobIDs = []
+        for command, memory, cpu in jobs:
+            self.checkResourceRequest(memory, cpu)
+            queueName = "%s_%s" % (memory, cpu)
+            if queueName not in self.queues:
+                os.mkdir(os.path.join(self.spoolDir, "queue", queueName))
+                self.queues[queueName] = [ 0, 0, memory, cpu ]
+            writeSpoolFile(os.path.join(self.spoolDir, "queue", queueName, str(self.jobIndex)), command.split()[-1])
+            self.queues[queueName][0] += 1
+            self.jobs[self.jobIndex] = queueName
+            self.jobEvents.append((self.jobIndex, JOB_QUEUED, time.time()))
+            jobIDs.append(self.jobIndex)
+            self.jobIndex += 1
+        self._issueWorkers()
+        return jobIDs
+    
+    def _issueWorkers(self):
+        """Issues a worker for each job of a queue beyond its number of workers.
+        """
+        workers = []
+        for queueName, (jobNumber, workerNumber, memory, cpu) in self.queues.items():
+            for i in xrange(jobNumber - workerNumber):
+                workers.append(("w%i" % self.workerIndex, queueName, memory, cpu))
+                self.workerIndex += 1
+            self.queues[queueName][1] = max(jobNumber, workerNumber)
+        if len(workers) > 0:
+            workerIDs = self.batchSystem.issueJobs([ ("%s -E %s %s %s %s %s %s %s" % (sys.executable, self.workerPath, self.rootPath, self.jobTree, 
+                                                                                       self.spoolDir, queueName, workerName, self.idleTimeout), memory, cpu) 
+                                                    for workerName, queueName, memory, cpu in workers ])
+            for workerID, (workerName, queueName, memory, cpu) in zip(workerIDs, workers):
+                self.workers[workerID] = (workerName, queueName)
+            logger.debug("Issued %i workers" % len(workers))
+    
+    def _finishJob(self, jobID, exitValue):
+        self.queues[self.jobs.pop(jobID)][0] -= 1
+        self.updatedJobs.append((jobID, exitValue))
+        self.runningJobIDs.discard(jobID)
+        self.jobEvents.append((jobID, JOB_FINISHED, time.time()))
+    
+    def _processDoneJobs(self):
+        doneDir = os.path.join(self.spoolDir, "done")
+        for ticket in listSpoolDir(doneDir):
+            fileHandle = open(os.path.join(doneDir, ticket), 'r')
+            exitValue = int(fileHandle.read())
+            fileHandle.close()
+            os.remove(os.path.join(doneDir, ticket))
+            if int(ticket) in self.jobs: #Else the job was killed
+                self._finishJob(int(ticket), exitValue)
+    
+    def _processFinishedWorkers(self):
+        self._removeWorkers([ workerID for workerID, exitValue in self.batchSystem.getUpdatedJobs(0, sys.maxint) ])
+    
+    def _removeWorkers(self, workerIDs):
+        """Fails the jobs left claimed by the given workers, which have finished or been lost by the 
+        other batch system, then issues any workers needed to replace them.
+        """
+        finishedWorkers = [ self.workers.pop(workerID) for workerID in workerIDs if workerID in self.workers ]
+        if len(finishedWorkers) > 0:
+            self._processDoneJobs() #The jobs a worker finished before it did
+            for workerName, queueName in finishedWorkers:
+                self.queues[queueName][1] -= 1
+                workerDir = os.path.join(self.spoolDir, "workers", workerName)
+                if os.path.isdir(workerDir):
+                    for ticket in listSpoolDir(workerDir):
+                        if int(ticket) in self.jobs:
+                            logger.critical("The worker %s finished while running the job %s, so it has failed" % (workerName, ticket))
+                            self._finishJob(int(ticket), 1)
+                    deletePath(workerDir)
+            self._issueWorkers()
+    
+    def getUpdatedJob(self, maxWait):
+        updatedJobs = self.getUpdatedJobs(maxWait, 1)
+        if len(updatedJobs) == 0:
+            return None
+        return updatedJobs[0]
+    
+    def getUpdatedJobs(self, maxWait, maxCount):
+        """Polls the done directory, and the other batch system for finished workers, until a job 
+        is found finished or maxWait seconds have passed.
+        """
+        endTime = time.time() + maxWait
+        pollInterval = minPollInterval
+        while True:
+            self._processFinishedWorkers()
+            self._processDoneJobs()
+            remaining = endTime - time.time()
+            if len(self.updatedJobs) > 0 or remaining <= 0:
+                break
+            time.sleep(min(pollInterval, remaining))
+            pollInterval = min(2 * pollInterval, 0.5)
+        updatedJobs = self.updatedJobs[:maxCount]
+        self.updatedJobs = self.updatedJobs[maxCount:]
+        return updatedJobs
+    
+    def killJobs(self, jobIDs):
+        """Removes the tickets of the jobs not yet claimed, and kills the workers running the others.
+        """
+        workerIDs = []
+        for jobID in jobIDs:
+            self.runningJobIDs.discard(jobID)
+            queueName = self.jobs.pop(jobID)
+            self.queues[queueName][0] -= 1
+            try:
+                os.remove(os.path.join(self.spoolDir, "queue", queueName, str(jobID)))
+            except OSError: #Claimed by a worker
+                workerIDs += [ workerID for workerID, (workerName, workerQueueName) in self.workers.items() 
+                               if os.path.exists(os.path.join(self.spoolDir, "workers", workerName, str(jobID))) ]
+        if len(workerIDs) > 0:
+            self.batchSystem.killJobs(workerIDs)
+            for workerID in workerIDs: #Forgotten, so they are not waited for
+                workerName, queueName = self.workers.pop(workerID)
+                self.queues[queueName][1] -= 1
+                deletePath(os.path.join(self.spoolDir, "workers", workerName))
+    
+    def getIssuedJobIDs(self):
+        return self.jobs.keys() + [ jobID for jobID, exitValue in self.updatedJobs ]
+    
+    def getRunningJobIDs(self):
+        """Returns the jobs claimed by the workers, with the time since they were claimed.
+        """
+        runningJobIDs = {}
+        now = time.time()
+        for workerName, queueName in self.workers.values():
+            workerDir = os.path.join(self.spoolDir, "workers", workerName)
+            try:
+                for ticket in listSpoolDir(workerDir):
+                    if int(ticket) in self.jobs:
+                        runningJobIDs[int(ticket)] = now - os.stat(os.path.join(workerDir, ticket)).st_mtime
+            except OSError: #The worker has not started, or has just finished
+                pass
+        return runningJobIDs
+    
+    def supportsJobEvents(self):
+        return self.batchSystem.supportsJobEvents()
+    
+    def getJobEvents(self):
+        """Returns the job events. The workers the other batch system reports vanished are removed, 
+        failing the jobs they claimed, and the jobs claimed by the workers, found by listing their 
+        directories at most every runningJobsPollInterval seconds, are running.
+        """
+        self._removeWorkers([ workerID for workerID, state, eventTime in self.batchSystem.getJobEvents() if state == JOB_VANISHED ])
+        if time.time() - self.timeWorkersLastListed >= runningJobsPollInterval:
+            self.timeWorkersLastListed = time.time()
+            for jobID, runTime in self.getRunningJobIDs().items():
+                if jobID not in self.runningJobIDs:
+                    self.runningJobIDs.add(jobID)
+                    self.jobEvents.append((jobID, JOB_RUNNING, self.timeWorkersLastListed - runTime))
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+    
+    def getRescueJobFrequency(self):
+        return self.batchSystem.getRescueJobFrequency()
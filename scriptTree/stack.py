@@ -36,7 +36,8 @@ from sonLib.bioio import setLogLevel
 from sonLib.bioio import setLoggingFromOptions
 from sonLib.bioio import getTempFile
 from sonLib.bioio import getTempDirectory 
-from sonLib.bioio import system, absSymPath
+from sonLib.bioio import absSymPath
+from jobTree.src.deleter import deleter
 from sonLib.bioio import getTotalCpuTimeAndMemoryUsage, getTotalCpuTime
 
 from jobTree.src.jobTreeRun import addOptions
@@ -47,6 +48,18 @@ from jobTree.src.jobTreeRun import loadEnvironment
 from jobTree.src.master import mainLoop
 
 from jobTree.scriptTree.target import Target
+from jobTree.scriptTree.target import FunctionWrappingTarget
+
+#The total and number of the run times of the targets run by this process, by target name, 
+#used to estimate the run times of targets that do not declare one
+_targetRunTimes = {}
+
+def getTargetName(target):
+    """Name of the function or class run by a target.
+    """
+    if isinstance(target, FunctionWrappingTarget):
+        return ".".join((target.fnModule, target.fnName))
+    return ".".join((target.__class__.__module__, target.__class__.__name__))
 
 class Stack(object):
     """Holds together a stack of targets and runs them.
@@ -99,15 +112,16 @@ class Stack(object):
 ####
         
     def makeRunnable(self, tempDir):
+        """Pickles the stack, returning the command to run it, see jobTreeSlave.loadStack. The 
+        import strings of the target's classes are pickled first, rather than added to the command, 
+        which keeps the commands in the job records short.
+        """
         pickleFile = getTempFile(".pickle", tempDir)
-        fileHandle = open(pickleFile, 'w')
+        fileHandle = open(pickleFile, 'wb')
+        cPickle.dump(sorted(self.target.importStrings), fileHandle, cPickle.HIGHEST_PROTOCOL)
         cPickle.dump(self, fileHandle, cPickle.HIGHEST_PROTOCOL)
         fileHandle.close() 
-        i = set()
-        for importString in self.target.importStrings:
-            i.add(importString)
-        classNames = " ".join(i)
-        return "scriptTree %s %s" % (pickleFile, classNames)
+        return "scriptTree %s" % pickleFile
     
     def getMemory(self, defaultMemory=sys.maxint):
         memory = self.target.getMemory()
@@ -121,6 +135,26 @@ class Stack(object):
             return defaultCpu
         return cpu
     
+    def getPriorityTuple(self):
+        """The priority is only added to the job's commands if it is not the default.
+        """
+        priority = self.target.getPriority()
+        if priority == 0:
+            return ()
+        return (priority,)
+    
+    def getEstimatedRunTime(self):
+        """The run time declared by the target, else the mean run time of the targets of 
+        the same name run by this process, else sys.maxint.
+        """
+        runTime = self.target.getRunTime()
+        if runTime != sys.maxint:
+            return runTime
+        if getTargetName(self.target) in _targetRunTimes:
+            totalRunTime, runs = _targetRunTimes[getTargetName(self.target)]
+            return totalRunTime / runs
+        return sys.maxint
+    
     def getLocalTempDir(self):
         self.tempDirAccessed = True
         return self.localTempDir
@@ -130,7 +164,14 @@ class Stack(object):
 
     def execute(self, job, stats, localTempDir, globalTempDir, 
                 memoryAvailable, cpuAvailable,
-                defaultMemory, defaultCpu, depth):
+                defaultMemory, defaultCpu, depth, inlineTime=0.0):
+        """Runs the target, adding its follow on and children to the job. Children whose 
+        estimated run times fit within inlineTime seconds, in total, and whose memory and cpu 
+        requirements fit those available are added as follow ons, above the target's follow on, 
+        so that the slave can run them itself, rather than as child jobs. If more than one cpu 
+        is available and the children fit in the memory and cpu available, together, they 
+        are all added as follow ons, for the slave to run concurrently.
+        """
         self.tempDirAccessed = False
         self.localTempDir = localTempDir
         self.globalTempDir = globalTempDir
@@ -150,13 +191,17 @@ class Stack(object):
         if targetCpu != sys.maxint:
             assert targetCpu <= cpuAvailable
         #Run the target, first cleanup then run.
+        targetStartTime = time.time()
         self.target.run()
+        totalRunTime, runs = _targetRunTimes.get(getTargetName(self.target), (0.0, 0))
+        _targetRunTimes[getTargetName(self.target)] = (totalRunTime + time.time() - targetStartTime, runs + 1)
+        inlineTime -= time.time() - targetStartTime #The target's own run time is taken from the budget
         #Change dir back to cwd dir, if changed by target (this is a safety issue)
         if os.getcwd() != baseDir:
             os.chdir(baseDir)
         #Cleanup after the target
         if self.tempDirAccessed:
-            system("rm -rf %s/*" % self.localTempDir)
+            deleter.deleteContents(self.localTempDir)
             self.tempDirAccessed = False
         #Handle the follow on
         followOn = self.target.getFollowOn()
@@ -167,21 +212,53 @@ class Stack(object):
             job.followOnCommands.append((followOnStack.makeRunnable(self.globalTempDir),
                                          followOnStack.getMemory(defaultMemory),
                                          followOnStack.getCpu(defaultCpu),
-                                         depth))
+                                         depth) + followOnStack.getPriorityTuple())
         
         #Now add the children to the newChildren stack
         newChildren = self.target.getChildren()
         newChildren.reverse()
         assert len(job.children) == 0
+        inlineChildren = []
+        concurrentChildren = []
+        def inlineChild(child, runTime):
+            #The child is inlined if it fits in the remaining time and resources
+            if runTime <= inlineTime - sum([ i[1] for i in inlineChildren ]) and \
+            child[1] <= memoryAvailable and child[2] <= cpuAvailable:
+                inlineChildren.append((child[:3] + (depth+1,) + child[3:], runTime))
+                return True
+            return False
+        def addChild(child, runTime):
+            #The child may be run concurrently if it fits in the resources with the others to be
+            if cpuAvailable > 1 and child[1] + sum([ i[0][1] for i in concurrentChildren ]) <= memoryAvailable and \
+            child[2] + sum([ i[0][2] for i in concurrentChildren ]) <= cpuAvailable:
+                concurrentChildren.append((child, runTime))
+            elif not inlineChild(child, runTime):
+                job.children.append(child)
         while len(newChildren) > 0:
             childStack = Stack(newChildren.pop())
-            job.children.append((childStack.makeRunnable(self.globalTempDir),
+            addChild((childStack.makeRunnable(self.globalTempDir),
                      childStack.getMemory(defaultMemory),
-                     childStack.getCpu(defaultCpu)))
+                     childStack.getCpu(defaultCpu)) + childStack.getPriorityTuple(),
+                     childStack.getEstimatedRunTime())
         
          #Now build jobs for each child command
         for childCommand, runTime in self.target.getChildCommands():
-            job.children.append((childCommand, defaultMemory, defaultCpu))
+            addChild((childCommand, defaultMemory, defaultCpu), runTime)
+        
+        #The children are only run concurrently if none are left to issue as jobs, else they 
+        #would not be run until those jobs had finished, and then by a slave with their cpus
+        if len(job.children) == 0:
+            inlineChildren = [ (child[:3] + (depth+1,) + child[3:], 0.0) for child, runTime in concurrentChildren ] + inlineChildren
+        else:
+            for child, runTime in concurrentChildren:
+                if not inlineChild(child, runTime):
+                    job.children.append(child)
+        
+        #The inlined children are pushed in reverse, so they are run in the order they were added
+        inlineChildren.reverse()
+        job.followOnCommands += [ i[0] for i in inlineChildren ]
+        if len(inlineChildren) > 0:
+            logger.debug("Running %i children of the target in the slave" % len(inlineChildren))
             
         for message in self.target.getMasterLoggingMessages():
             job.messages.append(message)
@@ -30,8 +30,11 @@ class Target(object):
     """Each job wrapper extends this class.
     """
     
-    def __init__(self, time=sys.maxint, memory=sys.maxint, cpu=sys.maxint):
+    def __init__(self, time=sys.maxint, memory=sys.maxint, cpu=sys.maxint, priority=0):
         """This method must be called by any overiding constructor.
+        
+        When the jobTree has more jobs ready to run than its max cpus or max memory allow, 
+        the jobs of targets with higher priorities are issued first.
         """
         self.__followOn = None
         self.__children = []
@@ -39,6 +42,7 @@ class Target(object):
         self.__memory = memory
         self.__time = time #This parameter is no longer used by the batch system.
         self.__cpu = cpu
+        self.__priority = priority
         self.globalTempDir = None
         if self.__module__ == "__main__":
             raise RuntimeError("The module name of class %s is __main__, which prevents us from serialising it properly, \
@@ -118,6 +122,11 @@ please ensure you re-import targets defined in main" % self.__class__.__name__)
         """
         return self.__cpu
     
+    def getPriority(self):
+        """Returns the priority of the target.
+        """
+        return self.__priority
+    
     def getFollowOn(self):
         """Get the follow on target.
         """
@@ -0,0 +1,136 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+
+"""Removes files and directories without forking a shell, either directly or, once 
+started, on a background thread, so reclaiming the directories of finished jobs does 
+not hold up the process.
+"""
+
+import os
+import stat
+import errno
+import shutil
+import threading
+import Queue
+import uuid
+
+def getTrashDirName(jobTreePath):
+    return os.path.join(jobTreePath, "trash")
+
+def deletePath(path):
+    """Removes a file or directory, recursively, ignoring errors, like rm -rf. 
+    Returns False if there was nothing to remove.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return False
+    if stat.S_ISDIR(mode):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return True
+
+class Deleter:
+    """Deletes paths directly until started. Once started, a path to delete is first renamed 
+    into the trash directory, which frees its name at once, and then removed by a background 
+    thread, which takes the paths queued in batches. Paths that can not be renamed into 
+    the trash, such as those on another file system, are deleted directly.
+    """
+    def __init__(self):
+        self.trashDir = None
+        self.queue = None
+        self.thread = None
+        self.pathsDeleted = 0
+    
+    def start(self, trashDir):
+        """Starts deleting in the background, using the given trash directory.
+        """
+        assert self.thread == None
+        try:
+            os.makedirs(trashDir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: #Another process may have made it
+                raise
+        self.trashDir = trashDir
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._deleteQueuedPaths)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Waits for the queued paths to be deleted, then deletes directly again.
+        """
+        if self.thread != None:
+            self.queue.put(None)
+            self.thread.join()
+            self.trashDir, self.queue, self.thread = None, None, None
+    
+    def forked(self):
+        """Deletes directly again in a forked process, which does not have the background thread.
+        """
+        self.trashDir, self.queue, self.thread = None, None, None
+    
+    def delete(self, path):
+        """Deletes the given file or directory, recursively.
+        """
+        if self.thread != None:
+            trashPath = os.path.join(self.trashDir, uuid.uuid4().hex)
+            try:
+                os.rename(path, trashPath)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return
+            else:
+                self.queue.put(trashPath)
+                return
+        if deletePath(path):
+            self.pathsDeleted += 1
+    
+    def deleteContents(self, dirName):
+        """Deletes the contents of the given directory, like rm -rf dirName/*.
+        """
+        try:
+            fileNames = os.listdir(dirName)
+        except OSError:
+            return
+        for fileName in fileNames:
+            self.delete(os.path.join(dirName, fileName))
+    
+    def _deleteQueuedPaths(self):
+        while True:
+            paths = [ self.queue.get() ]
+            try:
+                while True: #Takes all the paths queued so far as a batch
+                    paths.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            for path in paths:
+                if path != None:
+                    deletePath(path)
+                    self.pathsDeleted += 1
+            if None in paths:
+                break
+
+deleter = Deleter() #Shared by everything deleting in a process, started by the master and slaves if the deletion is in the background
@@ -0,0 +1,200 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""Removes, at a limited rate, the files the jobs leave behind on the shared disk: the 
+directories of finished (shell) jobs, which are otherwise only removed when an ancestor 
+next runs, the global temp directories of jobs waiting for their children, which are 
+otherwise kept until the jobs run again, and the stats files and trash abandoned by killed 
+processes.
+"""
+
+import os
+import re
+import stat
+import time
+from collections import OrderedDict, deque
+
+from jobTree.src.deleter import deleter
+
+globalTempDirPattern = re.compile("gTD([0-9]+)$")
+
+def getPathSize(path):
+    """Returns the number of bytes and the number of inodes used by a file or directory, recursively.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return 0, 0
+    paths = [ path ]
+    if stat.S_ISDIR(mode):
+        for dirPath, dirNames, fileNames in os.walk(path):
+            paths += [ os.path.join(dirPath, fileName) for fileName in dirNames + fileNames ]
+    bytes, inodes = 0, 0
+    for path in paths:
+        try:
+            bytes += os.lstat(path).st_size
+            inodes += 1
+        except OSError: #Removed while we looked
+            pass
+    return bytes, inodes
+
+class GarbageCollector:
+    """The garbage of a job still waiting for its children is kept by the job (its owner) and 
+    discarded if the job is issued before the garbage is collected, as the job's slave then 
+    cleans up after itself, and may reuse the names of the directories. The garbage is 
+    collected, a path at a time, by collect, which is called by the master each time round its 
+    loop and removes at most rate paths a second. Until started, garbage is ignored.
+    """
+    def __init__(self):
+        self.jobStore = None
+        self.garbage = OrderedDict() #Owner's job file to its list of garbage
+        self.stalePaths = deque()
+        self.bytesReclaimed = 0
+        self.inodesReclaimed = 0
+    
+    def start(self, jobStore, rate, trashDir=None, statsDirs=[], staleAge=3600, sweepFrequency=600):
+        """Starts collecting garbage, removing at most rate paths a second. Every sweepFrequency seconds 
+        the paths left in the trash directory and the part written (.new) files left in the stats 
+        directories for more than staleAge seconds are collected too.
+        """
+        assert rate > 0
+        self.jobStore = jobStore
+        self.rate = rate
+        self.staleDirs = ([ (trashDir, lambda fileName : True) ] if trashDir != None else []) + \
+                         [ (statsDir, lambda fileName : fileName[-4:] == ".new") for statsDir in statsDirs ]
+        self.staleAge = staleAge
+        self.sweepFrequency = sweepFrequency
+        self.allowance = 0.0
+        self.timeLastCollected = time.time()
+        self.timeLastSwept = time.time()
+    
+    def stop(self):
+        """Stops collecting garbage, leaving that not yet collected to be cleaned up by the slaves.
+        """
+        self.jobStore = None
+        self.garbage = OrderedDict()
+        self.stalePaths = deque()
+    
+    def addJob(self, job, ownerJobFile):
+        """Adds a finished job, which is removed with its directory, to the garbage of the given 
+        job, its parent. Top jobs, whose owner is None, are not collected. The job's own garbage 
+        within its directory is dropped, as it is removed with the job, and once the owner is issued 
+        again its slave may make new children at the same paths, which must not be removed.
+        """
+        if self.jobStore != None and ownerJobFile != None:
+            jobDir = os.path.join(job.jobDir, "")
+            garbage = [ item for item in self.garbage.pop(job.getJobFileName(), []) 
+                        if not os.path.join(item[0] if isinstance(item, tuple) else item.jobDir, "").startswith(jobDir) ]
+            if len(garbage) > 0: #In the sharded layout the job's children are not within its directory
+                self.garbage[job.getJobFileName()] = garbage
+            self.garbage.setdefault(ownerJobFile, []).append(job)
+    
+    def addGlobalTempDirs(self, job):
+        """Adds the global temp directories of a job waiting for its children that neither its next 
+        follow on nor its children use, see _removeGlobalTempDirs.
+        """
+        if self.jobStore != None:
+            depth = job.followOnCommands[-1][3] if len(job.followOnCommands) > 0 else -1
+            self.garbage.setdefault(job.getJobFileName(), []).append((job.jobDir, depth))
+    
+    def discard(self, jobFile):
+        """Discards the garbage of the given job, which is about to be issued.
+        """
+        self.garbage.pop(jobFile, None)
+    
+    def getNumberOfPathsToCollect(self):
+        return sum([ len(garbage) for garbage in self.garbage.values() ]) + len(self.stalePaths)
+    
+    def collect(self):
+        """Removes as much garbage as allowed by the rate since the last call.
+        """
+        if self.jobStore == None:
+            return
+        now = time.time()
+        self.allowance = min(self.rate, self.allowance + (now - self.timeLastCollected) * self.rate) #So at most a second's worth of paths are removed at once
+        self.timeLastCollected = now
+        if now - self.timeLastSwept >= self.sweepFrequency and len(self.stalePaths) == 0:
+            self._sweep(now)
+            self.timeLastSwept = now
+        while self.allowance >= 1.0:
+            if len(self.stalePaths) > 0:
+                self._removePath(self.stalePaths.popleft())
+            elif len(self.garbage) > 0:
+                ownerJobFile = next(iter(self.garbage))
+                garbage = self.garbage[ownerJobFile]
+                item = garbage.pop()
+                if len(garbage) == 0:
+                    self.garbage.pop(ownerJobFile)
+                if isinstance(item, tuple):
+                    jobDir, depth = item
+                    self._removeGlobalTempDirs(jobDir, depth)
+                else:
+                    self._removeJob(item)
+            else:
+                break
+            self.allowance -= 1.0
+    
+    def _sweep(self, now):
+        for dirName, isGarbage in self.staleDirs:
+            try:
+                fileNames = os.listdir(dirName)
+            except OSError:
+                continue
+            for fileName in filter(isGarbage, fileNames):
+                path = os.path.join(dirName, fileName)
+                try:
+                    if now - os.lstat(path).st_ctime >= self.staleAge: #The change time is updated by the rename into the trash
+                        self.stalePaths.append(path)
+                except OSError: #Removed while we looked
+                    pass
+    
+    def _reclaim(self, path):
+        bytes, inodes = getPathSize(path)
+        self.bytesReclaimed += bytes
+        self.inodesReclaimed += inodes
+    
+    def _removePath(self, path):
+        self._reclaim(path)
+        deleter.delete(path)
+    
+    def _removeGlobalTempDirs(self, jobDir, depth):
+        """Removes the global temp directories deeper than the given depth, of the next follow on, 
+        except the deepest. The slave removes those deeper than each target it runs, so the deepest 
+        is that of the last target run, which made the children and holds their pickles.
+        """
+        try:
+            fileNames = os.listdir(jobDir)
+        except OSError: #The job has been removed
+            return
+        depths = {}
+        for fileName in fileNames:
+            match = globalTempDirPattern.match(fileName)
+            if match != None:
+                depths[int(match.group(1))] = fileName
+        for i in depths:
+            if depth < i < max(depths):
+                self._removePath(os.path.join(jobDir, depths[i]))
+    
+    def _removeJob(self, job):
+        if self.jobStore.exists(job.getJobFileName()):
+            self._reclaim(job.jobDir)
+            self.jobStore.delete(job)
+
+garbageCollector = GarbageCollector() #Shared by the master, which starts it if garbage collection is turned on
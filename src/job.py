@@ -5,7 +5,11 @@ import marshal as pickler
 #import json as pickler    
 import os
 import re
-from jobTree.src.bioio import system
+import struct
+import uuid
+import errno
+import zlib
+from jobTree.src.deleter import deleter
 
 def getJobFileName(jobDir):
     return os.path.join(jobDir, "job")
@@ -14,13 +18,15 @@ def getJobLogFileName(jobDir):
     return os.path.join(jobDir, "log.txt")
 
 class Job:
-    def __init__(self, command, memory, cpu, tryCount, jobDir):
+    def __init__(self, command, memory, cpu, tryCount, jobDir, priority=0):
         self.remainingRetryCount = tryCount
         self.jobDir = jobDir
         self.children = []
         self.followOnCommands = []
-        self.followOnCommands.append((command, memory, cpu, 0))
+        self.followOnCommands.append((command, memory, cpu, 0) + _getPriorityTuple(priority))
         self.messages = []
+        self.partial = False #If True, the job was read without its follow on commands, so can not be written
+        self.generation = 0 #The number of times the job's record has been written, so readers can tell if it has changed
     
     def getJobFileName(self):
         return getJobFileName(self.jobDir)
@@ -31,14 +37,44 @@ class Job:
     def getGlobalTempDirName(self):
         return os.path.join(self.jobDir, "gTD")
     
+    def copy(self):
+        """Returns a copy of the job, whose lists can be changed without changing the job.
+        """
+        job = Job("", 0, 0, 0, None)
+        job.__dict__.update(self.__dict__)
+        job.children = list(self.children)
+        job.followOnCommands = list(self.followOnCommands)
+        job.messages = list(self.messages)
+        return job
+    
     @staticmethod
-    def read(jobFile):
-        """Loads a job from disk.
+    def read(jobFile, partial=False):
+        """Loads a job from disk. If partial is True the follow on commands are not read, 
+        see recordToJob.
         """
-        fileHandle = open(jobFile, 'r')
-        job = _convertJsonJobToJob(pickler.load(fileHandle))
+        fileHandle = open(jobFile, 'rb')
+        if partial:
+            record = fileHandle.read(_recordHeader.size)
+            header = _unpackRecordHeader(record)
+            if header != None: #Read up to the follow on commands, which are the last section
+                record += fileHandle.read(max(0, header[-2] - len(record)))
+            else:
+                record += fileHandle.read()
+        else:
+            record = fileHandle.read()
         fileHandle.close()
-        return job
+        return recordToJob(record, partial)
+    
+    @staticmethod
+    def readHeader(jobFile):
+        """Loads just the header of a job from disk, see JobHeader.
+        """
+        fileHandle = open(jobFile, 'rb')
+        record = fileHandle.read(getRecordHeaderSize())
+        if not isRecordHeader(record): #A record in the old format, which has no header
+            record += fileHandle.read()
+        fileHandle.close()
+        return recordToJobHeader(jobFile, record)
 
     def write(self):
         """Updates a job's status on disk atomically
@@ -54,45 +90,267 @@ class Job:
         """Removes from disk atomically, can not then subsequently call read(), write() or addChildren()
         """
         os.remove(self.getJobFileName()) #This is the atomic operation, if this file is not present the job is deleted.
-        dirToRemove = self.jobDir
-        while 1:
-            head, tail = os.path.split(dirToRemove)
-            if re.match("t[0-9]+$", tail):
-                command = "rm -rf %s" % dirToRemove
-            else:
-                command = "rm -rf %s/*" % dirToRemove #We're at the root
-            try:
-                system(command)
-            except RuntimeError:
-                pass #This is not a big deal, as we expect collisions
-            dirToRemove = head
-            try:
-                if len(os.listdir(dirToRemove)) != 0:
-                    break
-            except os.error: #In case stuff went wrong, but as this is not critical we let it slide
-                break
+        deleteJobDir(self.jobDir)
     
-    def update(self, depth, tryCount):
+    def update(self, depth, tryCount, jobsDir=None):
         """Creates a set of child jobs for the given job and updates state of job atomically on disk with new children.
+        If jobsDir is given the children are made in the sharded layout, see getShardedJobDirs, and their 
+        directories are listed in the .updating file, so they can be removed if the update is interrupted.
         """
         updatingFile = self.getJobFileName() + ".updating"
-        open(updatingFile, 'w').close()
-        if len(self.children) == 1: #Just make it a follow on
-            self.followOnCommands.append(self.children.pop() + (depth + 1,))
-        elif len(self.children) > 1:
-            self.children = [ (Job(command, memory, cpu, tryCount, tempDir).write(), memory, cpu) for ((command, memory, cpu), tempDir) in zip(self.children, _createTempDirectories(self.jobDir, len(self.children))) ]
+        childDirs = self.getChildDirs(jobsDir)
+        fileHandle = open(updatingFile, 'w')
+        if childDirs != None:
+            fileHandle.write("".join([ "%s\n" % childDir for childDir in childDirs ]))
+        fileHandle.close()
+        self.makeChildren(depth, tryCount, writeNewJob, childDirs)
         self._write(".new")
         os.remove(updatingFile)
         os.rename(self.getJobFileName() + ".new", self.getJobFileName())
+    
+    def getChildDirs(self, jobsDir):
+        """Returns the names of the directories for the children of the job in the sharded layout, or 
+        None if jobsDir is None, for the nested layout, or if the job does not have more than one child.
+        """
+        if jobsDir == None or len(self.children) <= 1:
+            return None
+        return getShardedJobDirs(jobsDir, len(self.children))
+    
+    def makeChildren(self, depth, tryCount, writeFn, childDirs=None):
+        """Turns the children of the job into jobs, in new directories, writing each with writeFn, 
+        which returns the child's job file. A single child is made a follow on instead. The 
+        directories are those given by childDirs, else new directories below the job's directory.
+        """
+        if len(self.children) == 1: #Just make it a follow on
+            child = self.children.pop()
+            self.followOnCommands.append(child[:3] + (depth + 1,) + child[3:])
+        elif len(self.children) > 1:
+            if childDirs == None:
+                childDirs = _createTempDirectories(self.jobDir, len(self.children))
+            else:
+                _makeShardedJobDirs(childDirs)
+            self.children = [ (writeFn(Job(child[0], child[1], child[2], tryCount, tempDir, *child[3:])),) + child[1:] for (child, tempDir) in zip(self.children, childDirs) ]
         
     def _write(self, suffix=""):
-        fileHandle = open(self.getJobFileName() + suffix, 'w')
-        pickler.dump(_convertJobToJson(self), fileHandle)
+        self.generation += 1
+        fileHandle = open(self.getJobFileName() + suffix, 'wb')
+        fileHandle.write(jobToRecord(self))
         fileHandle.close()
 
+def deleteJobDir(jobDir):
+    """Removes the directory of a deleted job, and the directories above it left empty, 
+    up to the root of the jobs.
+    """
+    if shardedJobDirPattern.match(os.path.split(jobDir)[1]): #In the sharded layout the directories above are shared
+        deleter.delete(jobDir)
+        return
+    dirToRemove = jobDir
+    while 1:
+        head, tail = os.path.split(dirToRemove)
+        if re.match("t[0-9]+$", tail):
+            deleter.delete(dirToRemove)
+        else:
+            deleter.deleteContents(dirToRemove) #We're at the root
+        dirToRemove = head
+        try:
+            if len(os.listdir(dirToRemove)) != 0:
+                break
+        except os.error: #In case stuff went wrong, but as this is not critical we let it slide
+            break
+
+class JobHeader:
+    """The fields of the fixed size header of a job's record, which can be read without the 
+    rest of the record. The memory, cpu, depth and priority are those of the next follow on.
+    """
+    def __init__(self, jobFile, remainingRetryCount, childCount, followOnCount, messageCount, 
+                 memory, cpu, depth, priority, generation):
+        self.jobFile = jobFile
+        self.remainingRetryCount = remainingRetryCount
+        self.childCount = childCount
+        self.followOnCount = followOnCount
+        self.messageCount = messageCount
+        self.memory = memory
+        self.cpu = cpu
+        self.depth = depth
+        self.priority = priority
+        self.generation = generation
+    
+    def getJobFileName(self):
+        return self.jobFile
+    
+    def getLogFileName(self):
+        return getJobLogFileName(os.path.split(self.jobFile)[0])
+
+def jobToRecord(job):
+    """Returns the string a job is stored as. The record is a fixed size header, holding the 
+    format version, the counts of the job's children, follow ons and messages, the requirements of 
+    its next follow on and the job's generation, followed by the job's directory, children, messages 
+    and follow on commands, each marshalled, at offsets given in the header. Sections larger than 
+    recordCompressionThreshold are compressed, if that makes them smaller, which is flagged in the header.
+    """
+    global recordBytesSaved
+    assert not job.partial
+    sections = [ pickler.dumps(section) for section in (job.jobDir, job.children, job.messages, job.followOnCommands) ]
+    flags = 0
+    for i, flag in enumerate(_compressedFlags):
+        if len(sections[i]) > recordCompressionThreshold:
+            compressedSection = zlib.compress(sections[i], 1) #Fast compression, as records are written often
+            if len(compressedSection) < len(sections[i]):
+                recordBytesSaved += len(sections[i]) - len(compressedSection)
+                sections[i] = compressedSection
+                flags |= flag
+    offsets = [ _recordHeader.size ]
+    for section in sections:
+        offsets.append(offsets[-1] + len(section))
+    if len(job.followOnCommands) > 0:
+        command, memory, cpu, depth = job.followOnCommands[-1][:4]
+        priority = getFollowOnPriority(job.followOnCommands[-1])
+    else:
+        memory, cpu, depth, priority = 0, 0, 0, 0
+    flags |= sum([ flag for (flag, value) in zip(_floatFlags, (memory, cpu, priority)) if isinstance(value, float) ])
+    return _recordHeader.pack(_recordMagic, _recordVersion, flags, job.remainingRetryCount, 
+                              len(job.children), len(job.followOnCommands), len(job.messages), 
+                              memory, cpu, depth, priority, job.generation, *offsets) + "".join(sections)
+
+def recordToJob(record, partial=False):
+    """Returns the job stored as the given string. If partial is True the record need only extend 
+    to the end of the messages, as the follow on commands are not read. Instead the job's 
+    follow on commands are just the next follow on, if any, without its command, 
+    (None, memory, cpu, depth[, priority]), which is all the master needs to issue it.
+    """
+    header = _unpackRecordHeader(record)
+    if header == None: #The old format, a marshalled list
+        job = _convertJsonJobToJob(pickler.loads(record))
+    else:
+        (magic, version, flags, remainingRetryCount, childCount, followOnCount, messageCount, 
+         memory, cpu, depth, priority, generation, jobDirOffset, childrenOffset, messagesOffset, followOnsOffset, endOffset) = header
+        job = Job("", 0, 0, 0, None)
+        job.remainingRetryCount = remainingRetryCount
+        job.generation = generation
+        job.jobDir = _loadSection(record[jobDirOffset:childrenOffset], flags & _compressedFlags[0])
+        job.children = _loadSection(record[childrenOffset:messagesOffset], flags & _compressedFlags[1])
+        job.messages = _loadSection(record[messagesOffset:followOnsOffset], flags & _compressedFlags[2])
+        if not partial:
+            job.followOnCommands = _loadSection(record[followOnsOffset:endOffset], flags & _compressedFlags[3])
+            return job
+        memory, cpu, priority = _restoreInts(flags, (memory, cpu, priority))
+        job.followOnCommands = [ (None, memory, cpu, depth) + _getPriorityTuple(priority) ][:followOnCount]
+    if partial:
+        job.followOnCommands = [ (None,) + followOn[1:] for followOn in job.followOnCommands[-1:] ]
+        job.partial = True
+    return job
+
+def recordToJobHeader(jobFile, record):
+    """Returns the header of the job stored as the given string, which need only extend to 
+    the end of the header, unless the record is in the old format.
+    """
+    header = _unpackRecordHeader(record)
+    if header == None:
+        job = recordToJob(record)
+        followOn = (job.followOnCommands + [ (None, 0, 0, 0) ])[0 if len(job.followOnCommands) == 0 else -1]
+        return JobHeader(jobFile, job.remainingRetryCount, len(job.children), len(job.followOnCommands), len(job.messages), 
+                         followOn[1], followOn[2], followOn[3], getFollowOnPriority(followOn), job.generation)
+    memory, cpu, priority = _restoreInts(header[2], (header[7], header[8], header[10]))
+    return JobHeader(jobFile, header[3], header[4], header[5], header[6], memory, cpu, header[9], priority, header[11])
+
+def getRecordHeaderSize():
+    """Returns the size of the header at the start of a record, in bytes.
+    """
+    return _recordHeader.size
+
+def isRecordHeader(record):
+    """Returns True if the given string starts with a record header, rather than being 
+    a record in the old format.
+    """
+    return _unpackRecordHeader(record) != None
+
+def writeNewJob(job):
+    """Writes the job file of a new child in place, rather than atomically. The child's directory 
+    is new and is removed if the update of its parent is interrupted, so the child's file need 
+    not be written and renamed separately.
+    """
+    job.generation += 1
+    fileHandle = open(job.getJobFileName(), 'wb')
+    fileHandle.write(jobToRecord(job))
+    fileHandle.close()
+    return job.getJobFileName()
+
+recordCompressionThreshold = 4096 #The size in bytes above which the sections of records are compressed
+recordBytesSaved = 0 #The bytes saved by compressing the records written by this process
+
+def getRecordBytesSaved():
+    """Returns the number of bytes saved by compressing the records written by this process.
+    """
+    return recordBytesSaved
+
+shardedJobDirPattern = re.compile("[0-9a-f]{32}$")
+
+def getShardedJobDirs(jobsDir, number):
+    """Returns the names of number new job directories in the sharded layout, in which each 
+    job has a directory named by a random id, jobsDir/ab/cd/abcd..., two levels of directories 
+    named by the first characters of the id spreading the jobs evenly. Unlike the nested layout, 
+    in which the directories of children are below those of their parents, the depth of 
+    the directories is fixed, and parents are linked to their children only by their records.
+    """
+    jobDirs = []
+    for i in xrange(number):
+        jobId = uuid.uuid4().hex
+        jobDirs.append(os.path.join(jobsDir, jobId[:2], jobId[2:4], jobId))
+    return jobDirs
+
+def getChildPriority(child):
+    """Returns the priority of a child, (command, memory, cpu[, priority]), the priority
+    only being present if it is not the default, 0.
+    """
+    if len(child) > 3:
+        return child[3]
+    return 0
+
+def getFollowOnPriority(followOn):
+    """Returns the priority of a follow on, (command, memory, cpu, depth[, priority]).
+    """
+    if len(followOn) > 4:
+        return followOn[4]
+    return 0
+
 """Private functions
 """
 
+_recordMagic = "JTJR"
+_recordVersion = 1
+#Magic, version, flags, then the retry count, numbers of children, follow ons and messages, 
+#the memory, cpu, depth and priority of the next follow on, the generation and the offsets of the sections
+_recordHeader = struct.Struct("<4sBBxxiiiiddidIIIIII")
+#Flags marking which of the memory, cpu and priority were floats, rather than ints, when written
+_floatFlags = (1, 2, 4)
+#Flags marking which of the directory, children, messages and follow on commands sections are compressed
+_compressedFlags = (8, 16, 32, 64)
+
+def _unpackRecordHeader(record):
+    """Returns the fields of the header of a record, or None if the record is in the old format.
+    """
+    if record[:4] != _recordMagic or len(record) < _recordHeader.size:
+        return None
+    version = ord(record[4])
+    if version > _recordVersion:
+        raise RuntimeError("The job record has version %i, which is newer than this version of jobTree" % version)
+    return _recordHeader.unpack(record[:_recordHeader.size])
+
+def _loadSection(section, compressed):
+    if compressed:
+        section = zlib.decompress(section)
+    return pickler.loads(section)
+
+def _restoreInts(flags, values):
+    """Converts the given header values back to ints, unless flagged as written as floats.
+    """
+    return [ value if flags & flag else int(value) for (flag, value) in zip(_floatFlags, values) ]
+
+def _getPriorityTuple(priority):
+    if priority == 0:
+        return ()
+    return (priority,)
+
 def _convertJobToJson(job):
     jsonJob = [ job.remainingRetryCount,
                 job.jobDir,
@@ -110,15 +368,38 @@ def _convertJsonJobToJob(jsonJob):
     job.messages = jsonJob[4] 
     return job
         
-def _createTempDirectories(rootDir, number, filesPerDir=4):
+def _makeShardedJobDirs(jobDirs):
+    for jobDir in jobDirs:
+        try:
+            os.mkdir(jobDir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(os.path.split(jobDir)[0]) #The first job in its shard
+            except OSError, e:
+                if e.errno != errno.EEXIST: #Another slave may have made it
+                    raise
+            os.mkdir(jobDir)
+
+def _createTempDirectories(rootDir, number, filesPerDir=4, tempDirs=None):
+    """Makes number directories in a tree below rootDir, each with at most filesPerDir 
+    entries, returning the leaves.
+    """
+    if tempDirs == None:
+        tempDirs = []
     def fn(i):
         dirName = os.path.join(rootDir, "t%i" % i)
         os.mkdir(dirName)
         return dirName
     if number > filesPerDir:
         if number % filesPerDir != 0:
-            return reduce(lambda x,y:x+y, [ _createTempDirectories(fn(i+1), number/filesPerDir, filesPerDir) for i in range(filesPerDir-1) ], _createTempDirectories(fn(0), (number % filesPerDir) + number/filesPerDir, filesPerDir)) 
+            _createTempDirectories(fn(0), (number % filesPerDir) + number/filesPerDir, filesPerDir, tempDirs)
+            for i in xrange(filesPerDir-1):
+                _createTempDirectories(fn(i+1), number/filesPerDir, filesPerDir, tempDirs)
         else:
-            return reduce(lambda x,y:x+y, [ _createTempDirectories(fn(i+1), number/filesPerDir, filesPerDir) for i in range(filesPerDir) ], []) 
+            for i in xrange(filesPerDir):
+                _createTempDirectories(fn(i+1), number/filesPerDir, filesPerDir, tempDirs)
     else:
-        return [ fn(i) for i in xrange(number) ]
+        tempDirs.extend([ fn(i) for i in xrange(number) ])
+    return tempDirs
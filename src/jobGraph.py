@@ -0,0 +1,265 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""The in memory record the master keeps of the dependencies between the jobs it is tracking, 
+and the snapshot and journal which persist it between runs of the master.
+"""
+
+import os
+import time
+import marshal
+from array import array
+
+class JobGraph:
+    """Tracks each job by an integer id, which indexes arrays of parent ids,
+    of the number of children of each job yet to finish, of depths and of the times the 
+    jobs were added. The only per job object kept is the job's file name, which is interned, 
+    so the graph costs tens of bytes per job. Ids of removed jobs are reused.
+    
+    The time from when a job is added to when it is removed is the time taken to run its 
+    subtree, the graph keeps the mean of these times for each depth, to estimate the 
+    critical paths of the jobs remaining.
+    """
+    def __init__(self):
+        self.jobFiles = [] #Id to job file, or None if the id is free
+        self.jobFileToID = {}
+        self.parentIDs = array('i') #Id to id of parent, or -1 if the job has no parent
+        self.childCounts = array('i') #Id to number of children yet to finish
+        self.depths = array('i') #Id to depth of the job in the tree
+        self.addTimes = array('d') #Id to the time the job was added
+        self.subtreeTimes = {} #Depth to the total time taken to run the subtrees of removed jobs at the depth and their number
+        self.freeIDs = []
+        self.parentNumber = 0
+        self.journal = None #If set, the changes made by addChildren and removeJob are appended to it
+    
+    def __len__(self):
+        return len(self.jobFileToID)
+    
+    def hasJob(self, jobFile):
+        return jobFile in self.jobFileToID
+    
+    def addJob(self, jobFile, parentJobFile=None):
+        """Adds a job, as a child of the given parent job if one is given.
+        """
+        jobFile = intern(jobFile)
+        assert jobFile not in self.jobFileToID
+        parentID, depth = -1, 0
+        if parentJobFile != None:
+            parentID = self.jobFileToID[parentJobFile]
+            if self.childCounts[parentID] == 0:
+                self.parentNumber += 1
+            self.childCounts[parentID] += 1
+            depth = self.depths[parentID] + 1
+        if len(self.freeIDs) > 0:
+            jobID = self.freeIDs.pop()
+            self.jobFiles[jobID] = jobFile
+            self.parentIDs[jobID] = parentID
+            self.childCounts[jobID] = 0
+            self.depths[jobID] = depth
+            self.addTimes[jobID] = time.time()
+        else:
+            jobID = len(self.jobFiles)
+            self.jobFiles.append(jobFile)
+            self.parentIDs.append(parentID)
+            self.childCounts.append(0)
+            self.depths.append(depth)
+            self.addTimes.append(time.time())
+        self.jobFileToID[jobFile] = jobID
+        return jobID
+    
+    def addChildren(self, parentJobFile, childJobFiles):
+        """Adds the children of a job, which must currently have no children.
+        """
+        assert self.getChildCount(parentJobFile) == 0
+        for childJobFile in childJobFiles:
+            self.addJob(childJobFile, parentJobFile)
+        if self.journal != None:
+            self.journal.append(("C", parentJobFile, childJobFiles))
+    
+    def removeJob(self, jobFile):
+        """Removes a finished job, which must have no children yet to finish. 
+        Returns the file of the job's parent if the parent has no more children 
+        to finish, else None.
+        """
+        jobID = self.jobFileToID.pop(jobFile)
+        assert self.childCounts[jobID] == 0
+        if self.journal != None:
+            self.journal.append(("D", jobFile))
+        parentID = self.parentIDs[jobID]
+        self.jobFiles[jobID] = None
+        self.freeIDs.append(jobID)
+        subtreeTimes = self.subtreeTimes.setdefault(self.depths[jobID], [ 0.0, 0 ])
+        subtreeTimes[0] += time.time() - self.addTimes[jobID]
+        subtreeTimes[1] += 1
+        if parentID != -1:
+            self.childCounts[parentID] -= 1
+            assert self.childCounts[parentID] >= 0
+            if self.childCounts[parentID] == 0:
+                self.parentNumber -= 1
+                return self.jobFiles[parentID]
+        return None
+    
+    def getParent(self, jobFile):
+        """Returns the file of the job's parent, or None if it has no parent.
+        """
+        parentID = self.parentIDs[self.jobFileToID[jobFile]]
+        if parentID == -1:
+            return None
+        return self.jobFiles[parentID]
+    
+    def getChildCount(self, jobFile):
+        """Returns the number of children of the job yet to finish.
+        """
+        return self.childCounts[self.jobFileToID[jobFile]]
+    
+    def getDepth(self, jobFile):
+        """Returns the depth of the job in the tree, the depth of the first job being 0.
+        """
+        return self.depths[self.jobFileToID[jobFile]]
+    
+    def getEstimatedCriticalPath(self, jobFile):
+        """Returns an estimate of the time remaining to run the subtree of the job, being 
+        the mean time taken by the subtrees of the finished jobs at the same depth less the 
+        time since the job was added, or None if no job at the depth has finished.
+        """
+        jobID = self.jobFileToID[jobFile]
+        if self.depths[jobID] not in self.subtreeTimes:
+            return None
+        totalTime, jobNumber = self.subtreeTimes[self.depths[jobID]]
+        return max(0.0, totalTime / jobNumber - (time.time() - self.addTimes[jobID]))
+    
+    def getDescendants(self, jobFile):
+        """Returns the files of the jobs in the subtree of the job, excluding the job. As only 
+        the parents of jobs are kept this walks up from every job, so takes time linear in the 
+        size of the graph.
+        """
+        inSubtree = { self.jobFileToID[jobFile]:True } #Ids to whether they are in the subtree
+        descendants = []
+        for jobID in self.jobFileToID.itervalues():
+            path = []
+            while jobID != -1 and jobID not in inSubtree:
+                path.append(jobID)
+                jobID = self.parentIDs[jobID]
+            isDescendant = jobID != -1 and inSubtree[jobID]
+            for pathID in path:
+                inSubtree[pathID] = isDescendant
+                if isDescendant:
+                    descendants.append(self.jobFiles[pathID])
+        return descendants
+    
+    def getNumberOfParents(self):
+        """Returns the number of jobs with children yet to finish.
+        """
+        return self.parentNumber
+    
+    def getFrontier(self):
+        """Returns the files of the jobs with no children yet to finish, which are those
+        the master has issued, or has yet to issue.
+        """
+        return [ jobFile for jobFile, jobID in self.jobFileToID.iteritems() if self.childCounts[jobID] == 0 ]
+
+class JobGraphLog:
+    """Persists a job graph as a snapshot, which is replaced atomically, and a journal 
+    of the changes made to the graph since the snapshot was written. Each snapshot has 
+    a generation number, which the journal records in its first entry, so that a 
+    journal is only replayed over the snapshot it follows.
+    
+    The journal is only flushed by flush(), and is not synced, so may lag the graph. 
+    The master therefore verifies the frontier of a loaded graph against the job files.
+    """
+    def __init__(self, snapshotFile, journalFile):
+        self.snapshotFile = snapshotFile
+        self.journalFile = journalFile
+        self.generation = 0
+        self.journalHandle = None
+        self.journalLength = 0
+    
+    def read(self):
+        """Loads the job graph from the snapshot and replays the journal over it. 
+        Returns None if there is no snapshot.
+        """
+        if not os.path.isfile(self.snapshotFile):
+            return None
+        fileHandle = open(self.snapshotFile, 'rb')
+        self.generation, jobFiles, parentIDs, childCounts, depths, addTimes, subtreeTimes, freeIDs = marshal.load(fileHandle)
+        fileHandle.close()
+        jobGraph = JobGraph()
+        jobGraph.jobFiles = [ jobFile if jobFile == None else intern(jobFile) for jobFile in jobFiles ]
+        jobGraph.parentIDs.fromstring(parentIDs)
+        jobGraph.childCounts.fromstring(childCounts)
+        jobGraph.depths.fromstring(depths)
+        jobGraph.addTimes.fromstring(addTimes)
+        jobGraph.subtreeTimes = subtreeTimes
+        jobGraph.freeIDs = freeIDs
+        for jobID, jobFile in enumerate(jobGraph.jobFiles):
+            if jobFile != None:
+                jobGraph.jobFileToID[jobFile] = jobID
+                if jobGraph.childCounts[jobID] > 0:
+                    jobGraph.parentNumber += 1
+        if os.path.isfile(self.journalFile):
+            fileHandle = open(self.journalFile, 'rb')
+            try:
+                if marshal.load(fileHandle) == self.generation: #Else the journal precedes the snapshot
+                    while True:
+                        entry = marshal.load(fileHandle)
+                        if entry[0] == "C":
+                            jobGraph.addChildren(entry[1], entry[2])
+                        else:
+                            assert entry[0] == "D"
+                            jobGraph.removeJob(entry[1])
+            except (EOFError, ValueError, TypeError): #The end of the journal, which may have been partly written
+                pass
+            fileHandle.close()
+        return jobGraph
+    
+    def write(self, jobGraph):
+        """Writes a new snapshot of the job graph and starts a new journal of its changes.
+        """
+        self.close()
+        self.generation += 1
+        fileHandle = open(self.snapshotFile + ".new", 'wb')
+        marshal.dump((self.generation, jobGraph.jobFiles, jobGraph.parentIDs.tostring(), 
+                      jobGraph.childCounts.tostring(), jobGraph.depths.tostring(), jobGraph.addTimes.tostring(),
+                      jobGraph.subtreeTimes, jobGraph.freeIDs), fileHandle)
+        fileHandle.flush()
+        os.fsync(fileHandle.fileno())
+        fileHandle.close()
+        os.rename(self.snapshotFile + ".new", self.snapshotFile) #The old journal is ignored from here as its generation is out of date
+        fileHandle = open(self.journalFile + ".new", 'wb')
+        marshal.dump(self.generation, fileHandle)
+        fileHandle.close()
+        os.rename(self.journalFile + ".new", self.journalFile)
+        self.journalHandle = open(self.journalFile, 'ab')
+        self.journalLength = 0
+        jobGraph.journal = self
+    
+    def append(self, entry):
+        marshal.dump(entry, self.journalHandle)
+        self.journalLength += 1
+    
+    def flush(self):
+        """Writes the buffered journal entries to the journal file.
+        """
+        self.journalHandle.flush()
+    
+    def close(self):
+        if self.journalHandle != None:
+            self.journalHandle.close()
+            self.journalHandle = None
@@ -0,0 +1,537 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""The job stores, which keep the records of the jobs of a jobTree. Jobs are named 
+by the paths of their job files, within the directories of the jobs tree, whichever
+store keeps their records.
+"""
+
+import os
+import re
+import threading
+import sqlite3
+import struct
+import zlib
+import marshal
+from collections import OrderedDict
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from jobTree.src.job import Job, getJobFileName, jobToRecord, recordToJob, recordToJobHeader, deleteJobDir, writeNewJob
+from jobTree.src.job import getRecordHeaderSize, isRecordHeader
+from sonLib.bioio import logger
+from jobTree.src.deleter import deleter
+
+def getJobFileDirName(jobTreePath):
+    return os.path.join(jobTreePath, "jobs")
+
+def getJobStoreFileName(jobTreePath):
+    return os.path.join(jobTreePath, "jobStore.sqlite")
+
+def getJobJournalFileName(jobDir):
+    return os.path.join(jobDir, "journal")
+
+def isShardedLayout(config):
+    """Returns True if the jobs' directories are in the sharded layout, see job.getShardedJobDirs, 
+    else they are in the nested layout, the directories of children below those of their parents.
+    """
+    jobLayout = config.attrib.get("job_layout", "nested")
+    if jobLayout not in ("nested", "sharded"):
+        raise RuntimeError("Unrecognised job layout: %s" % jobLayout)
+    return jobLayout == "sharded"
+
+def listDir(dirName):
+    """Lists the names of the files in a directory, using scandir if it is available, 
+    which avoids sorting and copying the listing on some platforms.
+    """
+    if scandir != None:
+        return [ entry.name for entry in scandir(dirName) ]
+    return os.listdir(dirName)
+
+childDirPattern = re.compile("t[0-9]+$")
+
+def listChildDirs(jobDir):
+    """Directories of child jobs for given job (not recursive).
+    """
+    return [ os.path.join(jobDir, f) for f in listDir(jobDir) if childDirPattern.match(f) ]
+
+def loadJobStore(config):
+    """Returns the job store chosen by the config.
+    """
+    jobStoreName = config.attrib.get("job_store", "file")
+    if jobStoreName == "file":
+        return FileJobStore(config)
+    elif jobStoreName == "sqlite":
+        return SQLiteJobStore(config)
+    elif jobStoreName == "journal":
+        return JournalJobStore(config)
+    raise RuntimeError("Unrecognised job store: %s" % jobStoreName)
+
+class AbstractJobStore:
+    """An abstract (as far as python currently allows) base class
+    to represent the interface the job stores must provide to the master, the slaves 
+    and jobTreeStatus. Each change to a job's record must be atomic.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.shardedJobsDir = None #The directory the jobs are sharded in, if in the sharded layout
+        if isShardedLayout(config):
+            self.shardedJobsDir = getJobFileDirName(config.attrib["job_tree"])
+    
+    def read(self, jobFile, partial=False):
+        """Loads a job. If partial is True the job's follow on commands are not loaded, 
+        see job.recordToJob, and the job can not be written back.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def readHeader(self, jobFile):
+        """Loads just the header of a job's record, see job.JobHeader.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def write(self, job):
+        """Updates a job's record atomically, returning its job file.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def update(self, job, depth, tryCount):
+        """Creates the child jobs of a job and updates the job's record with its new 
+        children, atomically.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def delete(self, job):
+        """Removes a job's record atomically, and then its directory.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def exists(self, jobFile, fileNames=None):
+        """Returns True if there is a record of the job. fileNames, if given, are the names 
+        of the files in the job's directory, which some stores can use to avoid accessing the disk.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def recover(self, jobFile, fileNames=None):
+        """Reverts or completes a change to a job's record that was interrupted by a crash, 
+        removing any children that were partly made. Returns True if there was such a change. 
+        fileNames is as for exists.
+        """
+        raise RuntimeError("Abstract method")
+    
+    def compact(self, jobFile, fileNames=None):
+        """Folds any changes kept apart from a job's record into it, which the master does 
+        when restarting, once the job has been recovered and no slave is running. fileNames 
+        is as for exists.
+        """
+        pass
+    
+    def close(self):
+        """Releases any resources held by the job store.
+        """
+        pass
+
+class FileJobStore(AbstractJobStore):
+    """Keeps each job's record in its job file, which is replaced atomically by 
+    renaming a .new file over it, an .updating file marking an update in progress.
+    """
+    def read(self, jobFile, partial=False):
+        return Job.read(jobFile, partial)
+    
+    def readHeader(self, jobFile):
+        return Job.readHeader(jobFile)
+    
+    def write(self, job):
+        return job.write()
+    
+    def update(self, job, depth, tryCount):
+        job.update(depth, tryCount, self.shardedJobsDir)
+    
+    def delete(self, job):
+        job.delete()
+    
+    def _hasFile(self, fileName, fileNames):
+        if fileNames == None:
+            return os.path.isfile(fileName)
+        return os.path.split(fileName)[1] in fileNames
+    
+    def exists(self, jobFile, fileNames=None):
+        return self._hasFile(jobFile, fileNames)
+    
+    def recover(self, jobFile, fileNames=None):
+        if self._hasFile(jobFile + ".updating", fileNames):
+            logger.critical("There was an .updating file for job: %s" % jobFile)
+            if os.path.isfile(jobFile + ".new"): #The job failed while writing the updated job file.
+                logger.critical("There was a .new file for the job: %s" % jobFile)
+                os.remove(jobFile + ".new") #The existance of the .updating file means it wasn't complete
+            fileHandle = open(jobFile + ".updating", 'r')
+            shardedChildDirs = [ line.strip() for line in fileHandle if line.strip() != "" ] #The children made in the sharded layout are listed
+            fileHandle.close()
+            for f in listChildDirs(os.path.split(jobFile)[0]) + shardedChildDirs:
+                logger.critical("Removing broken child %s\n" % f)
+                deleter.delete(f)
+            assert os.path.isfile(jobFile)
+            os.remove(jobFile + ".updating") #Delete second the updating file second to preserve a correct state
+            logger.critical("We've reverted to the original job file: %s" % jobFile)
+            return True
+        if self._hasFile(jobFile + ".new", fileNames): #The job was not properly updated before crashing
+            logger.critical("There was a .new file for the job and no .updating file %s" % jobFile)
+            if os.path.isfile(jobFile):
+                os.remove(jobFile)
+            os.rename(jobFile + ".new", jobFile)
+            return True
+        return False
+
+class JournalJobStore(FileJobStore):
+    """Records each change to a job as a frame appended to a journal in the job's directory, 
+    rather than replacing its job file. A slave works on one job, so it appends to one journal, 
+    whose handle it keeps open, and syncs it to disk just once, when closing the store. 
+    
+    The journal is the job's record while the jobTree runs, the master appending to it too, 
+    so finishing a job costs the master no more than reading its journal. It is folded into the 
+    job file by compact(), when restarting, and is otherwise removed with the job's directory.
+    Each frame holds its length and checksum, so a frame torn by a crash is found and cut off.
+    The children made by an update are written in place, after a frame listing their directories,
+    so if the frame committing the update is missing the children are removed.
+    """
+    def __init__(self, config):
+        FileJobStore.__init__(self, config)
+        self.journalFile = None #The journal open for appending, and its handle
+        self.fileHandle = None
+    
+    def _append(self, jobFile, frames):
+        journalFile = getJobJournalFileName(os.path.split(jobFile)[0])
+        if journalFile != self.journalFile:
+            self._closeJournal(sync=False) #The master may write to many journals, which are left to the OS to sync
+            self.fileHandle = os.open(journalFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            self.journalFile = journalFile
+        os.write(self.fileHandle, "".join([ _packJournalFrame(frame) for frame in frames ])) #One write, so the frames are appended together
+    
+    def _closeJournal(self, sync=True):
+        if self.fileHandle != None:
+            if sync:
+                os.fsync(self.fileHandle) #The group commit of all the frames appended to the journal
+            os.close(self.fileHandle)
+            self.journalFile, self.fileHandle = None, None
+    
+    def _readRecord(self, jobFile):
+        """Returns the last record of the job in its journal, None if it has no journal, 
+        or raises an IOError if the journal records its deletion.
+        """
+        frames = _readJournalFrames(getJobJournalFileName(os.path.split(jobFile)[0]))[0]
+        record = None
+        for frame in frames:
+            if frame[0] == "delete":
+                raise IOError("The job has been deleted: %s" % jobFile)
+            if frame[0] in ("write", "update"):
+                record = frame[1]
+        return record
+    
+    def read(self, jobFile, partial=False):
+        record = self._readRecord(jobFile)
+        if record == None:
+            return FileJobStore.read(self, jobFile, partial)
+        return recordToJob(record, partial)
+    
+    def readHeader(self, jobFile):
+        record = self._readRecord(jobFile)
+        if record == None:
+            return FileJobStore.readHeader(self, jobFile)
+        return recordToJobHeader(jobFile, record)
+    
+    def write(self, job):
+        assert not job.partial
+        job.generation += 1
+        self._append(job.getJobFileName(), [ ("write", jobToRecord(job)) ])
+        return job.getJobFileName()
+    
+    def update(self, job, depth, tryCount):
+        childDirs = job.getChildDirs(self.shardedJobsDir)
+        if len(job.children) > 1: #None for the nested layout, whose children are found in the job's directory
+            self._append(job.getJobFileName(), [ ("begin", childDirs) ])
+        job.makeChildren(depth, tryCount, writeNewJob, childDirs)
+        job.generation += 1
+        self._append(job.getJobFileName(), [ ("update", jobToRecord(job)) ])
+    
+    def delete(self, job):
+        jobFile = job.getJobFileName()
+        self._append(jobFile, [ ("delete",) ]) #So the job is deleted even if the store crashes below
+        self._closeJournal(sync=False) #The journal is removed with the job's directory
+        if os.path.isfile(jobFile):
+            os.remove(jobFile)
+        deleteJobDir(job.jobDir)
+    
+    def exists(self, jobFile, fileNames=None):
+        journalFile = getJobJournalFileName(os.path.split(jobFile)[0])
+        if self._hasFile(journalFile, fileNames):
+            try:
+                self._readRecord(jobFile)
+            except IOError:
+                return False
+            return True
+        return FileJobStore.exists(self, jobFile, fileNames)
+    
+    def recover(self, jobFile, fileNames=None):
+        """Removes the children of an interrupted update, cutting its frames and any torn 
+        frame off the end of the job's journal, so later frames are appended after the last 
+        good one. Returns True if a change was interrupted.
+        """
+        recovered = FileJobStore.recover(self, jobFile, fileNames)
+        journalFile = getJobJournalFileName(os.path.split(jobFile)[0])
+        if not self._hasFile(journalFile, fileNames):
+            return recovered
+        if journalFile == self.journalFile:
+            self._closeJournal(sync=False)
+        frames, offsets, torn = _readJournalFrames(journalFile)
+        childDirs, deleted = False, False #childDirs is False if there is no interrupted update
+        length = offsets[-1] #The length of the journal once recovered
+        for frame, offset in zip(frames, offsets):
+            if frame[0] == "begin":
+                childDirs, length = frame[1], offset
+            elif frame[0] in ("write", "update"):
+                childDirs, length = False, offsets[-1]
+            else:
+                deleted = True
+        if deleted: #The deletion of the job was interrupted
+            if os.path.isfile(jobFile):
+                os.remove(jobFile)
+            deleteJobDir(os.path.split(jobFile)[0])
+            return True
+        if torn:
+            logger.critical("The journal of the job %s ends with a torn frame" % jobFile)
+        if childDirs != False:
+            logger.critical("The journal of the job %s has an interrupted update" % jobFile)
+            for childDir in (listChildDirs(os.path.split(jobFile)[0]) if childDirs == None else childDirs):
+                logger.critical("Removing broken child %s\n" % childDir)
+                deleter.delete(childDir)
+        if torn or childDirs != False:
+            fileHandle = open(journalFile, 'r+b')
+            fileHandle.truncate(length)
+            fileHandle.close()
+            return True
+        return recovered
+    
+    def compact(self, jobFile, fileNames=None):
+        """Folds the job's journal into its job file.
+        """
+        journalFile = getJobJournalFileName(os.path.split(jobFile)[0])
+        if not self._hasFile(journalFile, fileNames):
+            return
+        if journalFile == self.journalFile:
+            self._closeJournal(sync=False)
+        record = self._readRecord(jobFile)
+        if record != None:
+            FileJobStore.write(self, recordToJob(record))
+        os.remove(journalFile)
+    
+    def close(self):
+        self._closeJournal()
+
+class SQLiteJobStore(AbstractJobStore):
+    """Keeps the records of all the jobs in a single SQLite database in the jobTree directory, 
+    indexed by job file, so a change to a job's record is a transaction on one file rather 
+    than the creation, renaming and removal of several files. The directories of the jobs are 
+    still made, for their temporary files and logs.
+    
+    The database uses write ahead logging, so the master reads while the slaves write. 
+    This relies on shared memory, so all the processes of the jobTree must run on one machine, 
+    which jobTreeRun enforces. Each record is kept with the job file of the job's parent, if it 
+    was made as a child, so an update can remove any records left by the job's old children.
+    """
+    def __init__(self, config):
+        AbstractJobStore.__init__(self, config)
+        self.databaseFile = getJobStoreFileName(config.attrib["job_tree"])
+        self.local = threading.local() #Each thread has its own connection, as connections can not be shared by threads
+        self.connections = []
+        connection = self._getConnection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (jobFile TEXT PRIMARY KEY, record BLOB, parentJobFile TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobsByParent ON jobs (parentJobFile)")
+    
+    def _getConnection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection == None:
+            connection = sqlite3.connect(self.databaseFile, timeout=600, check_same_thread=False) #Slaves wait for each other's transactions, and close() may be called from any thread
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL") #Committed transactions survive a crash of the process, and are synced at checkpoints
+            self.local.connection = connection
+            self.connections.append(connection)
+        return connection
+    
+    def read(self, jobFile, partial=False):
+        return recordToJob(self._readRecord(jobFile, "record"), partial)
+    
+    def readHeader(self, jobFile):
+        record = self._readRecord(jobFile, "substr(record, 1, %i)" % getRecordHeaderSize())
+        if isRecordHeader(record):
+            return recordToJobHeader(jobFile, record)
+        return recordToJobHeader(jobFile, self._readRecord(jobFile, "record")) #A record in the old format, which has no header
+    
+    def _readRecord(self, jobFile, column):
+        row = self._getConnection().execute("SELECT %s FROM jobs WHERE jobFile = ?" % column, (jobFile,)).fetchone()
+        if row == None:
+            raise IOError("There is no record of the job: %s" % jobFile)
+        return str(row[0])
+    
+    def _write(self, connection, job, parentJobFile=None):
+        """Writes the record of a job, with the job file of its parent if it is a new child, 
+        else keeping that of any existing record.
+        """
+        job.generation += 1
+        if parentJobFile == None:
+            connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, (SELECT parentJobFile FROM jobs WHERE jobFile = ?))", 
+                               (job.getJobFileName(), buffer(jobToRecord(job)), job.getJobFileName()))
+        else:
+            connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (job.getJobFileName(), buffer(jobToRecord(job)), parentJobFile))
+        return job.getJobFileName()
+    
+    def write(self, job):
+        connection = self._getConnection()
+        with connection:
+            return self._write(connection, job)
+    
+    def update(self, job, depth, tryCount):
+        connection = self._getConnection()
+        with connection:
+            #Removes the records of any old children, and their descendants, left by the lazy removal of their directories, whose paths are reused
+            connection.execute("WITH RECURSIVE oldJobs(jobFile) AS (SELECT jobFile FROM jobs WHERE parentJobFile = ? "
+                               "UNION SELECT jobs.jobFile FROM jobs, oldJobs WHERE jobs.parentJobFile = oldJobs.jobFile) "
+                               "DELETE FROM jobs WHERE jobFile IN oldJobs", (job.getJobFileName(),))
+            job.makeChildren(depth, tryCount, lambda childJob : self._write(connection, childJob, job.getJobFileName()), 
+                             job.getChildDirs(self.shardedJobsDir))
+            self._write(connection, job)
+    
+    def delete(self, job):
+        connection = self._getConnection()
+        with connection:
+            connection.execute("DELETE FROM jobs WHERE jobFile = ?", (job.getJobFileName(),))
+        deleteJobDir(job.jobDir)
+    
+    def exists(self, jobFile, fileNames=None):
+        return self._getConnection().execute("SELECT 1 FROM jobs WHERE jobFile = ?", (jobFile,)).fetchone() != None
+    
+    def recover(self, jobFile, fileNames=None):
+        return False #Changes are transactions, so are never left part made
+    
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.local = threading.local()
+
+def _packJournalFrame(frame):
+    payload = marshal.dumps(frame)
+    return _journalFrameHeader.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _readJournalFrames(journalFile):
+    """Returns the frames of a journal, or no frames if there is no journal, the offsets 
+    at which they start followed by that at which the last ends, and True if the journal 
+    ends with a torn frame, which is ignored.
+    """
+    try:
+        fileHandle = open(journalFile, 'rb')
+    except IOError:
+        return [], [ 0 ], False
+    journal = fileHandle.read()
+    fileHandle.close()
+    frames, offsets = [], [ 0 ]
+    while offsets[-1] + _journalFrameHeader.size <= len(journal):
+        offset = offsets[-1]
+        length, checksum = _journalFrameHeader.unpack(journal[offset:offset + _journalFrameHeader.size])
+        payload = journal[offset + _journalFrameHeader.size:offset + _journalFrameHeader.size + length]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+            break
+        frames.append(marshal.loads(payload))
+        offsets.append(offset + _journalFrameHeader.size + length)
+    return frames, offsets, offsets[-1] != len(journal)
+
+_journalFrameHeader = struct.Struct("<II") #The length and checksum of a frame
+
+class CachingJobStore(AbstractJobStore):
+    """Wraps a job store, keeping the jobs most recently read or written through it in memory.
+    A cached job is only used if the generation in the header of its record, which is increased
+    each time the record is written, is unchanged, so the master does not parse jobs again that the 
+    slaves have not changed, such as parents whose children have finished and jobs being retried.
+    Jobs are copied in and out of the cache, as the master changes the jobs it reads.
+    """
+    def __init__(self, jobStore, size):
+        AbstractJobStore.__init__(self, jobStore.config)
+        self.jobStore = jobStore
+        self.size = size
+        self.jobs = OrderedDict() #Job files to jobs, least recently used first
+        self.hits = 0
+        self.misses = 0
+    
+    def _cache(self, jobFile, job):
+        self.jobs[jobFile] = job
+        if len(self.jobs) > self.size:
+            self.jobs.popitem(last=False)
+    
+    def read(self, jobFile, partial=False):
+        job = self.jobs.pop(jobFile, None)
+        if job != None and (partial or not job.partial) and self.jobStore.readHeader(jobFile).generation == job.generation:
+            self.hits += 1
+        else:
+            self.misses += 1
+            job = self.jobStore.read(jobFile, partial)
+        self._cache(jobFile, job)
+        return job.copy()
+    
+    def readHeader(self, jobFile):
+        return self.jobStore.readHeader(jobFile)
+    
+    def write(self, job):
+        jobFile = self.jobStore.write(job)
+        self.jobs.pop(jobFile, None)
+        self._cache(jobFile, job.copy())
+        return jobFile
+    
+    def update(self, job, depth, tryCount):
+        self.jobs.pop(job.getJobFileName(), None)
+        self.jobStore.update(job, depth, tryCount)
+    
+    def delete(self, job):
+        self.jobs.pop(job.getJobFileName(), None)
+        self.jobStore.delete(job)
+    
+    def exists(self, jobFile, fileNames=None):
+        if self.jobStore.exists(jobFile, fileNames):
+            return True
+        self.jobs.pop(jobFile, None) #A new job may be made with the same job file
+        return False
+    
+    def recover(self, jobFile, fileNames=None):
+        if self.jobStore.recover(jobFile, fileNames):
+            self.jobs.pop(jobFile, None)
+            return True
+        return False
+    
+    def compact(self, jobFile, fileNames=None):
+        self.jobs.pop(jobFile, None)
+        self.jobStore.compact(jobFile, fileNames)
+    
+    def close(self):
+        self.jobs.clear()
+        self.jobStore.close()
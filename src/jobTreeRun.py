@@ -35,11 +35,14 @@ from jobTree.batchSystems.gridengine import GridengineBatchSystem
 from jobTree.batchSystems.singleMachine import SingleMachineBatchSystem, badWorker
 from jobTree.batchSystems.combinedBatchSystem import CombinedBatchSystem
 from jobTree.batchSystems.lsf import LSFBatchSystem
+from jobTree.batchSystems.warmSlave import WarmSlaveBatchSystem, defaultWarmSlaveIdleTimeout
 
 from jobTree.src.job import Job
+from jobTree.src.jobStore import loadJobStore
 
 from jobTree.src.master import mainLoop
 from jobTree.src.master import getEnvironmentFileName, getStatsFileName, getConfigFileName, getJobFileDirName
+from jobTree.src.master import defaultRestartThreads, defaultJobCacheSize, defaultGarbageCollectionRate
 
 from sonLib.bioio import logger, setLoggingFromOptions, addLoggingOptions, getLogLevelString
 from sonLib.bioio import TempFileTree
@@ -69,6 +72,15 @@ def _addOptions(addGroupFn, defaultStr):
                             "job tree, then try and restart the jobs in it. The default=%s" % defaultStr))
     addOptionFn("--stats", dest="stats", action="store_true", default=False,
                       help="Records statistics about the job-tree to be used by jobTreeStats. default=%s" % defaultStr)
+    addOptionFn("--jobStore", dest="jobStore", default="file",
+                      help=("Where the records of the jobs are kept, currently can be 'file', a file per job, 'journal', a file per job "
+                            "with the changes to it appended to a journal beside it, which is folded into the file on restarting, or 'sqlite', "
+                            "a single database in the jobTree directory, which needs far fewer file system operations "
+                            "but can only be used with the singleMachine batch system. default=%s" % defaultStr))
+    addOptionFn("--jobLayout", dest="jobLayout", default="nested",
+                      help=("The layout of the jobs' directories, either 'nested', each child's directory below its parent's, or 'sharded', "
+                            "each job's directory at a fixed depth, in directories named by the first characters of a random id, "
+                            "which suits wide trees. default=%s" % defaultStr))
     
     addOptionFn = addGroupFn("jobTree options for specifying the batch system", "Allows the specification of the batch system, and arguments to the batch system/big batch system (see below).")
     addOptionFn("--batchSystem", dest="batchSystem", default="singleMachine", #detectQueueSystem(),
@@ -79,6 +91,11 @@ def _addOptions(addGroupFn, defaultStr):
                             "machine mode. Increasing this will allow more jobs to run concurrently when running on a single machine. default=%s" % defaultStr))
     addOptionFn("--parasolCommand", dest="parasolCommand", default="parasol",
                       help="The command to run the parasol program default=%s" % defaultStr)
+    addOptionFn("--warmSlaves", dest="warmSlaves", action="store_true", default=False,
+                      help=("Run the jobs with long lived slaves, issued to the batch system, which each run many jobs one after another, "
+                            "rather than starting a slave process for each job. Suits many short jobs. default=%s" % defaultStr))
+    addOptionFn("--warmSlaveIdleTimeout", dest="warmSlaveIdleTimeout", default=defaultWarmSlaveIdleTimeout,
+                      help=("The number of seconds a warm slave waits for a job to run before exiting. default=%s" % defaultStr))
     
     addOptionFn = addGroupFn("jobTree options for cpu/memory requirements", "The options to specify default cpu/memory requirements (if not specified by the jobs themselves), and to limit the total amount of memory/cpu requested from the batch system.")
     addOptionFn("--defaultMemory", dest="defaultMemory", default=2147483648,
@@ -91,6 +108,9 @@ def _addOptions(addGroupFn, defaultStr):
                             "one time. default=%s" % defaultStr))
     addOptionFn("--maxMemory", dest="maxMemory", default=sys.maxint,
                       help=("The maximum amount of memory to request from the batch system at any one time. default=%s" % defaultStr))
+    addOptionFn("--enforceMemory", dest="enforceMemory", action="store_true", default=False,
+                      help=("Kill a job whose processes use more memory, in total, than it requested, and retry it "
+                            "with twice the memory. default=%s" % defaultStr))
     
     addOptionFn = addGroupFn("jobTree options for rescuing/killing/restarting jobs", "The options for jobs that either run too long/fail or get lost (some batch systems have issues!)")
     addOptionFn("--retryCount", dest="retryCount", default=0,
@@ -103,6 +123,22 @@ def _addOptions(addGroupFn, defaultStr):
     addOptionFn("--rescueJobsFrequency", dest="rescueJobsFrequency", 
                       help=("Period of time to wait (in seconds) between checking for "
                             "missing/overlong jobs, that is jobs which get lost by the batch system. Expert parameter. (default is set by the batch system)"))
+    addOptionFn("--failFast", dest="failFast", action="store_true", default=False,
+                      help=("When a job fails with no retries left, kill and cancel the other jobs in the subtree of its parent, "
+                            "whose follow on can no longer run, rather than leaving them to run. default=%s" % defaultStr))
+    addOptionFn("--backgroundDeletion", dest="backgroundDeletion", action="store_true", default=False,
+                      help=("Delete the directories of finished jobs on a background thread in the master and slaves, after first "
+                            "moving them to a trash directory in the jobTree, rather than waiting for each deletion. default=%s" % defaultStr))
+    addOptionFn("--restartThreads", dest="restartThreads", default=defaultRestartThreads,
+                      help=("The number of threads used to scan the jobs directory when restarting the jobTree. "
+                            "Increase this if the jobTree is on a high latency networked file system. default=%s" % defaultStr))
+    addOptionFn("--jobCacheSize", dest="jobCacheSize", default=defaultJobCacheSize,
+                      help=("The number of jobs the master keeps parsed in memory, which it uses again if their records "
+                            "have not been written since. default=%s" % defaultStr))
+    addOptionFn("--garbageCollectionRate", dest="garbageCollectionRate", default=defaultGarbageCollectionRate,
+                      help=("The max number of paths a second the master removes of those left behind by the jobs, being the "
+                            "directories of finished jobs, the global temp directories of jobs waiting for their children and "
+                            "abandoned stats and trash files. 0 turns the garbage collection off. default=%s" % defaultStr))
     
     addOptionFn = addGroupFn("jobTree big batch system options", "jobTree can employ a secondary batch system for running large memory/cpu jobs using the following arguments:")
     addOptionFn("--bigBatchSystem", dest="bigBatchSystem", default=None, #detectQueueSystem(),
@@ -126,6 +162,11 @@ def _addOptions(addGroupFn, defaultStr):
                             "This parameter allows one to avoid over parallelizing tiny jobs, and "
                             "therefore paying significant scheduling overhead, by running tiny "
                             "jobs in series on a single node/core of the cluster. default=%s" % defaultStr))
+    addOptionFn("--inlineChildren", dest="inlineChildren", action="store_true", default=False,
+                      help=("Run the children of a target within the slave when their declared or previously observed "
+                            "run times fit within the remainder of the jobTime, rather than issuing them as separate jobs. "
+                            "The children of a job with more than one cpu that fit in its memory and cpus, together, are "
+                            "always run concurrently within its slave. default=%s" % defaultStr))
     addOptionFn("--maxLogFileSize", dest="maxLogFileSize", default=50120,
                       help=("The maximum size of a job log file to keep (in bytes), log files larger "
                             "than this will be truncated to the last X bytes. Default is 50 "
@@ -152,6 +193,16 @@ def addOptions(parser):
         raise RuntimeError("Unanticipated class passed to addOptions(), %s. Expecting " 
                            "Either optparse.OptionParser or argparse.ArgumentParser" % parser.__class__)
 
+singleMachineBatchSystems = ("single_machine", "singleMachine", "acid_test", "acidTest") #The batch systems running jobs on this machine
+
+def checkJobStore(config):
+    """Raises a RuntimeError if the job store chosen by the config can not be used with its batch systems.
+    """
+    if config.attrib["job_store"] == "sqlite":
+        for batchSystemString in (config.attrib["batch_system"], config.attrib.get("big_batch_system")):
+            if batchSystemString != None and batchSystemString not in singleMachineBatchSystems:
+                raise RuntimeError("The sqlite job store can only be used with the single machine batch system, not: %s" % batchSystemString)
+
 def loadTheBatchSystem(config):
     """Load the batch system.
     """
@@ -183,23 +234,31 @@ def loadTheBatchSystem(config):
         bigMaxMemory = int(config.attrib["big_max_memory"])
         bigBatchSystem = batchSystemConstructionFn(config.attrib["big_batch_system"], maxCpus=bigMaxCpus, maxMemory=bigMaxMemory)
         batchSystem = CombinedBatchSystem(config, batchSystem, bigBatchSystem, lambda command, memory, cpu : memory <= bigMemoryThreshold and cpu <= bigCpuThreshold)
+    if "warm_slave_idle_timeout" in config.attrib:
+        if len(set((config.attrib["batch_system"], config.attrib.get("big_batch_system"))) & set(singleMachineBatchSystems)) > 0:
+            logger.info("Not using warm slaves, as the single machine batch system already runs the jobs in long lived processes")
+        else:
+            batchSystem = WarmSlaveBatchSystem(config, batchSystem, float(config.attrib["warm_slave_idle_timeout"]))
+            logger.info("Using warm slaves, which run many jobs each")
     return batchSystem
 
 def loadEnvironment(config):
     """Puts the environment in the pickle file.
     """
     #Dump out the environment of this process in the environment pickle file.
-    fileHandle = open(getEnvironmentFileName(config.attrib["job_tree"]), 'w')
+    fileHandle = open(getEnvironmentFileName(config.attrib["job_tree"]) + ".new", 'w')
     cPickle.dump(os.environ, fileHandle)
     fileHandle.close()
+    os.rename(getEnvironmentFileName(config.attrib["job_tree"]) + ".new", getEnvironmentFileName(config.attrib["job_tree"])) #Replaced, so the slaves' cached copies are invalidated, see loadSettings
     logger.info("Written the environment for the jobs to the environment file")
 
 def writeConfig(config):
     #Write the config file to disk
-    fileHandle = open(getConfigFileName(config.attrib["job_tree"]), 'w')
+    fileHandle = open(getConfigFileName(config.attrib["job_tree"]) + ".new", 'w')
     tree = ET.ElementTree(config)
     tree.write(fileHandle)
     fileHandle.close()
+    os.rename(getConfigFileName(config.attrib["job_tree"]) + ".new", getConfigFileName(config.attrib["job_tree"])) #Replaced, so the slaves' cached copies are invalidated, see loadSettings
     logger.info("Written the config file")
 
 def reloadJobTree(jobTree):
@@ -221,8 +280,6 @@ def reloadJobTree(jobTree):
 def createJobTree(options):
     logger.info("Starting to create the job tree setup for the first time")
     options.jobTree = absSymPath(options.jobTree)
-    os.mkdir(options.jobTree)
-    os.mkdir(getJobFileDirName(options.jobTree))
     config = ET.Element("config")
     config.attrib["log_level"] = getLogLevelString()
     config.attrib["job_tree"] = options.jobTree
@@ -237,6 +294,11 @@ def createJobTree(options):
     config.attrib["max_cpus"] = str(int(options.maxCpus))
     config.attrib["max_memory"] = str(int(options.maxMemory))
     config.attrib["max_threads"] = str(int(options.maxThreads))
+    config.attrib["restart_threads"] = str(int(options.restartThreads))
+    config.attrib["job_cache_size"] = str(int(options.jobCacheSize))
+    config.attrib["garbage_collection_rate"] = str(float(options.garbageCollectionRate))
+    config.attrib["job_store"] = options.jobStore
+    config.attrib["job_layout"] = options.jobLayout
     if options.bigBatchSystem != None:
         config.attrib["big_batch_system"] = options.bigBatchSystem
         config.attrib["big_memory_threshold"] = str(int(options.bigMemoryThreshold))
@@ -246,6 +308,19 @@ def createJobTree(options):
         
     if options.stats:
         config.attrib["stats"] = ""
+    if options.failFast:
+        config.attrib["fail_fast"] = ""
+    if options.backgroundDeletion:
+        config.attrib["background_deletion"] = ""
+    if options.inlineChildren:
+        config.attrib["inline_children"] = ""
+    if options.enforceMemory:
+        config.attrib["enforce_memory"] = ""
+    if options.warmSlaves:
+        config.attrib["warm_slave_idle_timeout"] = str(float(options.warmSlaveIdleTimeout))
+    checkJobStore(config) #Before the jobTree is made
+    os.mkdir(options.jobTree)
+    os.mkdir(getJobFileDirName(options.jobTree))
     #Load the batch system.
     batchSystem = loadTheBatchSystem(config)
     
@@ -269,7 +344,9 @@ def createFirstJob(command, config, memory=None, cpu=None, time=sys.maxint):
         cpu = float(config.attrib["default_cpu"])
     job = Job(command=command, memory=memory, cpu=cpu, 
               tryCount=int(config.attrib["try_count"]), jobDir=getJobFileDirName(config.attrib["job_tree"]))
-    job.write()
+    jobStore = loadJobStore(config)
+    jobStore.write(job)
+    jobStore.close()
     logger.info("Added the first job")
     
 def runJobTreeScript(options):
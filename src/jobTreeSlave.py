@@ -30,6 +30,10 @@ import traceback
 import time
 import socket
 import logging
+import tempfile
+import hashlib
+import errno
+import stat
 
 def truncateFile(fileNameString, tooBig=50000):
     """Truncates a file that is bigger than tooBig bytes, leaving only the 
@@ -44,17 +48,31 @@ def truncateFile(fileNameString, tooBig=50000):
         fh.truncate()
         fh.close()
         
+_targetClasses = {} #The classes of the targets imported by this process, which may run many slaves, by their import strings
+
+def importTargetClasses(importStrings):
+    """Imports the classes of targets, given as module.className strings, once per process.
+    """
+    for importString in importStrings:
+        if importString not in _targetClasses:
+            moduleName, className = importString.rsplit(".", 1)
+            _targetClasses[importString] = __import__(moduleName, globals(), locals(), [className], -1).__dict__[className]
+
 def loadStack(command):
+    """Loads the stack of a scriptTree command, "scriptTree pickleFile", the pickle file holding 
+    the import strings of the target's classes followed by the stack, see Stack.makeRunnable. 
+    Commands made by earlier versions list the import strings after the pickle file instead.
+    """
     commandTokens = command.split()
     assert commandTokens[0] == "scriptTree"
-    for className in commandTokens[2:]:
-        l = className.split(".")
-        moduleName = ".".join(l[:-1])
-        className = l[-1]
-        _temp = __import__(moduleName, globals(), locals(), [className], -1)
-        exec "%s = 1" % className
-        vars()[className] = _temp.__dict__[className]
-    return loadPickleFile(commandTokens[1])
+    if len(commandTokens) > 2:
+        importTargetClasses(commandTokens[2:])
+        return loadPickleFile(commandTokens[1])
+    fileHandle = open(commandTokens[1], 'rb')
+    importTargetClasses(cPickle.load(fileHandle))
+    stack = cPickle.load(fileHandle)
+    fileHandle.close()
+    return stack
         
 def loadPickleFile(pickleFile):
     """Loads the first object from a pickle file.
@@ -64,6 +82,127 @@ def loadPickleFile(pickleFile):
     fileHandle.close()
     return i
     
+_settingsCache = {} #The settings loaded by this process, which may run many slaves, see loadSettings
+
+def getSettingsCacheFileName(jobTreePath):
+    """Returns the name of the file on the local disk caching the settings of the jobTree for the slaves of the host, 
+    in a directory of the system's temp dir private to the user, as the cache is unpickled.
+    """
+    cacheDir = os.path.join(tempfile.gettempdir(), "jobTree_%i" % os.getuid())
+    try:
+        os.mkdir(cacheDir, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST: #Made by another slave, or by someone else, see _isPrivate
+            raise
+    return os.path.join(cacheDir, "jobTree_settings_%s.pickle" % hashlib.md5(os.path.abspath(jobTreePath)).hexdigest())
+
+def _isPrivate(path):
+    """Returns True if the path is owned by the user, is not a link and can not be written by anyone else.
+    """
+    try:
+        pathStat = os.lstat(path)
+    except OSError:
+        return False
+    return pathStat.st_uid == os.getuid() and not stat.S_ISLNK(pathStat.st_mode) and pathStat.st_mode & 022 == 0
+
+def _getFileStamp(fileName):
+    fileStat = os.stat(fileName)
+    return (fileStat.st_mtime, fileStat.st_size, fileStat.st_ino)
+
+def loadSettings(environmentFile, configFile, cacheFile):
+    """Returns the environment and the config of a jobTree, as a dictionary and the attributes of the config. 
+    They are cached in memory and in cacheFile, on the local disk, shared by the slaves of the host, and 
+    checked against the modification times, sizes and inodes of the files, so a slave need only stat them. 
+    The files are replaced, not rewritten, when the jobTree is reloaded, so their inodes change. The cache 
+    file is only loaded if it and its directory are private to the user, as it could otherwise have been 
+    planted by someone else.
+    """
+    stamp = (_getFileStamp(environmentFile), _getFileStamp(configFile))
+    settings = _settingsCache.get(cacheFile)
+    if settings == None or settings[0] != stamp:
+        settings = None
+        cacheDirIsPrivate = _isPrivate(os.path.dirname(os.path.abspath(cacheFile)))
+        if cacheDirIsPrivate and _isPrivate(cacheFile):
+            try:
+                settings = loadPickleFile(cacheFile)
+            except: #Corrupt
+                settings = None
+        if settings == None or settings[0] != stamp:
+            settings = (stamp, dict(loadPickleFile(environmentFile)), dict(ET.parse(configFile).getroot().attrib))
+            if cacheDirIsPrivate:
+                try:
+                    fileHandle = open("%s.%s.new" % (cacheFile, os.getpid()), 'wb')
+                    cPickle.dump(settings, fileHandle, cPickle.HIGHEST_PROTOCOL)
+                    fileHandle.close()
+                    os.rename("%s.%s.new" % (cacheFile, os.getpid()), cacheFile) #Atomic, so other slaves never read it part written
+                except (IOError, OSError): #The cache is just an optimisation
+                    pass
+        _settingsCache[cacheFile] = settings
+    return settings[1], settings[2]
+
+def getSiblingNumber(followOnCommands, memoryAvailable, cpuAvailable):
+    """Returns the number of follow ons at the top of the stack with the same depth, which fit in the memory 
+    and cpu available. They are independent of one another, such as the children of a target inlined by 
+    Stack.execute, as the follow ons they wait for are below them in the stack, at lesser depths, so they 
+    can be run concurrently.
+    """
+    depth = followOnCommands[-1][3]
+    i = 0
+    while i < len(followOnCommands) and followOnCommands[-1-i][3] == depth and \
+    followOnCommands[-1-i][1] <= memoryAvailable and followOnCommands[-1-i][2] <= cpuAvailable:
+        i += 1
+    return i
+
+def runConcurrently(fn, followOnCommands, memoryAvailable, cpuAvailable, pollInterval=0.01):
+    """Returns [ fn(followOnCommand) for followOnCommand in followOnCommands ], calling fn in 
+    forked processes, as many at once as fit in the memory and cpu available. Raises a RuntimeError 
+    if any of the calls fail, once those running have finished. The processes are forked directly, 
+    as the slave may itself be run by a daemonic multiprocessing process, see singleMachine.
+    """
+    resultDir = tempfile.mkdtemp()
+    pending = range(len(followOnCommands))
+    processes = {} #The running processes, by the indices of their follow ons
+    results = {}
+    failed = False
+    while len(pending) + len(processes) > 0:
+        #Start the follow ons that fit in the memory and cpu not in use
+        for index in pending[:]:
+            memory, cpu = followOnCommands[index][1:3]
+            if memory + sum([ followOnCommands[i][1] for i in processes ]) <= memoryAvailable and \
+            cpu + sum([ followOnCommands[i][2] for i in processes ]) <= cpuAvailable:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                processes[index] = os.fork()
+                if processes[index] == 0: #The result is written to a file, as it may be too big for a pipe
+                    exitValue = 1
+                    try:
+                        result = fn(followOnCommands[index])
+                        fileHandle = open(os.path.join(resultDir, str(index)), 'wb')
+                        cPickle.dump(result, fileHandle, cPickle.HIGHEST_PROTOCOL)
+                        fileHandle.close()
+                        exitValue = 0
+                    except:
+                        traceback.print_exc()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(exitValue)
+                pending.remove(index)
+        time.sleep(pollInterval)
+        for index in processes.keys():
+            pid, exitStatus = os.waitpid(processes[index], os.WNOHANG)
+            if pid != 0:
+                processes.pop(index)
+                if exitStatus == 0:
+                    results[index] = loadPickleFile(os.path.join(resultDir, str(index)))
+                    os.remove(os.path.join(resultDir, str(index)))
+                else:
+                    failed = True
+                    pending = []
+    os.rmdir(resultDir)
+    if failed:
+        raise RuntimeError("A follow on run concurrently with its siblings failed")
+    return [ results[index] for index in xrange(len(followOnCommands)) ]
+
 def nextOpenDescriptor():
     """Gets the number of the next available file descriptor.
     """
@@ -72,7 +211,8 @@ def nextOpenDescriptor():
     return descriptor
     
 def main():
-    sys.path.append(sys.argv[1])
+    if sys.argv[1] not in sys.path: #A process may run many slaves, see jobTreeWorker
+        sys.path.append(sys.argv[1])
     sys.argv.remove(sys.argv[1])
     
     #Now we can import all the stuff..
@@ -84,8 +224,11 @@ def main():
     from sonLib.bioio import getTotalCpuTime, getTotalCpuTimeAndMemoryUsage
     from sonLib.bioio import getTempDirectory
     from sonLib.bioio import makeSubDir
-    from jobTree.src.job import Job
-    from jobTree.src.master import getEnvironmentFileName, getConfigFileName, listChildDirs, getTempStatsFile, setupJobAfterFailure
+    from jobTree.src.jobStore import loadJobStore
+    from jobTree.src.job import Job, getRecordBytesSaved
+    from jobTree.src.deleter import deleter, getTrashDirName
+    from jobTree.src.resourceMonitor import ResourceMonitor
+    from jobTree.src.master import getEnvironmentFileName, getConfigFileName, listChildDirs, getTempStatsFile, setupJobAfterFailure, getMaxJobMemory
     from sonLib.bioio import system
     
     ########################################## 
@@ -99,17 +242,16 @@ def main():
     #Load the environment for the job
     ##########################################
     
-    #First load the environment for the job.
-    fileHandle = open(getEnvironmentFileName(jobTreePath), 'r')
-    environment = cPickle.load(fileHandle)
-    fileHandle.close()
+    #First load the environment for the job, and the config.
+    environment, configAttrib = loadSettings(getEnvironmentFileName(jobTreePath), getConfigFileName(jobTreePath), 
+                                             getSettingsCacheFileName(jobTreePath))
     for i in environment:
         if i not in ("TMPDIR", "TMP", "HOSTNAME", "HOSTTYPE"):
             os.environ[i] = environment[i]
     # sys.path is used by __import__ to find modules
     if "PYTHONPATH" in environment:
         for e in environment["PYTHONPATH"].split(':'):
-            if e != '':
+            if e != '' and e not in sys.path:
                 sys.path.append(e)
     #os.environ = environment
     #os.putenv(key, value)
@@ -181,12 +323,15 @@ def main():
     #Parse input files
     ##########################################
     
-    config = ET.parse(getConfigFileName(jobTreePath)).getroot()
+    config = ET.Element("config", dict(configAttrib)) #A copy, so the cached settings are not changed
     setLogLevel(config.attrib["log_level"])
-    job = Job.read(jobFile)
+    jobStore = loadJobStore(config)
+    if config.attrib.has_key("background_deletion"):
+        deleter.start(getTrashDirName(jobTreePath))
+    job = jobStore.read(jobFile)
     job.messages = [] #This is the only way to stop messages logging twice, as are read only in the master
     job.children = [] #Similarly, this is where old children are flushed out.
-    job.write() #Update status, to avoid reissuing children after running a follow on below.
+    jobStore.write(job) #Update status, to avoid reissuing children after running a follow on below.
     if os.path.exists(job.getLogFileName()): #This cleans the old log file
         os.remove(job.getLogFileName())
     logger.info("Parsed arguments and set up logging")
@@ -216,6 +361,7 @@ def main():
     ##########################################
 
     slaveFailed = False
+    monitor = None
     try:
         
         ##########################################
@@ -225,14 +371,53 @@ def main():
         def globalTempDirName(job, depth):
             return job.getGlobalTempDirName() + str(depth)
         
-        command, memoryAvailable, cpuAvailable, depth = job.followOnCommands[-1]
+        command, memoryAvailable, cpuAvailable, depth = job.followOnCommands[-1][:4]
         defaultMemory = int(config.attrib["default_memory"])
         defaultCpu = int(config.attrib["default_cpu"])
         assert len(job.children) == 0
         
+        ##########################################
+        #Monitor the resources used by the slave and 
+        #its descendants, if requested, which kills 
+        #them if they use more memory than requested
+        ##########################################
+        
+        if stats != None or config.attrib.has_key("enforce_memory"):
+            monitor = ResourceMonitor(memoryLimit=memoryAvailable if config.attrib.has_key("enforce_memory") else sys.maxint)
+            monitor.start()
+        
         startTime = time.time() 
+        loadTime = 0.0 #The time taken to load the targets
+        startRecordBytesSaved = getRecordBytesSaved() #The process may have run other slaves
+        
+        def runSibling(followOnCommand):
+            #Runs a follow on in a process forked by runConcurrently, returning what it adds to the job.
+            #Each sibling has its own subdirectories of the local and global temp dirs
+            deleter.forked()
+            command, memory, cpu = followOnCommand[:3]
+            siblingJob = Job("", memory, cpu, 0, job.jobDir)
+            siblingJob.followOnCommands.pop()
+            siblingStats = None
+            if stats != None:
+                siblingStats = ET.Element("slave")
+            if command[:11] == "scriptTree ":
+                loadStack(command).execute(job=siblingJob, stats=siblingStats,
+                                localTempDir=tempfile.mkdtemp(dir=localTempDir), globalTempDir=tempfile.mkdtemp(dir=globalTempDir),
+                                memoryAvailable=memory, cpuAvailable=cpu,
+                                defaultMemory=defaultMemory, defaultCpu=defaultCpu, depth=depth, 
+                                inlineTime=inlineTime)
+            elif command != "":
+                system(command)
+            if siblingStats != None:
+                siblingStats = [ ET.tostring(targetStats) for targetStats in siblingStats ]
+            return siblingJob.followOnCommands, siblingJob.children, siblingJob.messages, siblingStats
+        
         while True:
-            job.followOnCommands.pop()
+            #Siblings are run concurrently if we have the cpus
+            siblingNumber = 1
+            if cpuAvailable > 1:
+                siblingNumber = getSiblingNumber(job.followOnCommands, memoryAvailable, cpuAvailable)
+            siblings = [ job.followOnCommands.pop() for i in xrange(siblingNumber) ]
             
             ##########################################
             #Global temp dir
@@ -241,7 +426,7 @@ def main():
             globalTempDir = makeSubDir(globalTempDirName(job, depth))
             i = 1
             while os.path.isdir(globalTempDirName(job, depth+i)):
-                system("rm -rf %s" % globalTempDirName(job, depth+i))
+                deleter.delete(globalTempDirName(job, depth+i))
                 i += 1
                 
             ##########################################
@@ -253,22 +438,51 @@ def main():
         
             for childDir in listChildDirs(job.jobDir):
                 logger.debug("Cleaning up old child %s" % childDir)
-                system("rm -rf %s" % childDir)
+                deleter.delete(childDir)
         
             ##########################################
             #Run the job
             ##########################################
         
-            if command != "": #Not a stub
+            #Children that fit in the remainder of the job time may be run by this slave
+            inlineTime = 0.0
+            if config.attrib.has_key("inline_children"):
+                inlineTime = max(0.0, maxTime - (time.time() - startTime))
+            
+            if len(siblings) > 1:
+                ##########################################
+                #Run the siblings concurrently
+                #
+                #What they add to the job is merged into it, 
+                #and written in one update, below, so if the 
+                #slave fails they are all run again
+                ##########################################
+                
+                logger.info("Running %i follow ons concurrently" % len(siblings))
+                results = runConcurrently(runSibling, siblings, memoryAvailable, cpuAvailable)
+                for followOnCommands, children, messages, siblingStats in reversed(results): #So the first sibling's follow ons are run first
+                    job.followOnCommands += followOnCommands
+                for followOnCommands, children, messages, siblingStats in results:
+                    job.children += children
+                    job.messages += messages
+                    if stats != None:
+                        for targetStats in siblingStats:
+                            stats.append(ET.fromstring(targetStats))
+            
+            elif command != "": #Not a stub
                 if command[:11] == "scriptTree ":
                     ##########################################
                     #Run the target
                     ##########################################
                     
-                    loadStack(command).execute(job=job, stats=stats,
+                    loadStartTime = time.time()
+                    stack = loadStack(command)
+                    loadTime += time.time() - loadStartTime
+                    stack.execute(job=job, stats=stats,
                                     localTempDir=localTempDir, globalTempDir=globalTempDir, 
                                     memoryAvailable=memoryAvailable, cpuAvailable=cpuAvailable, 
-                                    defaultMemory=defaultMemory, defaultCpu=defaultCpu, depth=depth)
+                                    defaultMemory=defaultMemory, defaultCpu=defaultCpu, depth=depth,
+                                    inlineTime=inlineTime)
             
                 else: #Is another command
                     system(command) 
@@ -278,8 +492,8 @@ def main():
             ##########################################
             
             job.remainingRetryCount = int(config.attrib["try_count"])
-            system("rm -rf %s/*" % (localTempDir))
-            job.update(depth=depth, tryCount=job.remainingRetryCount)
+            deleter.deleteContents(localTempDir)
+            jobStore.update(job, depth=depth, tryCount=job.remainingRetryCount)
             
             ##########################################
             #Establish if we can run another job
@@ -299,7 +513,7 @@ def main():
                 break
             
             #Get the next job and see if we have enough cpu and memory to run it..
-            command, memory, cpu, depth = job.followOnCommands[-1]
+            command, memory, cpu, depth = job.followOnCommands[-1][:4]
             
             if memory > memoryAvailable:
                 logger.info("We need more memory for the next job, so finishing")
@@ -314,18 +528,27 @@ def main():
         #Finish up the stats
         ##########################################
         
+        if monitor != None:
+            monitor.stop()
+        
         if stats != None:
             totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
             stats.attrib["time"] = str(time.time() - startTime)
             stats.attrib["clock"] = str(totalCpuTime - startClock)
             stats.attrib["memory"] = str(totalMemoryUsage)
+            stats.attrib["record_bytes_saved"] = str(getRecordBytesSaved() - startRecordBytesSaved)
+            stats.attrib["load_time"] = str(loadTime)
+            stats.attrib["peak_memory"] = str(monitor.peakMemory)
+            stats.attrib["peak_threads"] = str(monitor.peakThreads)
+            stats.attrib["monitored_clock"] = str(monitor.cpuTime)
+            stats.attrib["io_bytes"] = str(monitor.ioBytes)
             tempStatsFile = getTempStatsFile(jobTreePath)
             fileHandle = open(tempStatsFile + ".new", "w")
             ET.ElementTree(stats).write(fileHandle)
             fileHandle.close()
             os.rename(tempStatsFile + ".new", tempStatsFile) #This operation is atomic
         
-        logger.info("Finished running the chain of jobs on this node, we ran for a total of %f seconds" % (time.time() - startTime))
+        logger.info("Finished running the chain of jobs on this node, we ran for a total of %f seconds, of which %f seconds were spent loading targets" % (time.time() - startTime, loadTime))
     
     ##########################################
     #Where slave goes wrong
@@ -333,9 +556,17 @@ def main():
     except: #Case that something goes wrong in slave
         traceback.print_exc()
         logger.critical("Exiting the slave because of a failed job on host %s", socket.gethostname())
-        job = Job.read(jobFile)
+        if monitor != None:
+            monitor.stop()
+        job = jobStore.read(jobFile)
         setupJobAfterFailure(job, config)
-        job.write()
+        if monitor != None and monitor.memoryExceeded and len(job.followOnCommands) > 0:
+            #The job is retried with twice the memory it requested, at least as much as it used, up to the most it can request
+            job.followOnCommands[-1] = (job.followOnCommands[-1][0], 
+                                        getMaxJobMemory(config, max(2*memoryAvailable, monitor.peakMemory), job.followOnCommands[-1][2])) + job.followOnCommands[-1][2:]
+            job.messages.append("The job %s was killed on host %s for using %i bytes of memory, more than the %i bytes requested, it will be retried with %i bytes" % 
+                                (job.getJobFileName(), socket.gethostname(), monitor.peakMemory, memoryAvailable, job.followOnCommands[-1][1]))
+        jobStore.write(job)
         slaveFailed = True
 
     ##########################################
@@ -371,14 +602,16 @@ def main():
         truncateFile(tempSlaveLogFile)
         system("mv %s %s" % (tempSlaveLogFile, job.getLogFileName()))
     #Remove the temp dir
-    system("rm -rf %s" % localSlaveTempDir)
+    deleter.delete(localSlaveTempDir)
     
     #This must happen after the log file is done with, else there is no place to put the log
     if (not slaveFailed) and len(job.followOnCommands) == 0 and len(job.children) == 0 and len(job.messages) == 0:
         ##########################################
         #Cleanup global files at the end of the chain
         ##########################################
-        job.delete()            
+        jobStore.delete(job)
+    jobStore.close()
+    deleter.stop() #Waits for the background deletions to finish
         
     
 def _test():
@@ -463,6 +463,20 @@ def reportPrettyData(root, slave, target, target_types, options):
         reportTime(get(root, "total_clock"), options),
         reportTime(get(root, "total_run_time"), options),
         ))
+    if "record_bytes_saved" in root.attrib: #Not in the stats collated by earlier versions
+        out_str += ("Job Record Bytes Saved By Compression: %s\n" % (
+            reportMemory(get(root, "record_bytes_saved"), options, isBytes=True),
+            ))
+    if "total_load_time" in root.attrib:
+        out_str += ("Total Target Load Time: %s\n" % (
+            reportTime(get(root, "total_load_time"), options),
+            ))
+    if "max_peak_memory" in root.attrib:
+        out_str += ("Max Slave Peak Memory: %s, Max Slave Peak Threads: %s, Total Slave IO: %s\n" % (
+            reportMemory(get(root, "max_peak_memory"), options, isBytes=True),
+            reportNumber(get(root, "max_peak_threads"), options),
+            reportMemory(get(root, "total_io_bytes"), options, isBytes=True),
+            ))
     target_types = sortTargets(target_types, options)
     columnWidths = computeColumnWidths(target_types, slave, target, options)
     out_str += "Slave\n"
@@ -621,6 +635,12 @@ def processData(config, stats, options):
     # Add slave info
     slaves = stats.findall("slave")
     buildElement(collatedStatsTag, slaves, "slave")
+    collatedStatsTag.attrib["record_bytes_saved"] = str(sum([ int(slave.attrib.get("record_bytes_saved", 0)) for slave in slaves ]))
+    collatedStatsTag.attrib["total_load_time"] = str(sum([ float(slave.attrib.get("load_time", 0)) for slave in slaves ]))
+    if len([ slave for slave in slaves if "peak_memory" in slave.attrib ]) > 0: #Not in the stats of earlier versions
+        collatedStatsTag.attrib["max_peak_memory"] = str(max([ int(slave.attrib.get("peak_memory", 0)) for slave in slaves ]))
+        collatedStatsTag.attrib["max_peak_threads"] = str(max([ int(slave.attrib.get("peak_threads", 0)) for slave in slaves ]))
+        collatedStatsTag.attrib["total_io_bytes"] = str(sum([ int(slave.attrib.get("io_bytes", 0)) for slave in slaves ]))
 
     # Add aggregated target info
     targets = []
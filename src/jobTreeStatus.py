@@ -35,11 +35,12 @@ from sonLib.bioio import parseBasicOptions
 
 from jobTree.src.master import getJobFileDirName, getConfigFileName
 from jobTree.src.master import listChildDirs as listChildDirsUnsafe
-from jobTree.src.job import Job, getJobFileName
+from jobTree.src.job import getJobFileName
+from jobTree.src.jobStore import loadJobStore
 
-def parseJobFile(absFileName):
+def parseJobFile(absFileName, jobStore):
     try:
-        job = Job.read(absFileName)
+        job = jobStore.readHeader(absFileName)
         return job
     except:
         logger.info("Encountered error while parsing job file %s, so we will ignore it" % absFileName)
@@ -52,27 +53,39 @@ def listChildDirs(jobDir):
         logger.info("Encountered error while parsing job dir %s, so we will ignore it" % jobDir)
     return []
 
-def _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs):
+def listJobChildDirs(jobDir, jobStore):
+    """Lists the directories of the children of the job in the given directory, which in the 
+    sharded layout are found from the job's record.
+    """
+    if jobStore.shardedJobsDir == None:
+        return listChildDirs(jobDir)
+    try:
+        return [ os.path.split(child[0])[0] for child in jobStore.read(getJobFileName(jobDir), partial=True).children ]
+    except:
+        logger.info("Encountered error while parsing job file %s, so we will ignore it" % getJobFileName(jobDir))
+    return []
+
+def _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore):
     #Read job
-    job = parseJobFile(getJobFileName(jobTreeJobsRoot))
+    job = parseJobFile(getJobFileName(jobTreeJobsRoot), jobStore)
     #Get children
-    childJobs = reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs) for childDir in listChildDirs(jobTreeJobsRoot) ], [])
+    childJobs = reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore) for childDir in listJobChildDirs(jobTreeJobsRoot, jobStore) ], [])
     if len(childJobs) > 0:
         childCounts[job] = len(childJobs)
         for childJob in childJobs:
             childJobFileToParentJob[childJob.getJobFileName()] = job
-    elif len(job.followOnCommands) > 0:
+    elif job.followOnCount > 0:
         updatedJobFiles.add(job)
     else: #Job is stub with nothing left to do, so ignore
         shellJobs.add(job)
         return []
     return [ job ]
 
-def parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs):
+def parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore):
     jobFile = getJobFileName(jobTreeJobsRoot)
-    if os.path.exists(jobFile):
-        return _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs)
-    return reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs) for childDir in listChildDirs(jobTreeJobsRoot) ], [])    
+    if jobStore.exists(jobFile):
+        return _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore)
+    return reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore) for childDir in listChildDirs(jobTreeJobsRoot) ], [])    
 
 def main():
     """Reports the state of the job tree.
@@ -120,8 +133,11 @@ def main():
     #Survey the status of the job and report.
     ##########################################  
     
+    config = ET.parse(getConfigFileName(options.jobTree)).getroot()
+    jobStore = loadJobStore(config)
     childJobFileToParentJob, childCounts, updatedJobFiles, shellJobs = {}, {}, set(), set()
-    parseJobFiles(getJobFileDirName(options.jobTree), updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs)
+    parseJobFiles(getJobFileDirName(options.jobTree), updatedJobFiles, childJobFileToParentJob, childCounts, shellJobs, jobStore)
+    jobStore.close()
     
     failedJobs = [ job for job in updatedJobFiles | set(childCounts.keys()) if job.remainingRetryCount == 0 ]
            
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""A long lived slave (a worker), launched through the batch system by the 
+WarmSlaveBatchSystem, which runs many jobs one after another in the same process, 
+so the start up of a slave process is paid once per worker rather than once per job.
+"""
+
+import os
+import sys
+import time
+import traceback
+
+minPollInterval = 0.01 #The seconds a worker waits before listing its queue again, doubled each time it is found empty
+maxPollInterval = 1.0
+
+def writeSpoolFile(fileName, value):
+    """Writes a file of the spool atomically, the readers ignoring names ending in .new.
+    """
+    fileHandle = open(fileName + ".new", 'w')
+    fileHandle.write(value)
+    fileHandle.close()
+    os.rename(fileName + ".new", fileName)
+
+def listSpoolDir(dirName):
+    """Lists the names of the complete files in a directory of the spool, which are the ids of their jobs.
+    """
+    return [ fileName for fileName in os.listdir(dirName) if fileName[-4:] != ".new" ]
+
+def runWorker(spoolDir, queueName, workerName, idleTimeout, runJobFn):
+    """Claims the jobs of the given queue of the spool, one at a time, by moving their tickets 
+    to the worker's directory, and runs them with runJobFn, which is given the job file and returns 
+    the exit value, which is written to the done directory. Returns the number of jobs run once 
+    no job has been found for idleTimeout seconds or the spool has been removed.
+    
+    If the worker dies, the master finds the ticket of the job it was running in its directory 
+    and fails the job, as it would a slave that died.
+    """
+    queueDir = os.path.join(spoolDir, "queue", queueName)
+    workerDir = os.path.join(spoolDir, "workers", workerName)
+    os.mkdir(workerDir)
+    jobsRun = 0
+    timeLastRun = time.time()
+    pollInterval = minPollInterval
+    while True:
+        try:
+            tickets = listSpoolDir(queueDir)
+        except OSError: #The spool was removed, as the master has been restarted
+            break
+        claimedTicket = None
+        for ticket in sorted(tickets, key=int): #In the order they were issued
+            try:
+                os.rename(os.path.join(queueDir, ticket), os.path.join(workerDir, ticket))
+                claimedTicket = ticket
+                break
+            except OSError: #Claimed by another worker
+                pass
+        if claimedTicket == None:
+            if time.time() - timeLastRun >= idleTimeout:
+                break
+            time.sleep(pollInterval)
+            pollInterval = min(2 * pollInterval, maxPollInterval)
+            continue
+        ticketFile = os.path.join(workerDir, claimedTicket)
+        os.utime(ticketFile, None) #Records when the job started
+        fileHandle = open(ticketFile, 'r')
+        jobFile = fileHandle.read()
+        fileHandle.close()
+        exitValue = runJobFn(jobFile)
+        writeSpoolFile(os.path.join(spoolDir, "done", claimedTicket), str(exitValue))
+        os.remove(ticketFile)
+        jobsRun += 1
+        timeLastRun = time.time()
+        pollInterval = minPollInterval
+    try:
+        os.rmdir(workerDir)
+    except OSError:
+        pass
+    return jobsRun
+
+def main():
+    sys.path.append(sys.argv[1])
+    from jobTree.src.jobTreeSlave import main as slaveMain
+    
+    ##########################################
+    #Input args
+    ##########################################
+    
+    rootPath, jobTreePath, spoolDir, queueName, workerName, idleTimeout = sys.argv[1:7]
+    
+    def runJob(jobFile):
+        sys.argv = [ sys.argv[0], rootPath, jobTreePath, jobFile ] #As the slave is given them
+        try:
+            slaveMain()
+        except: #The job is failed, as if its slave had died, and the worker carries on
+            traceback.print_exc()
+            return 1
+        return 0
+    
+    runWorker(spoolDir, queueName, workerName, float(idleTimeout), runJob)
+
+def _test():
+    import doctest      
+    return doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+    main()
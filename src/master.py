@@ -37,15 +37,25 @@ import time
 import shutil
 import socket
 import random
+import uuid
+import traceback
+import heapq
 from collections import deque
 #from threading import Thread, Queue
 from multiprocessing import Process, Queue
-
-from job import Job, getJobFileName, getJobLogFileName
+from multiprocessing.pool import ThreadPool
+from array import array
+from job import getJobFileName, getJobLogFileName, getChildPriority, getFollowOnPriority
+from jobGraph import JobGraph, JobGraphLog
+from jobStore import loadJobStore, CachingJobStore, listDir, childDirPattern, listChildDirs, getJobFileDirName, isShardedLayout
+from metrics import Metrics
+from deleter import deleter, getTrashDirName
+from garbageCollector import garbageCollector
 from sonLib.bioio import logger, getTotalCpuTime
 from sonLib.bioio import logFile
 from sonLib.bioio import system
 from jobTree.src.bioio import workflowRootPath
+from jobTree.batchSystems.abstractBatchSystem import JOB_RUNNING, JOB_VANISHED
 from sonLib.bioio import TempFileTree
 
 ####
@@ -55,9 +65,6 @@ from sonLib.bioio import TempFileTree
 def getEnvironmentFileName(jobTreePath):
     return os.path.join(jobTreePath, "environ.pickle")
 
-def getJobFileDirName(jobTreePath):
-    return os.path.join(jobTreePath, "jobs")
-
 def getStatsFileName(jobTreePath):
     return os.path.join(jobTreePath, "stats.xml")
 
@@ -70,6 +77,15 @@ def getParasolResultsFileName(jobTreePath):
 def getConfigFileName(jobTreePath):
     return os.path.join(jobTreePath, "config.xml")
 
+def getJobGraphSnapshotFileName(jobTreePath):
+    return os.path.join(jobTreePath, "jobGraph.snapshot")
+
+def getJobGraphJournalFileName(jobTreePath):
+    return os.path.join(jobTreePath, "jobGraph.journal")
+
+def getMetricsFileName(jobTreePath):
+    return os.path.join(jobTreePath, "metrics.jsonl")
+
 def setupJobAfterFailure(job, config):
     if len(job.followOnCommands) > 0:
         job.remainingRetryCount = max(0, job.remainingRetryCount-1)
@@ -81,6 +97,21 @@ def setupJobAfterFailure(job, config):
     else:
         logger.critical("The job %s has no follow on jobs to reset" % job.getJobFileName())
 
+def getMaxJobMemory(config, memory, cpu):
+    """Returns the given memory for a job, reduced, if needed, to the most that can be requested of 
+    the batch system, or of the big batch system, for jobs needing more than the big memory threshold.
+    """
+    maxMemory = float(config.attrib["max_memory"])
+    if "big_batch_system" in config.attrib:
+        bigMemoryThreshold = float(config.attrib["big_memory_threshold"])
+        bigMaxMemory = float(config.attrib["big_max_memory"])
+        if cpu > float(config.attrib["big_cpu_threshold"]): #Issued to the big batch system, whatever its memory
+            return min(memory, bigMaxMemory)
+        if memory > bigMemoryThreshold and bigMaxMemory > bigMemoryThreshold:
+            return min(memory, bigMaxMemory)
+        maxMemory = min(maxMemory, bigMemoryThreshold)
+    return min(memory, maxMemory)
+
 #####
 ##The following functions are used for collating stats from the slaves
 ####
@@ -89,7 +120,10 @@ def getTempStatDirNames():
     return [ "1", "2", "3", "4", "5", "6", "7", "8", "9", "10"]
 
 def getTempStatsFile(jobTreePath):
-    return os.path.join(jobTreePath, "stats", random.choice(getTempStatDirNames()), random.choice(getTempStatDirNames()), "%s_%s.xml" % (socket.gethostname(), os.getpid()))
+    """Returns a new name for a slave's stats file. The name is unique to each slave, not just 
+    each process, as a process may run many slaves, see jobTreeWorker.
+    """
+    return os.path.join(jobTreePath, "stats", random.choice(getTempStatDirNames()), random.choice(getTempStatDirNames()), "%s_%s_%s.xml" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex))
 
 def makeTemporaryStatsDirs(jobTreePath):
     #Temp dirs
@@ -144,42 +178,116 @@ def statsAggregatorProcess(jobTreePath, tempDirs, stop):
 ##Following encapsulates interations with batch system class.
 ####
 
+metrics = Metrics() #Times the hot paths of the master, written to the metrics file by the main loop
+
+class ResourcePool:
+    """The jobs waiting to be issued to a resource pool of the batch system (see 
+    AbstractBatchSystem.getResourcePool), and the cpus and memory requested by the 
+    jobs issued to it.
+    """
+    def __init__(self, batchSystem):
+        self.maxCpus = float(batchSystem.maxCpus)
+        self.maxMemory = float(batchSystem.maxMemory)
+        self.cpusIssued = 0
+        self.memoryIssued = 0
+        self.jobsIssued = 0
+        self.waitingJobs = [] #Heap of the jobs waiting to be issued
+
+    def hasRoomFor(self, memory, cpu):
+        """Returns True if the job fits within the max cpus and max memory of the pool. 
+        A job always fits if no jobs are issued to the pool, so a job can not wait forever.
+        """
+        return self.jobsIssued == 0 or \
+        (self.cpusIssued + cpu <= self.maxCpus and self.memoryIssued + memory <= self.maxMemory)
+
+    def reserve(self, memory, cpu, sign=1):
+        self.cpusIssued += sign * cpu
+        self.memoryIssued += sign * memory
+        self.jobsIssued += sign
+
 class JobBatcher:
     """Class works with jobBatcherWorker to submit jobs to the batch system.
+    
+    The batch system's resource pools each have a priority queue of jobs. When issueWaitingJobs is 
+    called the jobs are issued from each queue while the cpus and memory they request fit within the 
+    max cpus and max memory of the pool, so no batch system is sent more jobs than it is allowed.
+    Jobs are ordered by the priority set on their targets, then by the estimated 
+    time remaining to run their subtrees, then by their depth, deepest first, so that
+    long chains of jobs are not queued behind wide fan outs of short jobs.
     """
-    def __init__(self, config, batchSystem):
+    def __init__(self, config, batchSystem, jobGraph):
         self.jobTree = config.attrib["job_tree"]
         self.jobIDsToJobsHash = {}
         self.batchSystem = batchSystem
+        self.jobGraph = jobGraph
         self.jobsIssued = 0
         self.jobTreeSlavePath = os.path.join(workflowRootPath(), "src", "jobTreeSlave.py")
         self.rootPath = os.path.split(workflowRootPath())[0]
+        self.resourcePools = {} #Resource pools of the batch system, to their ResourcePool
+        self.waitingJobNumber = 0 #Used to break ties in the heaps, so jobs with equal priorities are issued in the order they were added
+        self.jobIDsToStartTimes = {} #Issued jobs the batch system has reported running, to the time they started
 
-    def issueJob(self, jobFile, memory, cpu):
+    @metrics.timed("JobBatcher.issueJob")
+    def issueJob(self, jobFile, memory, cpu, priority=0):
         """Add a job to the queue of jobs
         """
+        command = self._getJobCommand(jobFile)
+        pool = self.batchSystem.getResourcePool(command, memory, cpu)
+        if pool not in self.resourcePools:
+            self.resourcePools[pool] = ResourcePool(pool)
+        criticalPath = self.jobGraph.getEstimatedCriticalPath(jobFile)
+        heapq.heappush(self.resourcePools[pool].waitingJobs, ((-priority, -(criticalPath or 0.0), -self.jobGraph.getDepth(jobFile)), 
+                                                               self.waitingJobNumber, jobFile, memory, cpu))
+        self.waitingJobNumber += 1
         self.jobsIssued += 1
-        jobCommand = "%s -E %s %s %s %s" % (sys.executable, self.jobTreeSlavePath, self.rootPath, self.jobTree, jobFile)
-        jobID = self.batchSystem.issueJob(jobCommand, memory, cpu)
-        self.jobIDsToJobsHash[jobID] = jobFile
-        logger.debug("Issued the job: %s with job id: %s and cpus: %i" % (jobFile, str(jobID), cpu))
 
     def issueJobs(self, jobs):
-        """Add a list of jobs
+        """Add a list of jobs, (jobFile, memory, cpu[, priority]) tuples, to the queue of jobs.
+        """
+        for job in jobs:
+            self.issueJob(job[0], job[1], job[2], getChildPriority(job))
+
+    @metrics.timed("JobBatcher.issueWaitingJobs")
+    def issueWaitingJobs(self):
+        """Issues the waiting jobs to the batch system together, taking the jobs of each resource 
+        pool in order of priority, until the next job would exceed the pool's max cpus or max memory. 
         """
-        for jobFile, memory, cpu in jobs:
-            self.issueJob(jobFile, memory, cpu)
+        jobs = []
+        for resourcePool in self.resourcePools.values():
+            while len(resourcePool.waitingJobs) > 0:
+                key, index, jobFile, memory, cpu = resourcePool.waitingJobs[0]
+                if not resourcePool.hasRoomFor(memory, cpu):
+                    break
+                heapq.heappop(resourcePool.waitingJobs)
+                resourcePool.reserve(memory, cpu)
+                jobs.append((jobFile, memory, cpu, resourcePool))
+        if len(jobs) > 0:
+            jobIDs = self.batchSystem.issueJobs([ (self._getJobCommand(jobFile), memory, cpu) for jobFile, memory, cpu, resourcePool in jobs ])
+            assert len(jobIDs) == len(jobs)
+            for jobID, (jobFile, memory, cpu, resourcePool) in zip(jobIDs, jobs):
+                self.jobIDsToJobsHash[jobID] = (intern(jobFile), memory, cpu, resourcePool)
+            metrics.increment("jobsIssuedToBatchSystem", len(jobs))
+            logger.debug("Issued %i jobs, with %i jobs waiting to be issued" % (len(jobs), self.getNumberOfJobsWaiting()))
+
+    def _getJobCommand(self, jobFile):
+        return "%s -E %s %s %s %s" % (sys.executable, self.jobTreeSlavePath, self.rootPath, self.jobTree, jobFile)
 
     def getNumberOfJobsIssued(self):
-        """Gets number of jobs that have been added by issueJob(s) and not removed by removeJobID
+        """Gets number of jobs that have been added by issueJob(s) and not removed by removeJobID,
+        including those waiting to be issued to the batch system.
         """
         assert self.jobsIssued >= 0
         return self.jobsIssued
 
+    def getNumberOfJobsWaiting(self):
+        """Gets the number of jobs waiting to be issued to the batch system.
+        """
+        return self.jobsIssued - len(self.jobIDsToJobsHash)
+
     def getJob(self, jobID):
         """Gets the job file associated the a given id
         """
-        return self.jobIDsToJobsHash[jobID]
+        return self.jobIDsToJobsHash[jobID][0]
 
     def hasJob(self, jobID):
         """Returns true if the jobID is in the list of jobs.
@@ -187,92 +295,107 @@ class JobBatcher:
         return self.jobIDsToJobsHash.has_key(jobID)
 
     def getJobIDs(self):
-        """Gets the set of jobs currently issued.
+        """Gets the set of jobs currently issued to the batch system.
         """
         return self.jobIDsToJobsHash.keys()
 
+    def setJobRunning(self, jobID, startTime):
+        """Records the time an issued job started running, as reported by the batch system's job events.
+        """
+        self.jobIDsToStartTimes[jobID] = startTime
+
+    def getRunningJobIDs(self):
+        """Gets a map of the ids of the jobs reported running by the batch system's job events 
+        to the number of seconds they have been running.
+        """
+        now = time.time()
+        return dict([ (jobID, now - startTime) for jobID, startTime in self.jobIDsToStartTimes.items() ])
+
+    def removeJobs(self, jobFiles):
+        """Removes the jobs with the given files, whether issued to the batch system or waiting to 
+        be issued. Returns the removed jobs as (jobID, jobFile, memory, cpu) tuples, the jobID being 
+        None for jobs that were waiting. The issued jobs must be killed by the caller.
+        """
+        removedJobs = []
+        for jobID in [ jobID for jobID, job in self.jobIDsToJobsHash.iteritems() if job[0] in jobFiles ]:
+            memory, cpu = self.jobIDsToJobsHash[jobID][1:3]
+            removedJobs.append((jobID, self.removeJobID(jobID), memory, cpu))
+        for resourcePool in self.resourcePools.values():
+            waitingJobs = []
+            for waitingJob in resourcePool.waitingJobs:
+                key, index, jobFile, memory, cpu = waitingJob
+                if jobFile in jobFiles:
+                    removedJobs.append((None, jobFile, memory, cpu))
+                    self.jobsIssued -= 1
+                else:
+                    waitingJobs.append(waitingJob)
+            if len(waitingJobs) < len(resourcePool.waitingJobs):
+                heapq.heapify(waitingJobs)
+                resourcePool.waitingJobs = waitingJobs
+        return removedJobs
+
     def removeJobID(self, jobID):
         """Removes a job from the jobBatcher.
         """
         assert jobID in self.jobIDsToJobsHash
         self.jobsIssued -= 1
-        jobFile = self.jobIDsToJobsHash.pop(jobID)
+        self.jobIDsToStartTimes.pop(jobID, None)
+        jobFile, memory, cpu, resourcePool = self.jobIDsToJobsHash.pop(jobID)
+        resourcePool.reserve(memory, cpu, -1)
         return jobFile
 
 ####
 #Following functions process finished jobs
 ####
 
-def listChildDirs(jobDir):
-    """Directories of child jobs for given job (not recursive).
-    """
-    return [ os.path.join(jobDir, f) for f in os.listdir(jobDir) if re.match("t[0-9]+$", f) ]
-
-def processAnyUpdatingFile(jobFile):
-    if os.path.isfile(jobFile + ".updating"):
-        logger.critical("There was an .updating file for job: %s" % jobFile)
-        if os.path.isfile(jobFile + ".new"): #The job failed while writing the updated job file.
-            logger.critical("There was a .new file for the job: %s" % jobFile)
-            os.remove(jobFile + ".new") #The existance of the .updating file means it wasn't complete
-        for f in listChildDirs(os.path.split(jobFile)[0]):
-            logger.critical("Removing broken child %s\n" % f)
-            system("rm -rf %s" % f)
-        assert os.path.isfile(jobFile)
-        os.remove(jobFile + ".updating") #Delete second the updating file second to preserve a correct state
-        logger.critical("We've reverted to the original job file: %s" % jobFile)
-        return True
-    return False
-
-def processAnyNewFile(jobFile):
-    if os.path.isfile(jobFile + ".new"): #The job was not properly updated before crashing
-        logger.critical("There was a .new file for the job and no .updating file %s" % jobFile)
-        if os.path.isfile(jobFile):
-            os.remove(jobFile)
-        os.rename(jobFile + ".new", jobFile)
-        return True
-    return False
-
-def updateParentStatus(jobFile, updatedJobFiles, childJobFileToParentJob, childCounts):
+@metrics.timed("JobStore.read")
+def readJob(jobFile, jobStore, partial=False):
+    return jobStore.read(jobFile, partial)
+
+@metrics.timed("updateParentStatus")
+def updateParentStatus(jobFile, updatedJobFiles, jobGraph, jobStore):
     """Update status of parent for finished child job.
     """
     while True:
-        if jobFile not in childJobFileToParentJob:
+        if jobGraph.getParent(jobFile) == None:
+            jobGraph.removeJob(jobFile)
             assert len(updatedJobFiles) == 0
-            assert len(childJobFileToParentJob) == 0
-            assert len(childCounts) == 0
+            assert len(jobGraph) == 0
             break
-        parentJob = childJobFileToParentJob.pop(jobFile)
-        childCounts[parentJob] -= 1
-        assert childCounts[parentJob] >= 0
-        if childCounts[parentJob] == 0: #Job is done
-            childCounts.pop(parentJob)
-            logger.debug("Parent job %s has all its children run successfully", parentJob.getJobFileName())
-            assert parentJob not in updatedJobFiles
+        parentJobFile = jobGraph.removeJob(jobFile)
+        if parentJobFile != None: #Job is done
+            logger.debug("Parent job %s has all its children run successfully", parentJobFile)
+            parentJob = readJob(parentJobFile, jobStore, partial=True) #The parent's messages have been logged and its children run
+            parentJob.messages = []
+            parentJob.children = []
             if len(parentJob.followOnCommands) > 0:
                 updatedJobFiles.add(parentJob) #Now we know the job is done we can add it to the list of updated job files
                 break
             else:
-                jobFile = parentJob.getJobFileName()
+                garbageCollector.addJob(parentJob, jobGraph.getParent(parentJobFile)) #The job is finished but, unlike a job finished by its slave, not removed
+                jobFile = parentJobFile
         else:
             break
 
-def processFinishedJob(jobID, resultStatus, updatedJobFiles, jobBatcher, childJobFileToParentJob, childCounts, config):
+@metrics.timed("processFinishedJob")
+def processFinishedJob(jobID, resultStatus, updatedJobFiles, jobBatcher, jobGraph, jobStore, config):
     """Function reads a processed job file and updates it state.
     """
     jobFile = jobBatcher.removeJobID(jobID)
-    updatingFilePresent = processAnyUpdatingFile(jobFile)
-    newFilePresent = processAnyNewFile(jobFile)
+    recovered = jobStore.recover(jobFile)
     jobDir = os.path.split(jobFile)[0]
     if os.path.exists(getJobLogFileName(jobDir)):
         logger.critical("The job seems to have left a log file, indicating failure: %s", jobFile)
         logFile(getJobLogFileName(jobDir), logger.critical)
-    if os.path.isfile(jobFile):
-        job = Job.read(jobFile)
+    if jobStore.exists(jobFile):
+        job = readJob(jobFile, jobStore, partial=(resultStatus == 0 and not recovered)) #Only a failed job is changed and written back, so needs its follow on commands
         assert job not in updatedJobFiles
-        if resultStatus != 0 or newFilePresent or updatingFilePresent:
+        if resultStatus != 0 or recovered:
             if not os.path.exists(job.getLogFileName()):
                 logger.critical("No log file is present, despite job failing: %s", jobFile)
             setupJobAfterFailure(job, config)
+            if len(job.children) > 0:
+                jobStore.write(job) #The job is read again once its children are done, so this preserves its new state
         if len(job.followOnCommands) > 0 or len(job.children) > 0:
             updatedJobFiles.add(job) #Now we know the job is done we can add it to the list of updated job files
             logger.debug("Added job: %s to active jobs" % jobFile)
@@ -280,25 +403,53 @@ def processFinishedJob(jobID, resultStatus, updatedJobFiles, jobBatcher, childJo
             for message in job.messages: #This is here because jobs with no children or follow ons may log to master.
                 logger.critical("Got message from job at time: %s : %s" % (time.time(), message))
             logger.debug("Job has no follow-ons or children despite job file being present so we'll consider it done: %s" % jobFile)
-            updateParentStatus(jobFile, updatedJobFiles, childJobFileToParentJob, childCounts)
+            garbageCollector.addJob(job, jobGraph.getParent(jobFile))
+            updateParentStatus(jobFile, updatedJobFiles, jobGraph, jobStore)
     else:  #The job is done
         if resultStatus != 0:
             logger.critical("Despite the batch system claiming failure the job %s seems to have finished and been removed" % jobFile)
-        updateParentStatus(jobFile, updatedJobFiles, childJobFileToParentJob, childCounts)
+        updateParentStatus(jobFile, updatedJobFiles, jobGraph, jobStore)
 
 ####
 #Following functions handle error cases for when jobs have gone awry with the batch system.
 ####
 
-def killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, childJobFileToParentJob, childCounts, config):
+def killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, jobGraph, jobStore, config):
     """Kills the given set of jobs and then sends them for processing
     """
     if len(jobsToKill) > 0:
         batchSystem.killJobs(jobsToKill)
         for jobID in jobsToKill:
-            processFinishedJob(jobID, 1, updatedJobFiles, jobBatcher, childJobFileToParentJob, childCounts, config)
-
-def reissueOverLongJobs(updatedJobFiles, jobBatcher, config, batchSystem, childJobFileToParentJob, childCounts):
+            processFinishedJob(jobID, 1, updatedJobFiles, jobBatcher, jobGraph, jobStore, config)
+
+@metrics.timed("cancelSubtree")
+def cancelSubtree(jobFile, jobBatcher, batchSystem, jobGraph, config):
+    """Used in fail fast mode when a job has completely failed, so the follow on of its parent can 
+    never run. Kills the issued jobs in the subtree of the parent and removes those waiting to be 
+    issued, without retrying them. Their job files are left, so they are run again if the jobTree 
+    is restarted. Returns an estimate of the cpu hours saved, from the estimated time remaining to 
+    run the subtrees of the jobs, or the ideal job time for jobs with no estimate.
+    """
+    parentJobFile = jobGraph.getParent(jobFile)
+    if parentJobFile == None:
+        return 0.0
+    removedJobs = jobBatcher.removeJobs(set(jobGraph.getDescendants(parentJobFile)))
+    jobsToKill = [ jobID for jobID, removedJobFile, memory, cpu in removedJobs if jobID != None ]
+    if len(jobsToKill) > 0:
+        batchSystem.killJobs(jobsToKill)
+    idealJobTime = float(config.attrib["job_time"])
+    cpuHoursSaved = 0.0
+    for jobID, removedJobFile, memory, cpu in removedJobs:
+        criticalPath = jobGraph.getEstimatedCriticalPath(removedJobFile)
+        cpuHoursSaved += cpu * (idealJobTime if criticalPath == None else criticalPath) / 3600.0
+    logger.critical("As the job %s has failed, killed %i jobs and cancelled %i waiting jobs in the subtree of its parent %s, saving an estimated %f cpu hours" % \
+                    (jobFile, len(jobsToKill), len(removedJobs) - len(jobsToKill), parentJobFile, cpuHoursSaved))
+    metrics.increment("jobsCancelled", len(removedJobs))
+    metrics.increment("cpuHoursSaved", cpuHoursSaved)
+    return cpuHoursSaved
+
+@metrics.timed("reissueOverLongJobs")
+def reissueOverLongJobs(updatedJobFiles, jobBatcher, config, batchSystem, jobGraph, jobStore):
     """Check each issued job - if it is running for longer than desirable.. issue a kill instruction.
     Wait for the job to die then we pass the job to processFinishedJob.
     """
@@ -309,17 +460,21 @@ def reissueOverLongJobs(updatedJobFiles, jobBatcher, config, batchSystem, childJ
         maxJobDuration = idealJobTime * 10
     jobsToKill = []
     if maxJobDuration < 10000000: #We won't both doing anything is the rescue time is more than 16 weeks.
-        runningJobs = batchSystem.getRunningJobIDs()
+        if batchSystem.supportsJobEvents():
+            runningJobs = jobBatcher.getRunningJobIDs() #Tracked from the running events, so the batch system need not be queried
+        else:
+            runningJobs = batchSystem.getRunningJobIDs()
         for jobID in runningJobs.keys():
             if runningJobs[jobID] > maxJobDuration:
                 logger.critical("The job: %s has been running for: %s seconds, more than the max job duration: %s, we'll kill it" % \
                             (str(jobBatcher.getJob(jobID)), str(runningJobs[jobID]), str(maxJobDuration)))
                 jobsToKill.append(jobID)
-        killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, childJobFileToParentJob, childCounts, config)
+        killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, jobGraph, jobStore, config)
 
 reissueMissingJobs_missingHash = {} #Hash to store number of observed misses
+@metrics.timed("reissueMissingJobs")
 def reissueMissingJobs(updatedJobFiles, jobBatcher, batchSystem,
-                       childJobFileToParentJob, childCounts, config,
+                       jobGraph, jobStore, config,
                        killAfterNTimesMissing=3):
     """Check all the current job ids are in the list of currently running batch system jobs.
     If a job is missing, we mark it as so, if it is missing for a number of runs of
@@ -346,59 +501,231 @@ def reissueMissingJobs(updatedJobFiles, jobBatcher, batchSystem,
         if timesMissing == killAfterNTimesMissing:
             reissueMissingJobs_missingHash.pop(jobID)
             jobsToKill.append(jobID)
-    killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, childJobFileToParentJob, childCounts, config)
+    killJobs(jobsToKill, updatedJobFiles, jobBatcher, batchSystem, jobGraph, jobStore, config)
     return len(reissueMissingJobs_missingHash) == 0 #We use this to inform if there are missing jobs
 
+@metrics.timed("processJobEvents")
+def processJobEvents(jobEvents, updatedJobFiles, jobBatcher, jobGraph, jobStore, config):
+    """Processes the job events published by a batch system that supports them. Running jobs are 
+    recorded so overlong jobs can be found, and vanished jobs, lost by the batch system, 
+    are passed to processFinishedJob as failed, as soon as they are reported.
+    """
+    for jobID, state, eventTime in jobEvents:
+        if not jobBatcher.hasJob(jobID): #A job whose result has already been processed
+            continue
+        if state == JOB_RUNNING:
+            jobBatcher.setJobRunning(jobID, eventTime)
+        elif state == JOB_VANISHED:
+            logger.critical("Batch system is reporting that the job %s %s has vanished" % (jobID, jobBatcher.getJob(jobID)))
+            metrics.increment("vanishedJobs")
+            processFinishedJob(jobID, 1, updatedJobFiles, jobBatcher, jobGraph, jobStore, config)
+    metrics.increment("jobEvents", len(jobEvents))
+
 ####
 #Following is used to setup/resume a jobTree
 ####
 
-def _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, config):
-    #Read job
-    job = Job.read(getJobFileName(jobTreeJobsRoot))
-    #Reset the job
+defaultRestartThreads = 16 #The default number of threads used to scan the jobs directory when restarting
+defaultJobCacheSize = 10000 #The default number of jobs the master keeps parsed in memory
+defaultGarbageCollectionRate = 100 #The default max number of paths a second the master's garbage collector removes
+
+def _resetJob(job, jobStore, config):
+    """Resets the state of a job found when restarting the jobTree.
+    """
+    if job.remainingRetryCount != int(config.attrib["try_count"]):
+        job.remainingRetryCount = int(config.attrib["try_count"])
+        jobStore.write(job) #The master reads parent jobs again once their children are done, so the reset must be on disk
     job.messages = []
     job.children = []
-    job.remainingRetryCount = int(config.attrib["try_count"])
-    #Get children
-    childJobs = reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, config) for childDir in listChildDirs(jobTreeJobsRoot) ], [])
-    if len(childJobs) > 0:
-        childCounts[job] = len(childJobs)
-        for childJob in childJobs:
-            childJobFileToParentJob[childJob.getJobFileName()] = job
-    elif len(job.followOnCommands) > 0:
-        updatedJobFiles.add(job)
-    else: #Job is stub with nothing left to do, so ignore
-        return []
-    return [ job ]
-
-def parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, config):
-    jobFile = getJobFileName(jobTreeJobsRoot)
-    if processAnyUpdatingFile(jobFile) or processAnyNewFile(jobFile) or os.path.exists(jobFile):
-        return _parseJobFiles(jobTreeJobsRoot, updatedJobFiles, childJobFileToParentJob, childCounts, config)
-    return reduce(lambda x,y:x+y, [ parseJobFiles(childDir, updatedJobFiles, childJobFileToParentJob, childCounts, config) for childDir in listChildDirs(jobTreeJobsRoot) ], [])
+    return job
+
+def _scanJobDir(jobDir, jobStore, config):
+    """Lists the given directory of the jobs tree once, performing any recovery of the 
+    job file it contains and reading it. Returns the name of the job file, or None 
+    if the directory contains no job, the job if it may have commands to issue
+    (else None) and the list of child directories. In the sharded layout the child 
+    directories are those of the children in the job's record, some of which may have finished.
+    """
+    try:
+        fileNames = listDir(jobDir)
+    except OSError: #The directory was removed along with a finished job
+        return None, None, []
+    childDirs = [ os.path.join(jobDir, f) for f in fileNames if childDirPattern.match(f) ]
+    jobFile = getJobFileName(jobDir)
+    recovered = jobStore.recover(jobFile, fileNames)
+    if recovered:
+        childDirs = [ childDir for childDir in childDirs if os.path.isdir(childDir) ] #Any broken children have been removed
+    if not jobStore.exists(jobFile, None if recovered else fileNames): #The listing is out of date once recovered
+        return None, None, childDirs
+    jobStore.compact(jobFile, None if recovered else fileNames) #No slaves are running, so this is the time to fold any journal
+    job = jobStore.read(jobFile)
+    if isShardedLayout(config):
+        childDirs = [ os.path.split(child[0])[0] for child in job.children ]
+    job = _resetJob(job, jobStore, config)
+    jobFile = job.getJobFileName()
+    if len(job.followOnCommands) == 0:
+        job = None
+    return jobFile, job, childDirs
+
+def _scanJobDirs(rootDirs, updatedJobFiles, jobStore, config):
+    """Scans the trees of job directories rooted at the given directories, adding the 
+    jobs with commands to issue to updatedJobFiles. Returns, for each job found, its file, 
+    the index of its nearest ancestor job (or -1 - i if it is a top job in the i-th tree) and 
+    if it is unfinished, ie. if it has commands to issue or unfinished descendants.
+    
+    The directories are scanned breadth first, a level at a time, by a pool of threads, 
+    as on a networked file system the time taken is dominated by the latency of each file access. 
+    Only the jobs with follow ons and no children are kept in memory while scanning.
+    """
+    threadNumber = int(config.attrib.get("restart_threads", defaultRestartThreads))
+    pool = ThreadPool(threadNumber)
+    startTime = time.time()
+    jobFiles, ancestors, hasFollowOns = [], array('i'), array('b') #For each job found, its file, the index of its nearest ancestor job and if it has follow ons
+    jobs = {} #Jobs with follow ons and no child directories, which are likely to have commands to issue
+    level = [ (rootDir, -1 - i) for i, rootDir in enumerate(rootDirs) ] #Directories to scan, with the index of the nearest ancestor job
+    dirNumber = 0
+    def scanJobDir(jobDirAndAncestor):
+        return _scanJobDir(jobDirAndAncestor[0], jobStore, config)
+    while len(level) > 0:
+        nextLevel = []
+        for (jobDir, ancestor), (jobFile, job, childDirs) in zip(level, pool.imap(scanJobDir, level, chunksize=16)):
+            if jobFile != None:
+                ancestors.append(ancestor)
+                hasFollowOns.append(job != None)
+                ancestor = len(jobFiles)
+                jobFiles.append(jobFile)
+                if job != None and len(childDirs) == 0:
+                    jobs[ancestor] = job
+            nextLevel += [ (childDir, ancestor) for childDir in childDirs ]
+            dirNumber += 1
+            if dirNumber % 10000 == 0:
+                logger.info("Scanned %i job directories and found %i jobs in %i seconds" % (dirNumber, len(jobFiles), time.time() - startTime))
+        level = nextLevel
+    pool.close()
+    pool.join()
+    
+    #Find the unfinished jobs bottom up, ignoring stub jobs with nothing left to do
+    hasChildren = array('b', [ 0 ]) * len(jobFiles)
+    isUnfinished = array('b', [ 0 ]) * len(jobFiles)
+    for index in xrange(len(jobFiles)-1, -1, -1):
+        if hasChildren[index]:
+            isUnfinished[index] = 1
+        elif hasFollowOns[index]:
+            isUnfinished[index] = 1
+            if index in jobs:
+                updatedJobFiles.add(jobs.pop(index))
+            else: #All the job's children were stubs
+                updatedJobFiles.add(_resetJob(jobStore.read(jobFiles[index]), jobStore, config))
+        if isUnfinished[index] and ancestors[index] >= 0:
+            hasChildren[ancestors[index]] = 1
+    totalTime = time.time() - startTime
+    logger.info("Scanned %i job directories and found %i jobs in %f seconds, %f directories per second, using %i threads" % \
+                (dirNumber, len(jobFiles), totalTime, dirNumber / max(totalTime, 0.001), threadNumber))
+    return jobFiles, ancestors, isUnfinished
+
+def parseJobFiles(jobTreeJobsRoot, updatedJobFiles, jobGraph, jobStore, config):
+    """Walks the jobs directory, adding the jobs with commands to issue to updatedJobFiles 
+    and all the unfinished jobs to the jobGraph.
+    """
+    jobFiles, ancestors, isUnfinished = _scanJobDirs([ jobTreeJobsRoot ], updatedJobFiles, jobStore, config)
+    for index in xrange(len(jobFiles)): #Parents come before their children
+        if isUnfinished[index]:
+            ancestor = ancestors[index]
+            jobGraph.addJob(jobFiles[index], None if ancestor < 0 else jobFiles[ancestor])
+
+def verifyJobGraphFrontier(updatedJobFiles, jobGraph, jobStore, config):
+    """Checks the jobs of the frontier of a job graph loaded from its snapshot against 
+    their job files, as the snapshot's journal may not have recorded the last changes made by the 
+    master, and the slaves may have run the jobs since. Adds the jobs with commands to issue to 
+    updatedJobFiles, the children found for the jobs to the job graph, and removes finished jobs.
+    """
+    frontier = jobGraph.getFrontier()
+    jobFiles, ancestors, isUnfinished = _scanJobDirs([ os.path.split(jobFile)[0] for jobFile in frontier ], updatedJobFiles, jobStore, config)
+    finishedJobFiles = set(frontier)
+    for index in xrange(len(jobFiles)): #Parents come before their children
+        if isUnfinished[index]:
+            ancestor = ancestors[index]
+            if ancestor < 0:
+                assert jobFiles[index] == frontier[-1 - ancestor]
+                finishedJobFiles.remove(jobFiles[index])
+            else:
+                jobGraph.addJob(jobFiles[index], jobFiles[ancestor])
+    for jobFile in finishedJobFiles:
+        updateParentStatus(jobFile, updatedJobFiles, jobGraph, jobStore)
+    logger.info("Verified %i jobs of the frontier of the job graph, of which %i were finished" % (len(frontier), len(finishedJobFiles)))
+
+def loadJobGraph(jobTreePath, updatedJobFiles, jobStore, config):
+    """Loads the job graph from its snapshot if there is one, else by walking the jobs directory.
+    Returns the job graph and its log, having written a new snapshot.
+    """
+    jobGraphLog = JobGraphLog(getJobGraphSnapshotFileName(jobTreePath), getJobGraphJournalFileName(jobTreePath))
+    jobGraph = None
+    try:
+        jobGraph = jobGraphLog.read()
+    except: #Any problem with the snapshot, we fall back to walking the jobs directory
+        logger.critical("Could not load the job graph snapshot, so walking the jobs directory")
+        logger.critical(traceback.format_exc())
+    if jobGraph != None:
+        logger.info("Loaded the job graph of %i jobs from its snapshot" % len(jobGraph))
+        verifyJobGraphFrontier(updatedJobFiles, jobGraph, jobStore, config)
+    else:
+        jobGraph = JobGraph()
+        parseJobFiles(getJobFileDirName(jobTreePath), updatedJobFiles, jobGraph, jobStore, config)
+    jobGraphLog.write(jobGraph)
+    return jobGraph, jobGraphLog
 
 ####
 #The main loop
 ####
 
+def writeMetrics(config, jobBatcher, jobGraph, jobStore, updatedJobFiles):
+    """Sets the gauges of the master's queues and appends the metrics to the metrics file.
+    """
+    metrics.setGauge("issuedJobs", jobBatcher.getNumberOfJobsIssued() - jobBatcher.getNumberOfJobsWaiting())
+    metrics.setGauge("waitingJobs", jobBatcher.getNumberOfJobsWaiting())
+    metrics.setGauge("updatedJobFiles", len(updatedJobFiles))
+    metrics.setGauge("jobGraphJobs", len(jobGraph))
+    metrics.setGauge("jobGraphParents", jobGraph.getNumberOfParents())
+    metrics.setGauge("pathsDeleted", deleter.pathsDeleted)
+    metrics.setGauge("jobCacheHits", jobStore.hits)
+    metrics.setGauge("jobCacheMisses", jobStore.misses)
+    metrics.setGauge("garbagePaths", garbageCollector.getNumberOfPathsToCollect())
+    metrics.setGauge("bytesReclaimed", garbageCollector.bytesReclaimed)
+    metrics.setGauge("inodesReclaimed", garbageCollector.inodesReclaimed)
+    metrics.write(getMetricsFileName(config.attrib["job_tree"]))
+
 def mainLoop(config, batchSystem):
     """This is the main loop from which jobs are issued and processed.
     """
     rescueJobsFrequency = float(config.attrib["rescue_jobs_frequency"])
+    maxUpdatedJobs = 1000 #The max number of finished jobs processed between issuing passes
+    minJobGraphJournalLength = 100000 #The min number of changes to the job graph journaled between snapshots
+    metricsFrequency = 60 #The number of seconds between writes of the metrics file
     maxJobDuration = float(config.attrib["max_job_duration"])
     assert maxJobDuration >= 0
-    logger.info("Got parameters,rescue jobs frequency: %s max job duration: %s" % \
-                (rescueJobsFrequency, maxJobDuration))
+    failFast = config.attrib.has_key("fail_fast")
+    logger.info("Got parameters,rescue jobs frequency: %s max job duration: %s fail fast: %s" % \
+                (rescueJobsFrequency, maxJobDuration, failFast))
 
     #Kill any jobs on the batch system queue from the last time.
     assert len(batchSystem.getIssuedJobIDs()) == 0 #Batch system must start with no active jobs!
     logger.info("Checked batch system has no running jobs and no updated jobs")
-
-    childJobFileToParentJob, childCounts, updatedJobFiles = {}, {}, set()
-    parseJobFiles(getJobFileDirName(config.attrib["job_tree"]), updatedJobFiles, childJobFileToParentJob, childCounts, config)
-    jobBatcher = JobBatcher(config, batchSystem)
-    logger.info("Found %s jobs to start and %i parent jobs with children to run" % (len(updatedJobFiles), len(childCounts)))
+    jobEvents = batchSystem.supportsJobEvents()
+    if jobEvents:
+        logger.info("The batch system publishes job events, so lost jobs will be found from its vanished events")
+
+    metrics.reset()
+    updatedJobFiles = set()
+    jobStore = CachingJobStore(loadJobStore(config), int(config.attrib.get("job_cache_size", defaultJobCacheSize)))
+    if config.attrib.has_key("background_deletion"):
+        deleter.start(getTrashDirName(config.attrib["job_tree"]))
+    garbageCollectionRate = float(config.attrib.get("garbage_collection_rate", defaultGarbageCollectionRate))
+    if garbageCollectionRate > 0:
+        garbageCollector.start(jobStore, garbageCollectionRate, getTrashDirName(config.attrib["job_tree"]), 
+                               makeTemporaryStatsDirs(config.attrib["job_tree"]) if config.attrib.has_key("stats") else [])
+    jobGraph, jobGraphLog = loadJobGraph(config.attrib["job_tree"], updatedJobFiles, jobStore, config)
+    jobBatcher = JobBatcher(config, batchSystem, jobGraph)
+    logger.info("Found %s jobs to start and %i parent jobs with children to run" % (len(updatedJobFiles), jobGraph.getNumberOfParents()))
 
     stats = config.attrib.has_key("stats")
     if stats:
@@ -408,11 +735,23 @@ def mainLoop(config, batchSystem):
         worker.start()
 
     timeSinceJobsLastRescued = time.time() #Sets up the timing of the job rescuing method
+    timeSinceMetricsLastWritten = 0 #So the first metrics are written before the first jobs are issued
     totalFailedJobs = 0
+    totalCpuHoursSaved = 0.0 #By cancelling the subtrees of failed jobs in fail fast mode
     logger.info("Starting the main loop")
     while True:
+        if jobGraphLog.journalLength > max(minJobGraphJournalLength, len(jobGraph)): #Keeps the cost of writing snapshots proportional to the number of changes
+            jobGraphLog.write(jobGraph)
+            logger.debug("Wrote a snapshot of the job graph of %i jobs" % len(jobGraph))
+        else:
+            jobGraphLog.flush()
+        if time.time() - timeSinceMetricsLastWritten >= metricsFrequency:
+            writeMetrics(config, jobBatcher, jobGraph, jobStore, updatedJobFiles)
+            timeSinceMetricsLastWritten = time.time()
+        garbageCollector.collect()
         if len(updatedJobFiles) > 0:
             logger.debug("Built the jobs list, currently have %i jobs to update and %i jobs issued" % (len(updatedJobFiles), jobBatcher.getNumberOfJobsIssued()))
+            failedJobFiles = []
 
             for job in updatedJobFiles:
                 for message in job.messages:
@@ -423,44 +762,59 @@ def mainLoop(config, batchSystem):
                     logger.debug("Job: %s has %i children to schedule" % (job.getJobFileName(), len(job.children)))
                     children = job.children
                     job.children = []
-                    for childJobFile, memory, cpu in children:
-                        childJobFileToParentJob[childJobFile] = job
-                    assert job not in childCounts
-                    childCounts[job] = len(children)
+                    jobGraph.addChildren(job.getJobFileName(), [ child[0] for child in children ])
                     jobBatcher.issueJobs(children)
+                    garbageCollector.addGlobalTempDirs(job) #Those not needed by the job's follow on, while it waits for its children
                 else:
                     assert len(job.followOnCommands) > 0
                     if job.remainingRetryCount > 0:
                         logger.debug("Job: %s has a new command that we can now issue" % job.getJobFileName())
                         memory, cpu = job.followOnCommands[-1][1:3]
-                        jobBatcher.issueJob(job.getJobFileName(), memory, cpu)
+                        garbageCollector.discard(job.getJobFileName()) #The job's slave cleans up after itself
+                        jobBatcher.issueJob(job.getJobFileName(), memory, cpu, getFollowOnPriority(job.followOnCommands[-1]))
                     else:
                         totalFailedJobs += 1
+                        metrics.increment("jobsCompletelyFailed")
                         logger.critical("Job: %s is completely failed" % job.getJobFileName())
+                        failedJobFiles.append(job.getJobFileName())
             updatedJobFiles = set() #We've considered them all, so reset
+            if failFast: #Done once all the updated jobs have issued their children, so those in doomed subtrees are cancelled too
+                for jobFile in failedJobFiles:
+                    totalCpuHoursSaved += cancelSubtree(jobFile, jobBatcher, batchSystem, jobGraph, config)
+        jobBatcher.issueWaitingJobs()
 
         if jobBatcher.getNumberOfJobsIssued() == 0:
             logger.info("Only failed jobs and their dependents (%i total) are remaining, so exiting." % totalFailedJobs)
             break
 
-        updatedJob = batchSystem.getUpdatedJob(10) #Asks the batch system what jobs have been completed.
-        if updatedJob != None:
-            jobID, result = updatedJob
-            if jobBatcher.hasJob(jobID):
-                if result == 0:
-                    logger.debug("Batch system is reporting that the job %s ended successfully" % jobBatcher.getJob(jobID))
+        startTime = time.time()
+        updatedJobs = batchSystem.getUpdatedJobs(10, maxUpdatedJobs) #Asks the batch system what jobs have been completed.
+        metrics.addTime("getUpdatedJobs", time.time() - startTime)
+        metrics.increment("updatedJobs", len(updatedJobs))
+        if len(updatedJobs) > 0:
+            logger.debug("Got %i updated jobs from the batch system" % len(updatedJobs))
+            for jobID, result in updatedJobs:
+                if jobBatcher.hasJob(jobID):
+                    if result == 0:
+                        logger.debug("Batch system is reporting that the job %s ended successfully" % jobBatcher.getJob(jobID))
+                    else:
+                        metrics.increment("failedJobs")
+                        logger.critical("Batch system is reporting that the job %s %s failed with exit value %i" % (jobID, jobBatcher.getJob(jobID), result))
+                    processFinishedJob(jobID, result, updatedJobFiles, jobBatcher, jobGraph, jobStore, config)
                 else:
-                    logger.critical("Batch system is reporting that the job %s %s failed with exit value %i" % (jobID, jobBatcher.getJob(jobID), result))
-                processFinishedJob(jobID, result, updatedJobFiles, jobBatcher, childJobFileToParentJob, childCounts, config)
-            else:
-                logger.critical("A result seems to already have been processed: %i" % jobID)
-        else:
+                    logger.critical("A result seems to already have been processed: %s" % str(jobID))
+        if jobEvents:
+            processJobEvents(batchSystem.getJobEvents(), updatedJobFiles, jobBatcher, jobGraph, jobStore, config)
+        if len(updatedJobs) == 0:
             #logger.debug("Waited but no job was finished, still have %i jobs issued" % jobBatcher.getNumberOfJobsIssued())
             if time.time() - timeSinceJobsLastRescued >= rescueJobsFrequency: #We only rescue jobs every N seconds, and when we have apparently exhausted the current job supply
-                reissueOverLongJobs(updatedJobFiles, jobBatcher, config, batchSystem, childJobFileToParentJob, childCounts)
+                reissueOverLongJobs(updatedJobFiles, jobBatcher, config, batchSystem, jobGraph, jobStore)
                 logger.info("Reissued any over long jobs")
 
-                hasNoMissingJobs = reissueMissingJobs(updatedJobFiles, jobBatcher, batchSystem, childJobFileToParentJob, childCounts, config)
+                if jobEvents: #Lost jobs are reported by the vanished events
+                    hasNoMissingJobs = True
+                else:
+                    hasNoMissingJobs = reissueMissingJobs(updatedJobFiles, jobBatcher, batchSystem, jobGraph, jobStore, config)
                 if hasNoMissingJobs:
                     timeSinceJobsLastRescued = time.time()
                 else:
@@ -468,6 +822,16 @@ def mainLoop(config, batchSystem):
                 logger.info("Rescued any (long) missing jobs")
 
     logger.info("Finished the main loop")
+    if failFast:
+        logger.info("Cancelling the subtrees of failed jobs saved an estimated %f cpu hours" % totalCpuHoursSaved)
+    logger.info("The job cache had %i hits and %i misses" % (jobStore.hits, jobStore.misses))
+    logger.info("The garbage collector reclaimed %i bytes and %i inodes" % (garbageCollector.bytesReclaimed, garbageCollector.inodesReclaimed))
+    writeMetrics(config, jobBatcher, jobGraph, jobStore, updatedJobFiles)
+    jobGraphLog.write(jobGraph)
+    jobGraphLog.close()
+    garbageCollector.stop()
+    jobStore.close()
+    deleter.stop()
 
     if stats:
         startTime = time.time()
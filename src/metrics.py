@@ -0,0 +1,81 @@
+#
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""Timers, counters and gauges of where the master spends its time, which are 
+written periodically to a metrics file as JSON lines.
+"""
+
+import time
+import json
+
+class Metrics:
+    """Each timer records the number of times it has been timed, the total time and the 
+    max time. Counters are totals and gauges are the last values set. The metrics are 
+    cumulative, so the rates over an interval are the differences between lines.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.timers = {} #Name to count, total time and max time
+        self.counters = {}
+        self.gauges = {}
+        self.startTime = time.time()
+    
+    def addTime(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer == None:
+            timer = [ 0, 0.0, 0.0 ]
+            self.timers[name] = timer
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+    
+    def timed(self, name):
+        """Returns a decorator which times each call to the function it decorates.
+        """
+        def decorator(fn):
+            def timedFn(*args, **kwargs):
+                startTime = time.time()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.addTime(name, time.time() - startTime)
+            timedFn.__name__ = fn.__name__
+            timedFn.__doc__ = fn.__doc__
+            return timedFn
+        return decorator
+    
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def setGauge(self, name, value):
+        self.gauges[name] = value
+    
+    def write(self, metricsFile):
+        """Appends a line with the current values of the metrics to the metrics file.
+        """
+        timers = dict([ (name, { "count":count, "total":totalTime, "max":maxTime }) for name, (count, totalTime, maxTime) in self.timers.items() ])
+        fileHandle = open(metricsFile, 'a')
+        fileHandle.write(json.dumps({ "time":time.time(), "uptime":time.time() - self.startTime, 
+                                      "timers":timers, "counters":self.counters, "gauges":self.gauges }, sort_keys=True) + "\n")
+        fileHandle.close()
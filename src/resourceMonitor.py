@@ -0,0 +1,155 @@
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""Samples, from /proc, the resources used by a process and all its descendants, such as 
+the commands a slave runs with system and the siblings it forks: their peak resident memory 
+and number of threads, summed over the processes, and the cpu time and bytes read and 
+written by them. Optionally kills them if their memory exceeds a limit.
+"""
+
+import os
+import sys
+import signal
+import threading
+import thread
+
+from sonLib.bioio import logger
+
+defaultSampleInterval = 1.0
+
+_clockTicks = float(os.sysconf("SC_CLK_TCK"))
+_pageSize = os.sysconf("SC_PAGE_SIZE")
+
+def readProcessStat(pid):
+    """Returns the parent pid, start time (in clock ticks since boot), cpu time (in seconds), 
+    resident memory (in bytes) and number of threads of a process, or None if it has gone.
+    """
+    try:
+        fileHandle = open("/proc/%i/stat" % pid, 'r')
+        data = fileHandle.read()
+        fileHandle.close()
+    except IOError:
+        return None
+    fields = data[data.rindex(")")+2:].split() #The command name may contain spaces, the fields start with the state
+    return int(fields[1]), int(fields[19]), (int(fields[11]) + int(fields[12]))/_clockTicks, \
+        int(fields[21])*_pageSize, int(fields[17])
+
+def readProcessIoBytes(pid):
+    """Returns the number of bytes read and written by a process, by system calls, or 0 if 
+    they can not be read.
+    """
+    try:
+        fileHandle = open("/proc/%i/io" % pid, 'r')
+        lines = fileHandle.readlines()
+        fileHandle.close()
+    except IOError:
+        return 0
+    return sum([ int(line.split()[1]) for line in lines if line.split()[0] in ("rchar:", "wchar:") ])
+
+def getProcessTree(pid):
+    """Returns the stats, see readProcessStat, of a process and its descendants, by pid.
+    """
+    stats = {}
+    for fileName in os.listdir("/proc"):
+        if fileName.isdigit():
+            processStat = readProcessStat(int(fileName))
+            if processStat != None:
+                stats[int(fileName)] = processStat
+    tree = {}
+    pids = [ pid ]
+    while len(pids) > 0:
+        pid = pids.pop()
+        if pid in stats:
+            tree[pid] = stats[pid]
+            pids += [ childPid for childPid in stats if stats[childPid][0] == pid and childPid not in tree ]
+    return tree
+
+class ResourceMonitor:
+    """Samples the resources used by a process and its descendants, every interval seconds, 
+    on a background thread, until stopped. The cpu time and bytes read and written are those 
+    used since the monitor was started, as last sampled for each process, so those used by a 
+    process between its last sample and its end are missed. If the summed resident memory 
+    exceeds memoryLimit the descendants are killed and, if the monitor was started by the 
+    process's main thread, KeyboardInterrupt is raised in the main thread, so a slave fails its job.
+    """
+    def __init__(self, pid=None, interval=defaultSampleInterval, memoryLimit=sys.maxint):
+        self.pid = pid if pid != None else os.getpid()
+        self.interval = interval
+        self.memoryLimit = memoryLimit
+        self.peakMemory = 0
+        self.peakThreads = 0
+        self.cpuTime = 0.0
+        self.ioBytes = 0
+        self.memoryExceeded = False
+        self.startUsage = {} #The cpu time and io bytes of the processes when started, by pid and start time
+        self.usage = {} #The last sampled cpu time and io bytes of the processes, by pid and start time
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.interruptMain = False
+    
+    def start(self):
+        self.interruptMain = self.pid == os.getpid() and threading.current_thread().name == "MainThread"
+        self.sample()
+        self.startUsage = dict(self.usage)
+        self.cpuTime, self.ioBytes = 0.0, 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Stops the monitor, after a last sample, can be called more than once. The last sample 
+        does not raise KeyboardInterrupt, as the main thread is already finishing with the job.
+        """
+        if self.thread != None:
+            self.interruptMain = False #Else a slave failing its job could be interrupted before recording the failure
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+            self.sample()
+    
+    def sample(self):
+        """Samples the resources in use, returning the processes sampled, by pid.
+        """
+        tree = getProcessTree(self.pid)
+        memory, threads = 0, 0
+        for pid, (parentPid, startTime, cpuTime, residentMemory, threadNumber) in tree.items():
+            self.usage[(pid, startTime)] = (cpuTime, readProcessIoBytes(pid))
+            memory += residentMemory
+            threads += threadNumber
+        self.peakMemory = max(self.peakMemory, memory)
+        self.peakThreads = max(self.peakThreads, threads)
+        self.cpuTime = sum([ cpuTime - self.startUsage.get(key, (0.0, 0))[0] for key, (cpuTime, ioBytes) in self.usage.items() ])
+        self.ioBytes = sum([ ioBytes - self.startUsage.get(key, (0.0, 0))[1] for key, (cpuTime, ioBytes) in self.usage.items() ])
+        if memory > self.memoryLimit and not self.memoryExceeded:
+            self.memoryExceeded = True
+            logger.critical("The job is using %i bytes of memory, more than the %i bytes it requested, so is being killed" % (memory, self.memoryLimit))
+            for pid in tree:
+                if pid != self.pid:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError: #Already gone
+                        pass
+            if self.interruptMain:
+                thread.interrupt_main()
+        return tree
+    
+    def _run(self):
+        while not self.stopEvent.wait(self.interval):
+            self.sample()
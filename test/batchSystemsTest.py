@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""Tests the grouping of jobs into array jobs by the gridengine and lsf batch systems, and 
+the job events of the gridengine, lsf and parasol batch systems, with the commands that submit 
+jobs and check on them stubbed.
+"""
+
+import unittest
+import os
+import sys
+import Queue
+import time
+import xml.etree.cElementTree as ET
+
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
+
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import TempFileTree
+
+import jobTree.batchSystems.gridengine as gridengine
+import jobTree.batchSystems.lsf as lsf
+import jobTree.batchSystems.parasol as parasol
+from jobTree.batchSystems.multijob import MultiTarget
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
+from jobTree.src.master import getParasolResultsFileName
+
+class Boss:
+    """Stands in for the batch system that owns a worker.
+    """
+    def __init__(self, tempDir, maxCpus):
+        self.maxCpus = maxCpus
+        self.arrayJobTempFileTree = TempFileTree(os.path.join(tempDir, "arrayJobs"))
+        self.jobIDs = {}
+        self.lsfJobIDs = {}
+        self.jobEventQueue = Queue.Queue()
+
+def stoppedWorker(workerClass):
+    """Returns a subclass of a worker class whose thread is not started, so that the tests run 
+    its steps, and which is alive until the test says otherwise.
+    """
+    class StoppedWorker(workerClass):
+        alive = True
+        def start(self):
+            pass
+        def is_alive(self):
+            return self.alive
+    return StoppedWorker
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.stubbedFunctions = [ (module, name, getattr(module, name)) for module, name in 
+                                  ((gridengine, "qsub"), (gridengine, "qdel"), (gridengine, "getjobexitcode"), (gridengine, "Worker"), 
+                                   (lsf, "bsub"), (lsf, "bkill"), (lsf, "getjobexitcode"), (lsf, "Worker"), 
+                                   (gridengine.GridengineBatchSystem, "obtainSystemConstants"), 
+                                   (lsf.LSFBatchSystem, "obtainSystemConstants"), (parasol, "popenParasolCommand")) ]
+        self.submitted = [] #The command lines submitted
+        self.killed = [] #The batch system ids of the jobs killed
+        self.exitCodes = {} #The exit codes of the finished jobs and tasks, by their batch system ids
+        def submit(commandLine):
+            self.submitted.append(commandLine)
+            return len(self.submitted)
+        gridengine.qsub = lsf.bsub = submit
+        gridengine.qdel = lsf.bkill = self.killed.append
+        gridengine.getjobexitcode = lsf.getjobexitcode = lambda batchJobID : self.exitCodes.get(batchJobID)
+        gridengine.Worker = stoppedWorker(gridengine.Worker)
+        lsf.Worker = stoppedWorker(lsf.Worker)
+        gridengine.GridengineBatchSystem.obtainSystemConstants = lsf.LSFBatchSystem.obtainSystemConstants = lambda self : None
+        self.config = ET.Element("config")
+        self.config.attrib["job_tree"] = self.tempDir
+        self.config.attrib["parasol_command"] = "parasol"
+        self.environ = dict(os.environ)
+        os.environ.setdefault("LD_LIBRARY_PATH", "") #Passed on by qsub
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for module, name, fn in self.stubbedFunctions:
+            setattr(module, name, fn)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        system("rm -rf %s" % self.tempDir)
+
+    def loadMultiTarget(self, multiTargetCommand):
+        """Returns the multi target run by an array job's command, split into words, and its pickle file.
+        """
+        fileHandle = open(multiTargetCommand[1], 'r')
+        multiTarget = cPickle.load(fileHandle)
+        fileHandle.close()
+        return multiTarget, multiTargetCommand[1]
+
+    def testGridengine_ArrayJobs(self):
+        """Tests jobs with the same requirements are submitted as an array job, within the max cpus,
+        each mapped to its task, numbered from 1, and the array job's pickle removed after its last task.
+        """
+        boss = Boss(self.tempDir, maxCpus=5)
+        worker = gridengine.Worker(Queue.Queue(), Queue.Queue(), Queue.Queue(), Queue.Queue(), boss)
+        for jobID, cpu, command in ((0, 1, "a"), (1, 1, "b"), (2, 2, "c"), (3, 1, "d"), (4, 1, "e")):
+            worker.newJobsQueue.put((jobID, cpu, 100, command))
+        worker.createJobs()
+        self.assertEquals(len(self.submitted), 2) #The fifth job is held back by the max cpus
+        self.assertEquals(worker.waitingJobs, [ (4, 1, 100, "e") ])
+        arrayJobLine = [ commandLine for commandLine in self.submitted if "-t" in commandLine ][0]
+        self.assertEquals(arrayJobLine[arrayJobLine.index("-t") + 1], "1-3")
+        self.assertTrue("p=1" in arrayJobLine[arrayJobLine.index("-l") + 1])
+        arrayJobID = self.submitted.index(arrayJobLine) + 1
+        self.assertEquals(worker.sgeJobIDs[2], (3 - arrayJobID, None)) #The job with two cpus is submitted alone
+        self.assertEquals(self.submitted[2 - arrayJobID][-1], "c")
+        multiTarget, pickleFile = self.loadMultiTarget(arrayJobLine[-3:])
+        self.assertEquals(len(multiTarget.commands), 3)
+        for jobID, command in ((0, "a"), (1, "b"), (3, "d")):
+            sgeJobID, task = worker.sgeJobIDs[jobID]
+            self.assertEquals(sgeJobID, arrayJobID)
+            self.assertEquals(multiTarget.commands[task - 1], (command, None))
+
+        self.exitCodes[worker.sgeJobIDs[0]] = 0
+        self.exitCodes[worker.sgeJobIDs[1]] = 1
+        worker.checkOnJobs()
+        self.assertEquals(sorted([ worker.updatedJobsQueue.get() for i in xrange(2) ]), [ (0, 0), (1, 1) ])
+        self.assertTrue(os.path.exists(pickleFile)) #A task is still running
+        self.exitCodes[worker.sgeJobIDs[3]] = 0
+        worker.checkOnJobs()
+        self.assertEquals(worker.updatedJobsQueue.get(), (3, 0))
+        self.assertFalse(os.path.exists(pickleFile))
+        self.assertEquals(worker.runningJobs, set([ 2 ]))
+        worker.createJobs() #The job held back is now submitted alone
+        self.assertEquals(worker.sgeJobIDs[4], (3, None))
+
+    def testLSF_ArrayJobs(self):
+        """Tests jobs with the same requirements are submitted as an array job, each mapped to its
+        task, numbered from 1, and the array job's pickle removed after its last task.
+        """
+        boss = Boss(self.tempDir, maxCpus=sys.maxint)
+        worker = lsf.Worker(Queue.Queue(), Queue.Queue(), boss)
+        for jobID, cpu, command in ((0, 1, "a"), (1, 1, "b"), (2, 2, "c"), (3, 1, "d")):
+            worker.newJobsQueue.put((jobID, lsf.prepareBsub(cpu, 100000000) + [ command ]))
+        worker.createJobs()
+        self.assertEquals(len(self.submitted), 2)
+        arrayJobLine = [ commandLine for commandLine in self.submitted if '-J "jobTree[1-3]"' in commandLine ][0]
+        arrayJobID = self.submitted.index(arrayJobLine) + 1
+        self.assertEquals(boss.lsfJobIDs[2], (3 - arrayJobID, None))
+        multiTarget, pickleFile = self.loadMultiTarget(arrayJobLine[-1].split())
+        for jobID, command in ((0, "a"), (1, "b"), (3, "d")):
+            lsfJobID, task = boss.lsfJobIDs[jobID]
+            self.assertEquals(lsfJobID, arrayJobID)
+            self.assertEquals(boss.jobIDs[(lsfJobID, task)], jobID)
+            self.assertEquals(multiTarget.commands[task - 1], (command, None))
+            self.assertEquals(lsf.getLsfJobString((lsfJobID, task)), '"%i[%i]"' % (lsfJobID, task))
+
+        for jobID in (0, 1, 2):
+            self.exitCodes[boss.lsfJobIDs[jobID]] = 0
+        worker.checkOnJobs()
+        self.assertEquals(len([ worker.updatedJobsQueue.get() for i in xrange(3) ]), 3)
+        self.assertTrue(os.path.exists(pickleFile))
+        self.exitCodes[boss.lsfJobIDs[3]] = 0
+        worker.checkOnJobs()
+        self.assertEquals(worker.updatedJobsQueue.get(), (boss.lsfJobIDs[3], 0))
+        self.assertFalse(os.path.exists(pickleFile))
+
+    def testGridengine_JobEvents(self):
+        """Tests the jobs are queued when issued, running when submitted by the worker and finished 
+        when their results are returned, and that if the worker dies the jobs without results vanish, 
+        those submitted are deleted, and a new worker is started.
+        """
+        batchSystem = gridengine.GridengineBatchSystem(self.config, 10, sys.maxint)
+        self.assertTrue(batchSystem.supportsJobEvents())
+        jobIDs = batchSystem.issueJobs([ ("a", 100, 1), ("b", 100, 1), ("c", 100, 1) ])
+        batchSystem.worker.createJobs()
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], 
+                          [ (jobID, JOB_QUEUED) for jobID in jobIDs ] + [ (jobID, JOB_RUNNING) for jobID in jobIDs ])
+        worker = batchSystem.worker
+        self.exitCodes[worker.sgeJobIDs[jobIDs[0]]] = 0
+        worker.checkOnJobs()
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 10), [ (jobIDs[0], 0) ])
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobIDs[0], JOB_FINISHED) ])
+        
+        self.exitCodes[worker.sgeJobIDs[jobIDs[1]]] = 1
+        worker.checkOnJobs()
+        jobIDs.append(batchSystem.issueJob("d", 100, 1)) #Not submitted
+        worker.alive = False
+        self.assertEquals(sorted([ (i[0], i[1]) for i in batchSystem.getJobEvents() ]), 
+                          [ (jobIDs[2], JOB_VANISHED), (jobIDs[3], JOB_QUEUED), (jobIDs[3], JOB_VANISHED) ])
+        self.assertEquals(self.killed, [ worker.getSgeID(jobIDs[2]) ])
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 10), [ (jobIDs[1], 1) ]) #Finished before the worker died
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobIDs[1], JOB_FINISHED) ])
+        self.assertEquals(batchSystem.getIssuedJobIDs(), [])
+        
+        self.assertNotEquals(batchSystem.worker, worker)
+        jobID = batchSystem.issueJob("e", 100, 1)
+        batchSystem.worker.createJobs()
+        self.assertEquals(self.submitted[-1][-1], "e")
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobID, JOB_QUEUED), (jobID, JOB_RUNNING) ])
+    
+    def testLSF_JobEvents(self):
+        """Tests the jobs are queued when issued, running when submitted by the worker and finished 
+        when their results are returned, and that if the worker dies the jobs without results vanish, 
+        those submitted are killed, and a new worker is started.
+        """
+        batchSystem = lsf.LSFBatchSystem(self.config, 10, sys.maxint)
+        self.assertTrue(batchSystem.supportsJobEvents())
+        jobIDs = batchSystem.issueJobs([ ("a", 100000000, 1), ("b", 100000000, 2), ("c", 100000000, 3) ])
+        batchSystem.worker.createJobs()
+        jobEvents = [ (i[0], i[1]) for i in batchSystem.getJobEvents() ]
+        self.assertEquals(jobEvents[:3], [ (jobID, JOB_QUEUED) for jobID in jobIDs ])
+        self.assertEquals(sorted(jobEvents[3:]), [ (jobID, JOB_RUNNING) for jobID in jobIDs ])
+        worker = batchSystem.worker
+        self.exitCodes[batchSystem.lsfJobIDs[jobIDs[0]]] = 0
+        worker.checkOnJobs()
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 10), [ (jobIDs[0], 0) ])
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobIDs[0], JOB_FINISHED) ])
+        
+        self.exitCodes[batchSystem.lsfJobIDs[jobIDs[1]]] = 1
+        worker.checkOnJobs()
+        jobIDs.append(batchSystem.issueJob("d", 100000000, 1)) #Not submitted
+        worker.alive = False
+        self.assertEquals(sorted([ (i[0], i[1]) for i in batchSystem.getJobEvents() ]), 
+                          [ (jobIDs[2], JOB_VANISHED), (jobIDs[3], JOB_QUEUED), (jobIDs[3], JOB_VANISHED) ])
+        self.assertEquals(self.killed, [ batchSystem.lsfJobIDs[jobIDs[2]] ])
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 10), [ (jobIDs[1], 1) ]) #Finished before the worker died
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobIDs[1], JOB_FINISHED) ])
+        self.assertEquals(batchSystem.getIssuedJobIDs(), set())
+        
+        self.assertNotEquals(batchSystem.worker, worker)
+        jobID = batchSystem.issueJob("e", 100000000, 1)
+        batchSystem.worker.createJobs()
+        self.assertEquals(self.submitted[-1][-1], "e")
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobID, JOB_QUEUED), (jobID, JOB_RUNNING) ])
+    
+    def testParasol_JobEvents(self):
+        """Tests the jobs are queued when added, running when pstat2 lists them running, from their 
+        start times, finished when their results are read from the results file, and vanished when 
+        missing from pstat2 twice in a row.
+        """
+        self.parasolJobID = 100
+        pstat2Lines = []
+        def popenParasolCommand(command, runUntilSuccessful=True):
+            if command.startswith("sh "): #A job file, adding jobs
+                lines = []
+                for line in open(command.split()[1], 'r'):
+                    if line.startswith("echo "):
+                        lines.append(line.strip()[6:-1])
+                    elif " add job " in line:
+                        self.parasolJobID += 1
+                        lines.append("your job %i ('jobTreeSlave') submitted" % self.parasolJobID)
+                return 0, lines
+            if "pstat2" in command:
+                return 0, pstat2Lines
+            return 0, []
+        parasol.popenParasolCommand = popenParasolCommand
+        batchSystem = parasol.ParasolBatchSystem(self.config, 10, sys.maxint)
+        self.assertTrue(batchSystem.supportsJobEvents())
+        batchSystem.statusFrequency = 0
+        jobIDs = batchSystem.issueJobs([ ("a", 100, 1), ("b", 100, 1), ("c", 100, 1) ])
+        self.assertEquals(jobIDs, [ 101, 102, 103 ])
+        pstat2Lines += [ "r 101 user jobTreeSlave 1000 localhost", "q 102 user jobTreeSlave", "r 999 user jobTreeSlave 1000 localhost" ]
+        jobEvents = batchSystem.getJobEvents()
+        self.assertEquals([ (i[0], i[1]) for i in jobEvents ], [ (jobID, JOB_QUEUED) for jobID in jobIDs ] + [ (101, JOB_RUNNING) ])
+        self.assertEquals(jobEvents[-1][2], 1000) #The start time listed
+        
+        fileHandle = open(getParasolResultsFileName(self.tempDir), 'a')
+        fileHandle.write("0 localhost 101 jobTreeSlave 0 0 900 1000 1010 user /dev/null jobTreeSlave\n")
+        fileHandle.close()
+        self.assertEquals(batchSystem.getUpdatedJobs(10, 10), [ (101, 0) ])
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (101, JOB_FINISHED), (103, JOB_VANISHED) ])
+        
+        pstat2Lines[:] = []
+        self.assertEquals(batchSystem.getJobEvents(), []) #Missing once
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (102, JOB_VANISHED) ])
+        self.assertEquals(batchSystem.getJobEvents(), [])
+    
+    def testMultiTarget(self):
+        """Tests a multi target runs the command of the array job task it is run as, under gridengine or lsf.
+        """
+        multiTarget = MultiTarget([ ("true", None), ("false", None) ])
+        for taskVariable in ("SGE_TASK_ID", "LSB_JOBINDEX"):
+            for task, exitCode in ((1, 0), (2, 1)):
+                os.environ.pop("SGE_TASK_ID", None)
+                os.environ.pop("LSB_JOBINDEX", None)
+                os.environ[taskVariable] = str(task)
+                try:
+                    multiTarget.execute()
+                except SystemExit, e:
+                    self.assertEquals(e.code, exitCode)
+                else:
+                    self.fail("The multi target did not exit")
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the deleter.
+"""
+
+import unittest
+import os
+import sys
+import time
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.deleter import Deleter, getTrashDirName
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dirNumber = TestStatus.getTestSetup(100, 1000, 10000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def makeDirs(self):
+        """Makes a directory for each job, each with a file in a subdirectory, like a job's global temp dir.
+        """
+        dirNames = []
+        for i in xrange(self.dirNumber):
+            dirName = os.path.join(self.tempDir, "t%i" % i)
+            os.makedirs(os.path.join(dirName, "gTD0"))
+            open(os.path.join(dirName, "job"), 'w').close()
+            open(os.path.join(dirName, "gTD0", "foo"), 'w').close()
+            dirNames.append(dirName)
+        return dirNames
+
+    def testDeleter(self):
+        """Tests and benchmarks deleting directories directly and in the background.
+        """
+        for background in (False, True):
+            deleter = Deleter()
+            if background:
+                deleter.start(getTrashDirName(self.tempDir))
+            dirNames = self.makeDirs()
+            startTime = time.time()
+            for dirName in dirNames:
+                deleter.delete(dirName)
+                self.assertFalse(os.path.exists(dirName)) #The name is free at once, even if deleted in the background
+            deleteTime = time.time() - startTime
+            deleter.delete(os.path.join(self.tempDir, "missing")) #Missing paths are ignored
+            deleter.stop()
+            self.assertEquals(deleter.pathsDeleted, self.dirNumber)
+            if background:
+                self.assertEquals(os.listdir(getTrashDirName(self.tempDir)), [])
+                os.rmdir(getTrashDirName(self.tempDir))
+            self.assertEquals(os.listdir(self.tempDir), [])
+            print "Deleting %i directories %s took %f seconds" % (self.dirNumber, "in the background" if background else "directly", deleteTime)
+        
+        #Benchmark against forking rm -rf for each directory, as was done before
+        dirNames = self.makeDirs()
+        startTime = time.time()
+        for dirName in dirNames:
+            system("rm -rf %s" % dirName)
+        print "Deleting %i directories with rm -rf took %f seconds" % (self.dirNumber, time.time() - startTime)
+
+    def testDeleter_Contents(self):
+        """Tests deleting the contents of a directory, like rm -rf dirName/*.
+        """
+        deleter = Deleter()
+        deleter.start(getTrashDirName(self.tempDir))
+        dirName = os.path.join(self.tempDir, "localTempDir")
+        os.mkdir(dirName)
+        self.makeDirs()
+        for fileName in os.listdir(self.tempDir):
+            if fileName not in ("localTempDir", "trash"):
+                os.rename(os.path.join(self.tempDir, fileName), os.path.join(dirName, fileName))
+        deleter.deleteContents(dirName)
+        self.assertEquals(os.listdir(dirName), [])
+        deleter.stop()
+        self.assertEquals(os.listdir(getTrashDirName(self.tempDir)), [])
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
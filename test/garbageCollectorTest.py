@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the garbage collector.
+"""
+
+import unittest
+import os
+import sys
+import time
+import xml.etree.cElementTree as ET
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.job import Job
+from jobTree.src.jobStore import loadJobStore, getJobFileDirName
+from jobTree.src.garbageCollector import GarbageCollector, getPathSize
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.jobNumber = TestStatus.getTestSetup(100, 1000, 10000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+        config = ET.Element("config")
+        config.attrib["job_tree"] = self.tempDir
+        config.attrib["job_store"] = "file"
+        self.jobStore = loadJobStore(config)
+        self.jobDir = getJobFileDirName(self.tempDir)
+        os.mkdir(self.jobDir)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+    
+    def makeGlobalTempDirs(self, job, number):
+        for depth in xrange(number):
+            os.mkdir(job.getGlobalTempDirName() + str(depth))
+            open(os.path.join(job.getGlobalTempDirName() + str(depth), "foo"), 'w').write("bar")
+
+    def testGarbageCollector_Jobs(self):
+        """Tests and benchmarks removing finished jobs, at a limited rate.
+        """
+        parentJob = Job("parent", 1, 1, 1, self.jobDir)
+        parentJob.followOnCommands = []
+        parentJob.children = [ ("child%i" % i, 1, 1) for i in xrange(self.jobNumber) ]
+        self.jobStore.update(parentJob, depth=0, tryCount=1)
+        childJobs = [ self.jobStore.read(childJobFile) for childJobFile, memory, cpu in parentJob.children ]
+        for childJob in childJobs:
+            self.makeGlobalTempDirs(childJob, 1)
+        sizes = [ getPathSize(childJob.jobDir) for childJob in childJobs ]
+        
+        garbageCollector = GarbageCollector()
+        garbageCollector.start(self.jobStore, self.jobNumber)
+        for childJob in childJobs:
+            garbageCollector.addJob(childJob, parentJob.getJobFileName())
+        garbageCollector.addJob(parentJob, None) #Top jobs are not collected
+        self.assertEquals(garbageCollector.getNumberOfPathsToCollect(), self.jobNumber)
+        garbageCollector.collect() #Called at once, so the rate allows hardly any paths to be removed
+        self.assertTrue(garbageCollector.getNumberOfPathsToCollect() > self.jobNumber / 2)
+        time.sleep(1.0)
+        startTime = time.time()
+        garbageCollector.collect()
+        collectTime = time.time() - startTime
+        self.assertEquals(garbageCollector.getNumberOfPathsToCollect(), 0)
+        for childJob in childJobs:
+            self.assertFalse(os.path.exists(childJob.jobDir))
+        self.assertEquals(os.listdir(self.jobDir), [ "job" ])
+        self.assertEquals(garbageCollector.bytesReclaimed, sum([ bytes for bytes, inodes in sizes ]))
+        self.assertEquals(garbageCollector.inodesReclaimed, 4 * self.jobNumber) #The job's directory and file and its global temp dir and file
+        garbageCollector.stop()
+        print "Removing %i finished jobs took %f seconds, reclaiming %i bytes" % (self.jobNumber, collectTime, garbageCollector.bytesReclaimed)
+
+    def testGarbageCollector_GlobalTempDirs(self):
+        """Tests removing the global temp dirs of a job waiting for its children, and discarding them once it is issued.
+        """
+        job = Job("job", 1, 1, 1, self.jobDir)
+        job.followOnCommands = [ ("followOn", 1, 1, 1) ]
+        self.makeGlobalTempDirs(job, 4)
+        garbageCollector = GarbageCollector()
+        garbageCollector.start(self.jobStore, 1000)
+        garbageCollector.addGlobalTempDirs(job)
+        garbageCollector.discard(job.getJobFileName()) #The job is issued
+        time.sleep(0.1)
+        garbageCollector.collect()
+        self.assertEquals(len(os.listdir(self.jobDir)), 4)
+        
+        garbageCollector.addGlobalTempDirs(job)
+        time.sleep(0.1)
+        garbageCollector.collect()
+        #Those used by the follow on and the deepest, holding the pickles of the children, are kept
+        self.assertEquals(sorted(os.listdir(self.jobDir)), [ "gTD0", "gTD1", "gTD3" ])
+        self.assertEquals(garbageCollector.inodesReclaimed, 2)
+        
+        job.followOnCommands = [] #Only the deepest is used
+        garbageCollector.addGlobalTempDirs(job)
+        time.sleep(0.1)
+        garbageCollector.collect()
+        self.assertEquals(os.listdir(self.jobDir), [ "gTD3" ])
+        garbageCollector.stop()
+    
+    def testGarbageCollector_FinishedOwner(self):
+        """Tests the garbage of a finished job is dropped, so it is not removed once reused by the 
+        new children of the job's parent.
+        """
+        grandParentJob = Job("grandParent", 1, 1, 1, self.jobDir)
+        grandParentJob.followOnCommands = []
+        grandParentJob.children = [ ("parent%i" % i, 1, 1) for i in xrange(2) ]
+        self.jobStore.update(grandParentJob, depth=0, tryCount=1)
+        parentJob = self.jobStore.read(grandParentJob.children[0][0])
+        parentJob.followOnCommands = []
+        parentJob.children = [ ("child%i" % i, 1, 1) for i in xrange(2) ]
+        self.jobStore.update(parentJob, depth=0, tryCount=1)
+        childJobs = [ self.jobStore.read(childJobFile) for childJobFile, memory, cpu in parentJob.children ]
+        
+        garbageCollector = GarbageCollector()
+        garbageCollector.start(self.jobStore, 1000)
+        for childJob in childJobs:
+            garbageCollector.addJob(childJob, parentJob.getJobFileName())
+        garbageCollector.addGlobalTempDirs(parentJob)
+        garbageCollector.addJob(parentJob, grandParentJob.getJobFileName())
+        self.assertEquals(garbageCollector.getNumberOfPathsToCollect(), 1) #Just the parent
+        garbageCollector.discard(grandParentJob.getJobFileName()) #The grand parent is issued
+        self.assertEquals(garbageCollector.getNumberOfPathsToCollect(), 0)
+        
+        #The grand parent's slave removes its old children and makes new jobs at the same paths, which are not removed
+        for parentJobFile, memory, cpu in grandParentJob.children:
+            self.jobStore.delete(self.jobStore.read(parentJobFile))
+        grandParentJob.followOnCommands = []
+        grandParentJob.children = [ ("parent%i" % i, 1, 1) for i in xrange(2) ]
+        self.jobStore.update(grandParentJob, depth=0, tryCount=1)
+        time.sleep(0.1)
+        garbageCollector.collect()
+        for childJobFile, memory, cpu in grandParentJob.children:
+            self.assertTrue(self.jobStore.exists(childJobFile))
+        garbageCollector.stop()
+    
+    def testGarbageCollector_Workflow(self):
+        """Runs a workflow whose targets have children but no follow ons, with the garbage collector on.
+        """
+        outputDir = os.path.join(self.tempDir, "output")
+        system("%s %s --jobTree %s --outputDir %s --batchSystem singleMachine --garbageCollectionRate 1000" % 
+               (sys.executable, os.path.join(os.path.split(os.path.abspath(__file__))[0], "garbageCollectorTest_Wrapper.py"), 
+                os.path.join(self.tempDir, "jobTree"), outputDir))
+        self.assertEquals(len([ fileName for dirPath, dirNames, fileNames in os.walk(outputDir) for fileName in fileNames ]), 9)
+
+    def testGarbageCollector_Stale(self):
+        """Tests removing the stats files part written and the trash left by killed processes.
+        """
+        statsDir, trashDir = os.path.join(self.tempDir, "stats"), os.path.join(self.tempDir, "trash")
+        os.mkdir(statsDir)
+        os.makedirs(os.path.join(trashDir, "foo"))
+        for fileName in ("slave.xml", "slave.xml.new"):
+            open(os.path.join(statsDir, fileName), 'w').close()
+        garbageCollector = GarbageCollector()
+        garbageCollector.start(self.jobStore, 1000, trashDir, [ statsDir ], staleAge=3600, sweepFrequency=0)
+        time.sleep(0.1)
+        garbageCollector.collect()
+        self.assertEquals(garbageCollector.inodesReclaimed, 0) #Not yet stale
+        
+        garbageCollector.staleAge = 0
+        time.sleep(0.1)
+        garbageCollector.collect()
+        self.assertEquals(os.listdir(statsDir), [ "slave.xml" ]) #Still to be collated
+        self.assertEquals(os.listdir(trashDir), [])
+        self.assertEquals(garbageCollector.inodesReclaimed, 2)
+        garbageCollector.stop()
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#Copyright (C) 2011 by Benedict Paten (benedictpaten@gmail.com)
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""A workflow of targets with children but no follow ons, three levels deep, used to test the 
+garbage collector does not remove the global temp dirs holding the pickles of the children.
+"""
+
+import os
+from optparse import OptionParser
+
+from jobTree.scriptTree.target import Target
+from jobTree.scriptTree.stack import Stack
+
+class Parent(Target):
+    """Adds children, which add children in turn, until the given depth, without follow ons.
+    """
+    def __init__(self, outputDir, depth, children=3):
+        Target.__init__(self, time=1)
+        self.outputDir = outputDir
+        self.depth = depth
+        self.children = children
+    
+    def run(self):
+        for i in xrange(self.children):
+            if self.depth > 1:
+                self.addChildTarget(Parent(os.path.join(self.outputDir, str(i)), self.depth-1, self.children))
+            else:
+                self.addChildTarget(Leaf(os.path.join(self.outputDir, str(i))))
+        os.makedirs(self.outputDir)
+
+class Leaf(Target):
+    """Writes its output file.
+    """
+    def __init__(self, outputFile):
+        Target.__init__(self, time=1)
+        self.outputFile = outputFile
+    
+    def run(self):
+        open(self.outputFile, 'w').close()
+
+def main():
+    parser = OptionParser()
+    Stack.addJobTreeOptions(parser)
+    parser.add_option("--outputDir", dest="outputDir")
+    options, args = parser.parse_args()
+    
+    #Now we are ready to run
+    if Stack(Parent(options.outputDir, 2)).startJobTree(options) != 0:
+        raise RuntimeError("The workflow has failed jobs")
+
+if __name__ == '__main__':
+    from jobTree.test.garbageCollectorTest_Wrapper import *
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the job stores.
+"""
+
+import unittest
+import os
+import sys
+import time
+import xml.etree.cElementTree as ET
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.job import Job, getJobFileName
+from jobTree.src.jobStore import loadJobStore, FileJobStore, CachingJobStore, getJobFileDirName, listChildDirs
+from jobTree.src.jobStore import _packJournalFrame
+from jobTree.src.jobTreeRun import checkJobStore
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.jobNumber = TestStatus.getTestSetup(100, 1000, 10000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def makeJobStore(self, jobStoreName, jobLayout="nested"):
+        """Makes a job store in a new jobTree directory, returning it and the directory of the root job.
+        """
+        config = ET.Element("config")
+        config.attrib["job_tree"] = os.path.join(self.tempDir, "%s_%s" % (jobStoreName, jobLayout))
+        config.attrib["job_store"] = jobStoreName
+        config.attrib["job_layout"] = jobLayout
+        jobDir = getJobFileDirName(config.attrib["job_tree"])
+        os.makedirs(jobDir)
+        return loadJobStore(config), jobDir
+
+    def testJobStores(self):
+        """Tests and benchmarks writing, updating, reading and deleting jobs in each job store and layout.
+        """
+        for jobStoreName, jobLayout in (("file", "nested"), ("sqlite", "nested"), ("journal", "nested"), 
+                                        ("file", "sharded"), ("sqlite", "sharded"), ("journal", "sharded")):
+            jobStore, jobDir = self.makeJobStore(jobStoreName, jobLayout)
+            rootJob = Job("root", 1, 1, 1, jobDir)
+            rootJob.followOnCommands = []
+            rootJob.children = [ ("child%i" % i, 1, 1) for i in xrange(self.jobNumber) ]
+            startTime = time.time()
+            jobStore.update(rootJob, depth=0, tryCount=2)
+            updateTime = time.time() - startTime
+            self.assertFalse(jobStore.recover(rootJob.getJobFileName()))
+            self.assertEquals(jobStore.read(rootJob.getJobFileName()).children, rootJob.children)
+            startTime = time.time()
+            for i, (childJobFile, memory, cpu) in enumerate(rootJob.children):
+                self.assertTrue(jobStore.exists(childJobFile))
+                childJob = jobStore.read(childJobFile)
+                self.assertEquals(childJob.followOnCommands, [ ("child%i" % i, 1, 1, 0) ])
+                self.assertEquals(childJob.remainingRetryCount, 2)
+                self.assertEquals(jobStore.read(childJobFile, partial=True).followOnCommands, [ (None, 1, 1, 0) ])
+                self.assertEquals(jobStore.readHeader(childJobFile).followOnCount, 1)
+                childJob.remainingRetryCount = 1
+                jobStore.write(childJob)
+                self.assertEquals(jobStore.read(childJobFile).remainingRetryCount, 1)
+                jobStore.delete(childJob)
+                self.assertFalse(jobStore.exists(childJobFile))
+            readWriteTime = time.time() - startTime
+            if jobLayout == "sharded": #Just the shards are left
+                self.assertEquals(set([ len(f) for f in os.listdir(jobDir) if f not in ("job", "journal") ]), set([ 2 ]))
+            jobStore.delete(rootJob)
+            self.assertFalse(jobStore.exists(rootJob.getJobFileName()))
+            jobStore.close()
+            print "The %s job store made %i children in %f seconds and read, wrote and deleted them in %f seconds, in the %s layout" % \
+            (jobStoreName, self.jobNumber, updateTime, readWriteTime, jobLayout)
+
+    def testFileJobStore_Recover(self):
+        """Tests the file job store reverts a job whose update was interrupted, removing its broken children.
+        """
+        jobStore, jobDir = self.makeJobStore("file")
+        job = Job("root", 1, 1, 1, jobDir)
+        jobStore.write(job)
+        job.children = [ ("child%i" % i, 1, 1) for i in xrange(10) ]
+        jobStore.update(job, depth=0, tryCount=1)
+        open(job.getJobFileName() + ".updating", 'w').close() #As if the update had crashed
+        self.assertTrue(jobStore.recover(job.getJobFileName(), os.listdir(jobDir)))
+        self.assertEquals(os.listdir(jobDir), [ "job" ])
+        self.assertFalse(jobStore.recover(job.getJobFileName()))
+        self.assertTrue(isinstance(jobStore, FileJobStore))
+
+    def testFileJobStore_Recover_Sharded(self):
+        """Tests the file job store removes the children made in the sharded layout by an interrupted update, 
+        which are listed in the .updating file.
+        """
+        jobStore, jobDir = self.makeJobStore("file", "sharded")
+        job = Job("root", 1, 1, 1, jobDir)
+        jobStore.write(job)
+        job.children = [ ("child%i" % i, 1, 1) for i in xrange(10) ]
+        jobStore.update(job, depth=0, tryCount=1)
+        childDirs = [ os.path.split(childJobFile)[0] for childJobFile, memory, cpu in job.children ]
+        for childDir in childDirs:
+            self.assertEquals(len(os.path.relpath(childDir, jobDir).split(os.sep)), 3)
+            self.assertTrue(os.path.isfile(getJobFileName(childDir)))
+        fileHandle = open(job.getJobFileName() + ".updating", 'w') #As if the update had crashed
+        fileHandle.write("".join([ "%s\n" % childDir for childDir in childDirs ]))
+        fileHandle.close()
+        self.assertTrue(jobStore.recover(job.getJobFileName()))
+        for childDir in childDirs:
+            self.assertFalse(os.path.exists(childDir))
+        self.assertFalse(os.path.exists(job.getJobFileName() + ".updating"))
+
+    def testJournalJobStore_Recover(self):
+        """Tests the journal job store keeps jobs in their journals until compacted, cutting off 
+        torn frames and removing the children of interrupted updates.
+        """
+        for jobLayout in ("nested", "sharded"):
+            jobStore, jobDir = self.makeJobStore("journal", jobLayout)
+            job = Job("root", 1, 1, 1, jobDir)
+            jobStore.write(job)
+            self.assertFalse(os.path.exists(job.getJobFileName())) #The job is just in its journal
+            self.assertTrue(jobStore.exists(job.getJobFileName()))
+            job.remainingRetryCount = 2
+            jobStore.write(job)
+            self.assertEquals(jobStore.read(job.getJobFileName()).remainingRetryCount, 2)
+            self.assertFalse(jobStore.recover(job.getJobFileName()))
+            self.assertEquals(os.listdir(jobDir), [ "journal" ]) #The journal is not folded until compacted
+            jobStore.compact(job.getJobFileName())
+            self.assertEquals(sorted(os.listdir(jobDir)), [ "job" ])
+            self.assertEquals(Job.read(job.getJobFileName()).remainingRetryCount, 2)
+            
+            #An update whose children were made, but which was not committed
+            job.children = [ ("child%i" % i, 1, 1) for i in xrange(10) ]
+            jobStore.update(job, depth=0, tryCount=1)
+            childDirs = [ os.path.split(childJobFile)[0] for childJobFile, memory, cpu in job.children ]
+            jobStore.close()
+            journalFile = os.path.join(jobDir, "journal")
+            fileHandle = open(journalFile, 'rb')
+            frames = fileHandle.read()
+            fileHandle.close()
+            fileHandle = open(journalFile, 'wb')
+            fileHandle.write(frames[:-10]) #Tears the frame committing the update
+            fileHandle.close()
+            self.assertEquals(jobStore.read(job.getJobFileName()).children, []) #The torn frame is ignored
+            self.assertTrue(jobStore.recover(job.getJobFileName()))
+            for childDir in childDirs:
+                self.assertFalse(os.path.exists(childDir))
+            self.assertEquals(os.path.getsize(journalFile), 0) #The frames of the update are cut off
+            self.assertFalse(jobStore.recover(job.getJobFileName()))
+            job = jobStore.read(job.getJobFileName())
+            self.assertEquals((job.children, job.remainingRetryCount), ([], 2))
+            job.remainingRetryCount = 3 #Frames appended after recovering are read
+            jobStore.write(job)
+            self.assertEquals(jobStore.read(job.getJobFileName()).remainingRetryCount, 3)
+            jobStore.compact(job.getJobFileName())
+            self.assertEquals(Job.read(job.getJobFileName()).remainingRetryCount, 3)
+            
+            #A deletion that was interrupted after it was journaled
+            jobStore.write(job)
+            jobStore.close()
+            fileHandle = open(journalFile, 'ab')
+            fileHandle.write(_packJournalFrame(("delete",)))
+            fileHandle.close()
+            self.assertFalse(jobStore.exists(job.getJobFileName()))
+            self.assertTrue(jobStore.recover(job.getJobFileName()))
+            self.assertEquals(os.listdir(jobDir), [])
+
+    def testJobStores_FinishingJobs(self):
+        """Benchmarks the job stores for jobs run by slaves, each reading its job, writing it and 
+        then updating it with no children, followed by the master recovering and reading the finished 
+        jobs, and then compacting them as when restarting.
+        """
+        for jobStoreName in ("file", "sqlite", "journal"):
+            jobStore, jobDir = self.makeJobStore(jobStoreName)
+            rootJob = Job("root", 1, 1, 1, jobDir)
+            rootJob.followOnCommands = []
+            rootJob.children = [ ("child%i" % i, 1, 1) for i in xrange(self.jobNumber) ]
+            jobStore.update(rootJob, depth=0, tryCount=1)
+            childJobFiles = [ childJobFile for childJobFile, memory, cpu in rootJob.children ]
+            jobStore.close()
+            
+            startTime = time.time()
+            for childJobFile in childJobFiles: #As done by the slaves, each with its own store
+                slaveJobStore = loadJobStore(jobStore.config)
+                job = slaveJobStore.read(childJobFile)
+                slaveJobStore.write(job)
+                job.followOnCommands.pop()
+                slaveJobStore.update(job, depth=0, tryCount=1)
+                slaveJobStore.close()
+            slaveTime = time.time() - startTime
+            
+            startTime = time.time()
+            for childJobFile in childJobFiles: #As done by the master in processFinishedJob
+                self.assertFalse(jobStore.recover(childJobFile))
+                self.assertTrue(jobStore.exists(childJobFile))
+                self.assertEquals(jobStore.read(childJobFile, partial=True).followOnCommands, [])
+            masterTime = time.time() - startTime
+            
+            startTime = time.time()
+            for childJobFile in childJobFiles: #As done by the master when restarting
+                jobStore.compact(childJobFile)
+                self.assertEquals(jobStore.read(childJobFile, partial=True).followOnCommands, [])
+            compactTime = time.time() - startTime
+            jobStore.close()
+            print "The %s job store took %f seconds for the slaves and %f seconds for the master to finish %i jobs, and %f seconds to compact them" % \
+            (jobStoreName, slaveTime, masterTime, self.jobNumber, compactTime)
+
+    def testSQLiteJobStore_OldChildren(self):
+        """Tests the SQLite job store removes the records of a job's old children, and their descendants, 
+        when the job is updated, but not those of other jobs.
+        """
+        for jobLayout in ("nested", "sharded"):
+            jobStore, jobDir = self.makeJobStore("sqlite", jobLayout)
+            rootJob = Job("root", 1, 1, 1, jobDir)
+            jobStore.write(rootJob)
+            rootJob.children = [ ("child%i" % i, 1, 1) for i in xrange(5) ]
+            jobStore.update(rootJob, depth=0, tryCount=1)
+            oldChildJobFiles = [ childJobFile for childJobFile, memory, cpu in rootJob.children ]
+            childJob = jobStore.read(oldChildJobFiles[0])
+            jobStore.write(childJob) #Keeps the job's parent
+            childJob.children = [ ("grandChild%i" % i, 1, 1) for i in xrange(2) ]
+            jobStore.update(childJob, depth=0, tryCount=1)
+            grandChildJobFiles = [ grandChildJobFile for grandChildJobFile, memory, cpu in childJob.children ]
+            
+            otherJob = Job("other", 1, 1, 1, os.path.join(jobDir, "tmp")) #Not a child, though its directory's name starts with a t
+            os.mkdir(otherJob.jobDir)
+            jobStore.write(otherJob)
+            otherJob.children = [ ("otherChild%i" % i, 1, 1) for i in xrange(2) ]
+            jobStore.update(otherJob, depth=0, tryCount=1)
+            
+            #The directories of the old children are removed, as by the slave, but not their records
+            for childDir in listChildDirs(jobDir) + [ os.path.split(oldChildJobFile)[0] for oldChildJobFile in oldChildJobFiles ]:
+                system("rm -rf %s" % childDir)
+            rootJob.children = [ ("newChild%i" % i, 1, 1) for i in xrange(2) ]
+            jobStore.update(rootJob, depth=0, tryCount=1)
+            newChildJobFiles = [ newChildJobFile for newChildJobFile, memory, cpu in rootJob.children ]
+            for i, newChildJobFile in enumerate(newChildJobFiles):
+                self.assertEquals(jobStore.read(newChildJobFile).followOnCommands[0][0], "newChild%i" % i)
+            for jobFile in oldChildJobFiles + grandChildJobFiles:
+                if jobFile not in newChildJobFiles: #The nested layout reuses the paths of the children
+                    self.assertFalse(jobStore.exists(jobFile))
+            self.assertTrue(jobStore.exists(otherJob.getJobFileName()))
+            for otherChildJobFile, memory, cpu in otherJob.children:
+                self.assertTrue(jobStore.exists(otherChildJobFile))
+            jobStore.close()
+
+    def testCheckJobStore(self):
+        """Tests the SQLite job store can only be chosen with the single machine batch system.
+        """
+        config = ET.Element("config")
+        for jobStoreName, batchSystem, bigBatchSystem, valid in (("sqlite", "singleMachine", None, True), 
+                                                                 ("sqlite", "acidTest", "singleMachine", True),
+                                                                 ("sqlite", "parasol", None, False), 
+                                                                 ("sqlite", "singleMachine", "gridEngine", False), 
+                                                                 ("file", "lsf", "parasol", True)):
+            config.attrib["job_store"] = jobStoreName
+            config.attrib["batch_system"] = batchSystem
+            config.attrib.pop("big_batch_system", None)
+            if bigBatchSystem != None:
+                config.attrib["big_batch_system"] = bigBatchSystem
+            if valid:
+                checkJobStore(config)
+            else:
+                self.assertRaises(RuntimeError, checkJobStore, config)
+
+    def testCachingJobStore(self):
+        """Tests the caching job store uses cached jobs only while their records are unchanged, and benchmarks it.
+        """
+        for jobStoreName in ("file", "sqlite"):
+            jobStore, jobDir = self.makeJobStore(jobStoreName)
+            cachingJobStore = CachingJobStore(jobStore, 10)
+            rootJob = Job("root", 1, 1, 1, jobDir)
+            rootJob.followOnCommands = []
+            rootJob.children = [ ("child%i" % i, 1, 1) for i in xrange(self.jobNumber) ]
+            jobStore.update(rootJob, depth=0, tryCount=1)
+            rootJobFile = rootJob.getJobFileName()
+            
+            job = cachingJobStore.read(rootJobFile, partial=True)
+            self.assertEquals((cachingJobStore.hits, cachingJobStore.misses), (0, 1))
+            job.children = [] #Changes to the jobs read do not change the cache
+            startTime = time.time()
+            for i in xrange(100):
+                self.assertEquals(len(cachingJobStore.read(rootJobFile, partial=True).children), self.jobNumber)
+            hitTime = time.time() - startTime
+            self.assertEquals((cachingJobStore.hits, cachingJobStore.misses), (100, 1))
+            startTime = time.time()
+            for i in xrange(100):
+                jobStore.read(rootJobFile, partial=True)
+            missTime = time.time() - startTime
+            
+            self.assertEquals(len(cachingJobStore.read(rootJobFile).followOnCommands), 0) #A partial job is not used for a full read
+            self.assertEquals(cachingJobStore.misses, 2)
+            
+            job = jobStore.read(rootJobFile) #As if written by a slave
+            job.children = []
+            jobStore.write(job)
+            self.assertEquals(cachingJobStore.read(rootJobFile).children, [])
+            self.assertEquals(cachingJobStore.misses, 3)
+            job.remainingRetryCount = 5 #Jobs written through the cache are cached
+            cachingJobStore.write(job)
+            self.assertEquals(cachingJobStore.read(rootJobFile).remainingRetryCount, 5)
+            self.assertEquals(cachingJobStore.hits, 101)
+            
+            for childJobFile, memory, cpu in rootJob.children: #The cache is bounded
+                cachingJobStore.read(childJobFile)
+            self.assertEquals(len(cachingJobStore.jobs), 10)
+            childJobFile = rootJob.children[-1][0]
+            cachingJobStore.delete(cachingJobStore.read(childJobFile))
+            self.assertFalse(cachingJobStore.exists(childJobFile))
+            self.assertFalse(childJobFile in cachingJobStore.jobs)
+            cachingJobStore.close()
+            print "With the %s job store, reading a parent of %i children from the cache took %f seconds, against %f seconds without" % \
+            (jobStoreName, self.jobNumber, hitTime / 100, missTime / 100)
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,10 @@ import random
 from sonLib.bioio import parseSuiteTestOptions
 from sonLib.bioio import logger, system
 
-from jobTree.src.job import Job
+import marshal
+
+from jobTree.src.job import Job, getChildPriority, getFollowOnPriority, jobToRecord, getRecordBytesSaved
+from jobTree.src.job import getRecordHeaderSize
 
 class TestCase(unittest.TestCase):
     def testJobReadWriteAndDelete(self):
@@ -79,6 +82,151 @@ class TestCase(unittest.TestCase):
             print "It took %f seconds to update jobs" % (time.time() - startTime) #We've just used it for benchmarking, so far 
             
         system("rm -rf %s" % jobDir)
+        
+    def testJobUpdate_FanOut(self):
+        """Benchmarks making a fan out of 10000 children in one update.
+        """
+        jobDir = os.path.join(os.getcwd(), "testJobDir")
+        os.mkdir(jobDir) #If directory already exists then the test will fail
+        command = "by your command"
+        memory = 2^32
+        cpu = 1
+        tryCount = 100
+        childNumber = 10000
+        
+        j = Job(command, memory, cpu, tryCount, jobDir)
+        j.children = [ (command, memory, cpu) ] * childNumber
+        startTime = time.time()
+        j.update(tryCount=tryCount, depth=0)
+        print "It took %f seconds to make %i children" % (time.time() - startTime, childNumber)
+        self.assertEquals(len(os.listdir(jobDir)), 5) #The job file and the directories the children are spread over
+        j = Job.read(j.getJobFileName())
+        self.assertEquals(len(j.children), childNumber)
+        self.assertEquals(len(set([ childJobFile for childJobFile, memory, cpu in j.children ])), childNumber)
+        for childJobFile, memory, cpu in j.children:
+            cJ = Job.read(childJobFile)
+            self.assertEquals(cJ.followOnCommands, [ (command, memory, cpu, 0)])
+            self.assertEquals(os.listdir(cJ.jobDir), [ "job" ])
+        
+        system("rm -rf %s" % jobDir)
+        
+    def testJobUpdate_Priority(self):
+        jobDir = os.path.join(os.getcwd(), "testJobDir")
+        os.mkdir(jobDir) #If directory already exists then the test will fail
+        command = "by your command"
+        memory = 2^32
+        cpu = 1
+        tryCount = 100
+        
+        for childNumber in (1, 2, 10):
+            j = Job(command, memory, cpu, tryCount, jobDir)
+            for k in xrange(childNumber):
+                j.children.append((command, memory, cpu, k + 1))
+            j.update(tryCount=tryCount, depth=0)
+            j = Job.read(j.getJobFileName())
+            if childNumber == 1: #A single child is made a follow on
+                self.assertEquals(j.followOnCommands[-1], (command, memory, cpu, 1, 1))
+                self.assertEquals(getFollowOnPriority(j.followOnCommands[-1]), 1)
+                self.assertEquals(getFollowOnPriority(j.followOnCommands[0]), 0)
+            for k, child in enumerate(j.children):
+                self.assertEquals(getChildPriority(child), k + 1)
+                cJ = Job.read(child[0])
+                self.assertEquals(getFollowOnPriority(cJ.followOnCommands[-1]), k + 1)
+                cJ.delete()
+            j.delete()
+            
+        system("rm -rf %s" % jobDir)
+    
+    def testJobRecord_PartialReads(self):
+        jobDir = os.path.join(os.getcwd(), "testJobDir")
+        os.mkdir(jobDir) #If directory already exists then the test will fail
+        command = "by your command"
+        memory = 2^32
+        cpu = 1
+        tryCount = 100
+        
+        j = Job(command, memory, cpu, tryCount, jobDir)
+        j.followOnCommands.append(("then this", 10.5, 2, 1, 3))
+        j.children = [ ("child", memory, cpu) ]
+        j.messages = [ "hello" ]
+        j.write()
+        
+        #A partial read has all but the follow on commands, of which just the requirements of the next are kept
+        pJ = Job.read(j.getJobFileName(), partial=True)
+        self.assertEquals(pJ.remainingRetryCount, tryCount)
+        self.assertEquals(pJ.jobDir, jobDir)
+        self.assertEquals(pJ.children, j.children)
+        self.assertEquals(pJ.messages, j.messages)
+        self.assertEquals(pJ.followOnCommands, [ (None, 10.5, 2, 1, 3) ])
+        self.assertEquals(type(pJ.followOnCommands[0][2]), int)
+        self.assertRaises(AssertionError, pJ.write)
+        self.assertEquals(Job.read(j.getJobFileName()).followOnCommands, j.followOnCommands)
+        
+        #The header has just the counts and requirements
+        header = Job.readHeader(j.getJobFileName())
+        self.assertEquals((header.remainingRetryCount, header.childCount, header.followOnCount, header.messageCount), (tryCount, 1, 2, 1))
+        self.assertEquals((header.memory, header.cpu, header.depth, header.priority), (10.5, 2, 1, 3))
+        self.assertEquals(header.getJobFileName(), j.getJobFileName())
+        self.assertEquals(header.getLogFileName(), j.getLogFileName())
+        self.assertEquals(header.generation, 1)
+        j.write()
+        self.assertEquals(Job.readHeader(j.getJobFileName()).generation, 2)
+        self.assertEquals(Job.read(j.getJobFileName(), partial=True).generation, 2)
+        
+        #Records in the old format, a marshalled list, can still be read
+        fileHandle = open(j.getJobFileName(), 'wb')
+        marshal.dump([ tryCount, jobDir, j.children, j.followOnCommands, j.messages ], fileHandle)
+        fileHandle.close()
+        self.assertEquals(Job.read(j.getJobFileName()).followOnCommands, j.followOnCommands)
+        self.assertEquals(Job.read(j.getJobFileName(), partial=True).followOnCommands, [ (None, 10.5, 2, 1, 3) ])
+        self.assertEquals(Job.readHeader(j.getJobFileName()).followOnCount, 2)
+        j.delete()
+            
+        system("rm -rf %s" % jobDir)
+
+    def testJobRecord_Compression(self):
+        """Tests and benchmarks the compression of large sections of job records.
+        """
+        jobDir = os.path.join(os.getcwd(), "testJobDir")
+        os.mkdir(jobDir) #If directory already exists then the test will fail
+        command = "scriptTree %s/stack_%%i.pickle" % jobDir
+        memory = 2^32
+        cpu = 1
+        tryCount = 100
+        
+        j = Job(command, memory, cpu, tryCount, jobDir)
+        j.followOnCommands = [ (command % i, memory, cpu, i) for i in xrange(1000) ]
+        j.messages = [ "A message logged to the master %i" % i for i in xrange(1000) ]
+        uncompressedSize = getRecordHeaderSize() + sum([ len(marshal.dumps(section)) for section in (jobDir, [], j.messages, j.followOnCommands) ])
+        bytesSaved = getRecordBytesSaved()
+        startTime = time.time()
+        for i in xrange(100):
+            j.write()
+        writeTime = time.time() - startTime
+        compressedSize = os.path.getsize(j.getJobFileName())
+        self.assertTrue(compressedSize < uncompressedSize / 2)
+        self.assertEquals(getRecordBytesSaved() - bytesSaved, 100 * (uncompressedSize - compressedSize))
+        startTime = time.time()
+        for i in xrange(100):
+            cJ = Job.read(j.getJobFileName())
+        readTime = time.time() - startTime
+        self.assertEquals(cJ.followOnCommands, j.followOnCommands)
+        self.assertEquals(cJ.messages, j.messages)
+        pJ = Job.read(j.getJobFileName(), partial=True)
+        self.assertEquals(pJ.messages, j.messages)
+        self.assertEquals(pJ.followOnCommands, [ (None, memory, cpu, 999) ])
+        
+        #Small sections are not compressed
+        j.followOnCommands = j.followOnCommands[:1]
+        j.messages = []
+        bytesSaved = getRecordBytesSaved()
+        j.write()
+        self.assertEquals(getRecordBytesSaved(), bytesSaved)
+        self.assertEquals(Job.read(j.getJobFileName()).followOnCommands, j.followOnCommands)
+        print "Writing a record compressed from %i bytes to %i bytes took %f seconds and reading it %f seconds" % \
+        (uncompressedSize, compressedSize, writeTime / 100, readTime / 100)
+        
+        system("rm -rf %s" % jobDir)
 
 def main():
     parseSuiteTestOptions()
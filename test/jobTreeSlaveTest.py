@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the slave's caches of the jobTree's settings and of the classes of targets, 
+and the running of children by the slave, in series and concurrently.
+"""
+
+import unittest
+import os
+import sys
+import time
+import cPickle
+import xml.etree.cElementTree as ET
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.jobTreeSlave import loadSettings, loadPickleFile, loadStack, _settingsCache, _targetClasses
+from jobTree.src.jobTreeSlave import getSiblingNumber, runConcurrently, getSettingsCacheFileName
+from jobTree.scriptTree.stack import Stack, _targetRunTimes
+from jobTree.scriptTree.target import FunctionWrappingTarget, TargetFunctionWrappingTarget
+from jobTree.src.job import Job
+from jobTree.src.jobTreeRun import writeConfig, loadEnvironment
+from jobTree.src.master import getEnvironmentFileName, getConfigFileName
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.testNo = TestStatus.getTestSetup(100, 1000, 10000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.config = ET.Element("config")
+        self.config.attrib["job_tree"] = self.tempDir
+        self.config.attrib["log_level"] = "INFO"
+        writeConfig(self.config)
+        loadEnvironment(self.config)
+        os.mkdir(os.path.join(self.tempDir, "cache"), 0700) #The cache is only used if private to the user
+        self.cacheFile = os.path.join(self.tempDir, "cache", "settings.pickle")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        _settingsCache.clear()
+        system("rm -rf %s" % self.tempDir)
+
+    def loadSettings(self):
+        return loadSettings(getEnvironmentFileName(self.tempDir), getConfigFileName(self.tempDir), self.cacheFile)
+
+    def testLoadSettings(self):
+        """Tests the settings are cached, in memory and on disk, until the config is rewritten.
+        """
+        environment, configAttrib = self.loadSettings()
+        self.assertEquals(environment, dict(os.environ))
+        self.assertEquals(configAttrib, self.config.attrib)
+        
+        #The cache on disk is used by a new process, which we fake by changing the cached config
+        _settingsCache.clear()
+        stamp, environment, configAttrib = loadPickleFile(self.cacheFile)
+        configAttrib["log_level"] = "CACHED"
+        fileHandle = open(self.cacheFile, 'wb')
+        cPickle.dump((stamp, environment, configAttrib), fileHandle)
+        fileHandle.close()
+        self.assertEquals(self.loadSettings()[1]["log_level"], "CACHED")
+        
+        #Rewriting the config, as when the jobTree is reloaded, invalidates the caches
+        self.config.attrib["log_level"] = "DEBUG"
+        writeConfig(self.config)
+        self.assertEquals(self.loadSettings()[1]["log_level"], "DEBUG")
+        _settingsCache.clear()
+        self.assertEquals(self.loadSettings()[1]["log_level"], "DEBUG")
+        
+        #A corrupt cache is ignored
+        _settingsCache.clear()
+        open(self.cacheFile, 'w').write("foo")
+        self.assertEquals(self.loadSettings()[1]["log_level"], "DEBUG")
+        
+        #A cache that others could have written is ignored
+        _settingsCache.clear()
+        self.loadSettings()
+        stamp, environment, configAttrib = loadPickleFile(self.cacheFile)
+        configAttrib["log_level"] = "PLANTED"
+        fileHandle = open(self.cacheFile, 'wb')
+        cPickle.dump((stamp, environment, configAttrib), fileHandle)
+        fileHandle.close()
+        os.chmod(os.path.dirname(self.cacheFile), 0777)
+        self.assertEquals(self.loadSettings()[1]["log_level"], "DEBUG")
+        self.assertEquals(loadPickleFile(self.cacheFile)[2]["log_level"], "PLANTED")
+        os.chmod(os.path.dirname(self.cacheFile), 0700)
+        os.chmod(self.cacheFile, 0666)
+        _settingsCache.clear()
+        self.assertEquals(self.loadSettings()[1]["log_level"], "DEBUG") #Replaced, as the directory is private
+        self.assertEquals(loadPickleFile(self.cacheFile)[2]["log_level"], "DEBUG")
+        
+        #The slaves' cache is in a directory private to the user
+        cacheDir = os.path.dirname(getSettingsCacheFileName(self.tempDir))
+        self.assertEquals(os.stat(cacheDir).st_uid, os.getuid())
+        self.assertEquals(os.stat(cacheDir).st_mode & 0777, 0700)
+
+    def testLoadSettings_Benchmark(self):
+        """Benchmarks loading the settings from the cache, against parsing them.
+        """
+        startTime = time.time()
+        for i in xrange(self.testNo):
+            ET.parse(getConfigFileName(self.tempDir))
+            loadPickleFile(getEnvironmentFileName(self.tempDir))
+        parseTime = time.time() - startTime
+        self.loadSettings()
+        startTime = time.time()
+        for i in xrange(self.testNo):
+            _settingsCache.clear() #As for a new slave process
+            self.loadSettings()
+        cacheTime = time.time() - startTime
+        print "Parsing the settings %i times took %f seconds, loading them from the cache %f seconds" % (self.testNo, parseTime, cacheTime)
+
+    def testLoadStack(self):
+        """Tests and benchmarks loading stacks, from commands with the import strings in the pickle file and, as 
+        made by earlier versions, in the command.
+        """
+        importString = "jobTree.scriptTree.target.FunctionWrappingTarget"
+        stack = Stack(FunctionWrappingTarget(os.path.join, ("foo", "bar")))
+        command = stack.makeRunnable(self.tempDir)
+        self.assertEquals(command.split()[:-1], [ "scriptTree" ]) #Just the pickle file
+        _targetClasses.clear()
+        self.assertEquals(loadStack(command).target.args, ("foo", "bar"))
+        self.assertEquals(_targetClasses, { importString:FunctionWrappingTarget })
+        
+        oldCommand = "%s %s" % (command.replace(".pickle", "_old.pickle"), importString)
+        fileHandle = open(oldCommand.split()[1], 'w')
+        cPickle.dump(stack, fileHandle, cPickle.HIGHEST_PROTOCOL)
+        fileHandle.close()
+        self.assertEquals(loadStack(oldCommand).target.args, ("foo", "bar"))
+        
+        startTime = time.time()
+        for i in xrange(self.testNo):
+            loadStack(command)
+        print "Loading a stack %i times took %f seconds" % (self.testNo, time.time() - startTime)
+
+    def testInlineChildren(self):
+        """Tests children whose run times fit in the time available are added as follow ons.
+        """
+        def execute(inlineTime):
+            job = Job("", 10, 1, 1, self.tempDir)
+            job.followOnCommands.pop()
+            stack = Stack(TargetFunctionWrappingTarget(spawnChildren))
+            stack.execute(job=job, stats=None, localTempDir=self.tempDir, globalTempDir=self.tempDir,
+                          memoryAvailable=10, cpuAvailable=1, defaultMemory=1, defaultCpu=1, depth=2, 
+                          inlineTime=inlineTime)
+            return [ loadStack(command).target.args if command[:11] == "scriptTree " else command 
+                     for command in [ i[0] for i in job.followOnCommands + job.children ] ], \
+                     [ i[3] for i in job.followOnCommands ], len(job.children)
+        
+        #Without time to spare the children are all run as jobs
+        _targetRunTimes.clear()
+        self.assertEquals(execute(0.0), ([ ("followOn",), ("1",), ("2",), ("3",), ("4",), ("5",), ("6",), 
+                                           "echo 7", "echo 8" ], [ 2 ], 8))
+        
+        #The children with declared run times fitting the time are run in order, as follow ons
+        self.assertEquals(execute(3.9), ([ ("followOn",), "echo 7", ("3",), ("2",), ("1",), ("4",), 
+                                           ("5",), ("6",), "echo 8" ], [ 2, 3, 3, 3, 3 ], 4))
+        
+        #The run times of the targets without declared run times are estimated from those run
+        self.assertEquals(Stack(FunctionWrappingTarget(os.path.join)).getEstimatedRunTime(), sys.maxint)
+        job = Job("", 10, 1, 1, self.tempDir)
+        Stack(FunctionWrappingTarget(os.path.join, ("foo", "bar"))).execute(job=job, stats=None, 
+                          localTempDir=self.tempDir, globalTempDir=self.tempDir, memoryAvailable=10, 
+                          cpuAvailable=1, defaultMemory=1, defaultCpu=1, depth=0)
+        self.assertTrue(Stack(FunctionWrappingTarget(os.path.join)).getEstimatedRunTime() < 0.5)
+        self.assertEquals(execute(100.0)[2], 1)
+
+    def testConcurrentChildren(self):
+        """Tests the children of a job with more than one cpu are added as follow ons, to be run concurrently, 
+        with or without time to spare, if they fit together in its memory and cpus.
+        """
+        def execute(memoryAvailable, cpuAvailable, inlineTime):
+            job = Job("", memoryAvailable, cpuAvailable, 1, self.tempDir)
+            job.followOnCommands.pop()
+            stack = Stack(TargetFunctionWrappingTarget(spawnChildren))
+            stack.execute(job=job, stats=None, localTempDir=self.tempDir, globalTempDir=self.tempDir,
+                          memoryAvailable=memoryAvailable, cpuAvailable=cpuAvailable, defaultMemory=1, defaultCpu=1,
+                          depth=2, inlineTime=inlineTime)
+            return [ loadStack(i[0]).target.args if i[0][:11] == "scriptTree " else i[0]
+                     for i in job.followOnCommands if i[3] == 3 ], len(job.children), \
+                     getSiblingNumber(job.followOnCommands, memoryAvailable, cpuAvailable)
+
+        _targetRunTimes.clear()
+        self.assertEquals(execute(10, 8, 0.0), ([ "echo 8", "echo 7", ("6",), ("5",), ("4",), ("3",), ("2",), ("1",) ], 0, 8))
+        self.assertEquals(execute(7, 8, 0.0), ([], 8, 1)) #They do not all fit in the memory
+        self.assertEquals(execute(10, 2, 0.0), ([], 8, 1)) #Nor in the cpus
+        self.assertEquals(execute(10, 1, 0.0), ([], 8, 1))
+        #Those that do not all fit may still be inlined in the time available
+        self.assertEquals(execute(10, 2, 2.6), ([ "echo 7", ("4",), ("3",) ], 5, 3))
+
+    def testGetSiblingNumber(self):
+        """Tests the follow ons at the top of the stack with the same depth, that fit, are siblings.
+        """
+        followOnCommands = [ ("a", 1, 1, 0), ("b", 1, 1, 1), ("c", 1, 1, 1), ("d", 1, 1, 1) ]
+        self.assertEquals(getSiblingNumber(followOnCommands, 1, 1), 3)
+        self.assertEquals(getSiblingNumber(followOnCommands + [ ("e", 1, 1, 2) ], 1, 1), 1)
+        self.assertEquals(getSiblingNumber(followOnCommands[:2] + [ ("c", 1, 2, 1), ("d", 1, 1, 1, 5) ], 1, 1), 1)
+        self.assertEquals(getSiblingNumber(followOnCommands[:2] + [ ("c", 2, 1, 1), ("d", 1, 1, 1) ], 2, 1), 3)
+
+    def testRunConcurrently(self):
+        """Tests and benchmarks running follow ons concurrently, within the memory and cpu available.
+        """
+        followOnCommands = [ ("sleep", 1, 1, 0) ] * 8 + [ ("sleep", 2, 2, 0) ]
+        def sleep(followOnCommand):
+            time.sleep(0.1)
+            return (os.getpid(), time.time())
+        startTime = time.time()
+        results = runConcurrently(sleep, followOnCommands, 2, 2)
+        self.assertEquals(len(set([ pid for pid, finishTime in results ])), len(followOnCommands))
+        self.assertTrue(os.getpid() not in [ pid for pid, finishTime in results ])
+        #The last, needing all the memory and cpu, is run on its own, after the others
+        self.assertTrue(results[-1][1] - max([ finishTime for pid, finishTime in results[:-1] ]) >= 0.1)
+        print "Running %i follow ons, two at a time, took %f seconds" % (len(followOnCommands), time.time() - startTime)
+        
+        #A failure is raised once the others have run
+        def fail(followOnCommand):
+            if followOnCommand[0] == "fail":
+                raise RuntimeError()
+            return followOnCommand[0]
+        self.assertEquals(runConcurrently(fail, [ ("a", 1, 1, 0), ("b", 1, 1, 0) ], 2, 2), [ "a", "b" ])
+        self.assertRaises(RuntimeError, runConcurrently, fail, [ ("a", 1, 1, 0), ("fail", 1, 1, 0) ], 2, 2)
+
+def spawnChildren(target):
+    target.setFollowOnTarget(FunctionWrappingTarget(os.path.join, ("followOn",)))
+    for i in xrange(4):
+        target.addChildTarget(FunctionWrappingTarget(os.path.join, (str(i+1),), time=1))
+    for i in xrange(4, 6):
+        target.addChildTarget(FunctionWrappingTarget(os.path.join, (str(i+1),)))
+    target.addChildCommand("echo 7", runTime=0.5)
+    target.addChildCommand("echo 8")
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
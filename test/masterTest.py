@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the master's main loop, using a batch system that completes jobs instantly.
+"""
+
+import unittest
+import os
+import sys
+import time
+import json
+import xml.etree.cElementTree as ET
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.job import Job
+from jobTree.src.master import mainLoop, parseJobFiles, loadJobGraph, getJobFileDirName, getMetricsFileName, JobBatcher, getMaxJobMemory
+from jobTree.src.jobGraph import JobGraph
+from jobTree.src.jobStore import loadJobStore
+from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem, JOB_VANISHED
+from jobTree.batchSystems.combinedBatchSystem import CombinedBatchSystem
+
+class InstantBatchSystem(AbstractBatchSystem):
+    """Batch system that 'runs' each job by removing its job file, or its record in the given job store, 
+    as a slave does when a job completes with nothing left to do.
+    """
+    def __init__(self, config, jobStore=None):
+        AbstractBatchSystem.__init__(self, config, sys.maxint, sys.maxint)
+        self.jobs = {}
+        self.jobIndex = 0
+        self.jobStore = jobStore
+
+    def issueJob(self, command, memory, cpu):
+        self.jobs[self.jobIndex] = command.split()[-1]
+        self.jobIndex += 1
+        return self.jobIndex - 1
+
+    def killJobs(self, jobIDs):
+        pass
+
+    def getIssuedJobIDs(self):
+        return self.jobs.keys()
+
+    def getRunningJobIDs(self):
+        return {}
+
+    def getUpdatedJob(self, maxWait):
+        updatedJobs = self.getUpdatedJobs(maxWait, 1)
+        if len(updatedJobs) == 0:
+            return None
+        return updatedJobs[0]
+
+    def getUpdatedJobs(self, maxWait, maxCount):
+        updatedJobs = []
+        for jobID in self.jobs.keys()[:maxCount]:
+            if self.jobStore != None:
+                self.jobStore.delete(self.jobStore.read(self.jobs.pop(jobID)))
+            else:
+                os.remove(self.jobs.pop(jobID))
+            updatedJobs.append((jobID, 0))
+        return updatedJobs
+
+    def getRescueJobFrequency(self):
+        return sys.maxint
+
+class VanishingBatchSystem(InstantBatchSystem):
+    """Batch system that loses the first attempt of each job, publishing a vanished event for it.
+    """
+    def __init__(self, config):
+        InstantBatchSystem.__init__(self, config)
+        self.jobFilesSeen = set()
+        self.jobEvents = []
+
+    def issueJob(self, command, memory, cpu):
+        jobFile = command.split()[-1]
+        if jobFile in self.jobFilesSeen:
+            return InstantBatchSystem.issueJob(self, command, memory, cpu)
+        self.jobFilesSeen.add(jobFile)
+        self.jobEvents.append((self.jobIndex, JOB_VANISHED, time.time()))
+        self.jobIndex += 1
+        return self.jobIndex - 1
+
+    def supportsJobEvents(self):
+        return True
+
+    def getJobEvents(self):
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+
+class FailingBatchSystem(InstantBatchSystem):
+    """Batch system that fails the first job issued to it, and leaves the others running until they are killed.
+    """
+    def __init__(self, config):
+        InstantBatchSystem.__init__(self, config)
+        self.failingJobFiles = set()
+        self.killedJobFiles = []
+
+    def issueJob(self, command, memory, cpu):
+        if self.jobIndex == 0:
+            self.failingJobFiles.add(command.split()[-1])
+        return InstantBatchSystem.issueJob(self, command, memory, cpu)
+
+    def killJobs(self, jobIDs):
+        for jobID in jobIDs:
+            self.killedJobFiles.append(self.jobs.pop(jobID))
+
+    def getUpdatedJobs(self, maxWait, maxCount):
+        updatedJobs = [ (jobID, 1) for jobID, jobFile in self.jobs.items() if jobFile in self.failingJobFiles ][:maxCount]
+        for jobID, exitValue in updatedJobs:
+            self.jobs.pop(jobID)
+        return updatedJobs
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.leafNumber = TestStatus.getTestSetup(1000, 10000, 100000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.jobTreeDir = os.path.join(self.tempDir, "testJobTree")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def makeConfig(self):
+        config = ET.Element("config")
+        config.attrib["job_tree"] = self.jobTreeDir
+        config.attrib["try_count"] = "1"
+        config.attrib["default_memory"] = "1"
+        config.attrib["default_cpu"] = "1"
+        config.attrib["job_time"] = "30"
+        config.attrib["max_job_duration"] = str(float(sys.maxint))
+        config.attrib["rescue_jobs_frequency"] = str(float(sys.maxint))
+        return config
+
+    def testMainLoop_StarTree(self):
+        """Benchmarks the rate at which the master processes the completion of the leaves of a star tree.
+        """
+        self.runStarTree("file")
+
+    def testMainLoop_StarTree_SQLite(self):
+        """Benchmarks the master processing the leaves of a star tree with the SQLite job store.
+        """
+        self.runStarTree("sqlite")
+
+    def testMainLoop_StarTree_Journal(self):
+        """Benchmarks the master processing the leaves of a star tree with the journal job store.
+        """
+        self.runStarTree("journal")
+
+    def runStarTree(self, jobStoreName):
+        os.mkdir(self.jobTreeDir)
+        os.mkdir(getJobFileDirName(self.jobTreeDir))
+        config = self.makeConfig()
+        config.attrib["job_store"] = jobStoreName
+        jobStore = loadJobStore(config)
+        rootJob = Job("", 1, 1, 1, getJobFileDirName(self.jobTreeDir))
+        rootJob.followOnCommands = []
+        rootJob.children = [ ("leaf", 1, 1) ] * self.leafNumber
+        jobStore.update(rootJob, depth=0, tryCount=1)
+        startTime = time.time()
+        self.assertEquals(mainLoop(config, InstantBatchSystem(config, None if jobStoreName == "file" else jobStore)), 0)
+        totalTime = time.time() - startTime
+        self.assertFalse(jobStore.exists(rootJob.children[0][0]))
+        jobStore.close()
+        metrics = json.loads(open(getMetricsFileName(self.jobTreeDir)).readlines()[-1])
+        self.assertEquals(metrics["timers"]["processFinishedJob"]["count"], self.leafNumber)
+        self.assertEquals(metrics["counters"]["jobsIssuedToBatchSystem"], self.leafNumber)
+        self.assertEquals(metrics["gauges"]["jobGraphJobs"], 0)
+        self.assertEquals(metrics["gauges"]["jobCacheHits"], 1) #The root job, read when it was scanned, is not parsed again once its children are done
+        print "The master completed %i leaf jobs in %f seconds, %f jobs per second, with the %s job store" % \
+        (self.leafNumber, totalTime, self.leafNumber / totalTime, jobStoreName)
+
+    def testMainLoop_VanishedJobs(self):
+        """Tests the master retries jobs as soon as the batch system reports them vanished, without rescuing jobs.
+        """
+        os.mkdir(self.jobTreeDir)
+        os.mkdir(getJobFileDirName(self.jobTreeDir))
+        config = self.makeConfig()
+        config.attrib["try_count"] = "2"
+        rootJob = Job("", 1, 1, 2, getJobFileDirName(self.jobTreeDir))
+        rootJob.followOnCommands = []
+        rootJob.children = [ ("leaf", 1, 1) ] * self.leafNumber
+        rootJob.update(depth=0, tryCount=2)
+        self.assertEquals(mainLoop(config, VanishingBatchSystem(config)), 0)
+        metrics = json.loads(open(getMetricsFileName(self.jobTreeDir)).readlines()[-1])
+        self.assertEquals(metrics["counters"]["vanishedJobs"], self.leafNumber)
+        self.assertEquals(metrics["timers"]["processFinishedJob"]["count"], 2 * self.leafNumber)
+        self.assertEquals(metrics["gauges"]["jobGraphJobs"], 0)
+
+    def testMainLoop_FailFast(self):
+        """Tests that in fail fast mode the master kills the issued siblings of a job that has completely failed 
+        and cancels those waiting to be issued, leaving their job files.
+        """
+        os.mkdir(self.jobTreeDir)
+        os.mkdir(getJobFileDirName(self.jobTreeDir))
+        config = self.makeConfig()
+        config.attrib["fail_fast"] = ""
+        rootJob = Job("", 1, 1, 1, getJobFileDirName(self.jobTreeDir))
+        rootJob.followOnCommands = []
+        rootJob.children = [ ("leaf", 1, 1) ] * self.leafNumber
+        rootJob.update(depth=0, tryCount=1)
+        batchSystem = FailingBatchSystem(config)
+        batchSystem.maxCpus = 10
+        self.assertEquals(mainLoop(config, batchSystem), 1)
+        self.assertEquals(len(batchSystem.killedJobFiles), 9)
+        metrics = json.loads(open(getMetricsFileName(self.jobTreeDir)).readlines()[-1])
+        self.assertEquals(metrics["counters"]["jobsCancelled"], self.leafNumber - 1)
+        self.assertTrue(metrics["counters"]["cpuHoursSaved"] > 0)
+        for childJobFile, memory, cpu in rootJob.children:
+            self.assertTrue(os.path.isfile(childJobFile))
+
+    def testParseJobFiles(self):
+        """Tests and benchmarks the scan of the jobs directory made when restarting a jobTree.
+        """
+        self.runParseJobFiles("nested")
+
+    def testParseJobFiles_Sharded(self):
+        """Tests and benchmarks the scan of the jobs directory in the sharded layout, in which the children of jobs are found from their records.
+        """
+        self.runParseJobFiles("sharded")
+
+    def runParseJobFiles(self, jobLayout):
+        os.mkdir(self.jobTreeDir)
+        os.mkdir(getJobFileDirName(self.jobTreeDir))
+        config = self.makeConfig()
+        config.attrib["job_layout"] = jobLayout
+        rootJob = Job("", 1, 1, 1, getJobFileDirName(self.jobTreeDir))
+        rootJob.followOnCommands = []
+        rootJob.children = [ ("leaf", 1, 1) ] * self.leafNumber
+        loadJobStore(config).update(rootJob, depth=0, tryCount=1)
+        os.rename(rootJob.children[0][0], rootJob.children[0][0] + ".new") #A job that crashed while being updated
+        stubJob = Job.read(rootJob.children[1][0]) #A job with nothing left to do
+        stubJob.followOnCommands = []
+        stubJob.write()
+        updatedJobFiles, jobGraph = set(), JobGraph()
+        startTime = time.time()
+        parseJobFiles(getJobFileDirName(self.jobTreeDir), updatedJobFiles, jobGraph, loadJobStore(config), config)
+        totalTime = time.time() - startTime
+        self.assertEquals(len(updatedJobFiles), self.leafNumber - 1)
+        self.assertEquals(len(jobGraph), self.leafNumber)
+        self.assertEquals(jobGraph.getNumberOfParents(), 1)
+        self.assertEquals(jobGraph.getChildCount(rootJob.getJobFileName()), self.leafNumber - 1)
+        self.assertTrue(jobGraph.hasJob(rootJob.children[0][0]))
+        self.assertFalse(jobGraph.hasJob(rootJob.children[1][0]))
+        for job in updatedJobFiles:
+            self.assertEquals(jobGraph.getParent(job.getJobFileName()), rootJob.getJobFileName())
+        print "Scanned %i jobs in %f seconds, %f jobs per second, in the %s layout" % \
+        (self.leafNumber, totalTime, self.leafNumber / totalTime, jobLayout)
+
+    def testLoadJobGraph(self):
+        """Tests and benchmarks restarting from the job graph snapshot, including changes made 
+        after the snapshot that are in its journal and that are only on disk.
+        """
+        os.mkdir(self.jobTreeDir)
+        os.mkdir(getJobFileDirName(self.jobTreeDir))
+        config = self.makeConfig()
+        rootJob = Job("", 1, 1, 1, getJobFileDirName(self.jobTreeDir))
+        rootJob.followOnCommands = []
+        rootJob.children = [ ("leaf", 1, 1) ] * self.leafNumber
+        rootJob.update(depth=0, tryCount=1)
+        jobGraph, jobGraphLog = loadJobGraph(self.jobTreeDir, set(), loadJobStore(config), config)
+        self.assertEquals(len(jobGraph), self.leafNumber + 1)
+        jobGraph.removeJob(rootJob.children[0][0]) #A finished job that is journaled
+        Job.read(rootJob.children[0][0]).delete()
+        jobGraphLog.flush()
+        jobGraphLog.close()
+        Job.read(rootJob.children[1][0]).delete() #A finished job that is not
+        updatedJobFiles = set()
+        startTime = time.time()
+        jobGraph, jobGraphLog = loadJobGraph(self.jobTreeDir, updatedJobFiles, loadJobStore(config), config)
+        totalTime = time.time() - startTime
+        jobGraphLog.close()
+        self.assertEquals(len(jobGraph), self.leafNumber - 1)
+        self.assertEquals(len(updatedJobFiles), self.leafNumber - 2)
+        self.assertEquals(jobGraph.getChildCount(rootJob.getJobFileName()), self.leafNumber - 2)
+        self.assertFalse(jobGraph.hasJob(rootJob.children[1][0]))
+        print "Restarted from the job graph snapshot with %i jobs in %f seconds" % (self.leafNumber, totalTime)
+
+    def testJobBatcher_Priority(self):
+        """Tests the job batcher holds back jobs beyond the max cpus, issuing the waiting jobs by priority, then by depth.
+        """
+        config = self.makeConfig()
+        batchSystem = InstantBatchSystem(config)
+        batchSystem.maxCpus = 2
+        jobGraph = JobGraph()
+        jobGraph.addJob("root")
+        jobGraph.addChildren("root", [ "child%i" % i for i in xrange(4) ])
+        jobGraph.addChildren("child3", [ "grandChild" ])
+        jobBatcher = JobBatcher(config, batchSystem, jobGraph)
+        jobBatcher.issueJobs([ ("child0", 1, 1), ("child1", 1, 1, 1), ("child2", 1, 1, 2), ("grandChild", 1, 1) ])
+        self.assertEquals(jobBatcher.getNumberOfJobsIssued(), 4)
+        for expectedJobFiles in ([ "child2", "child1" ], [ "grandChild", "child0" ]):
+            jobBatcher.issueWaitingJobs()
+            self.assertEquals(sorted(batchSystem.jobs.values()), sorted(expectedJobFiles))
+            for jobID in batchSystem.jobs.keys():
+                jobBatcher.removeJobID(jobID)
+            batchSystem.jobs = {}
+        self.assertEquals(jobBatcher.getNumberOfJobsIssued(), 0)
+
+    def testJobBatcher_ResourcePools(self):
+        """Tests the job batcher limits the cpus and memory of the jobs issued to each batch system of a combined batch system.
+        """
+        config = self.makeConfig()
+        smallBatchSystem, bigBatchSystem = InstantBatchSystem(config), InstantBatchSystem(config)
+        smallBatchSystem.maxCpus = 3
+        bigBatchSystem.maxMemory = 10
+        batchSystem = CombinedBatchSystem(config, smallBatchSystem, bigBatchSystem, lambda command, memory, cpu : memory < 5)
+        jobGraph = JobGraph()
+        jobGraph.addJob("root")
+        jobs = [ ("small%i" % i, 1, 1) for i in xrange(10) ] + [ ("big%i" % i, 5, 1) for i in xrange(10) ]
+        jobGraph.addChildren("root", [ jobFile for jobFile, memory, cpu in jobs ])
+        jobBatcher = JobBatcher(config, batchSystem, jobGraph)
+        jobBatcher.issueJobs(jobs)
+        jobsRun = 0
+        while jobBatcher.getNumberOfJobsIssued() > 0:
+            jobBatcher.issueWaitingJobs()
+            self.assertEquals(len(smallBatchSystem.jobs), min(3, 10 - jobsRun))
+            self.assertEquals(len(bigBatchSystem.jobs), min(2, 10 - jobsRun))
+            jobsRun += 1
+            jobBatcher.removeJobID((1, smallBatchSystem.jobs.keys()[0])) #The combined batch system's job id
+            jobBatcher.removeJobID((2, bigBatchSystem.jobs.keys()[0]))
+            smallBatchSystem.jobs.pop(smallBatchSystem.jobs.keys()[0])
+            bigBatchSystem.jobs.pop(bigBatchSystem.jobs.keys()[0])
+
+    def testGetMaxJobMemory(self):
+        """Tests the memory of a job is limited to that of the batch system it is issued to.
+        """
+        config = ET.Element("config", { "max_memory":"100" })
+        self.assertEquals(getMaxJobMemory(config, 50, 1), 50)
+        self.assertEquals(getMaxJobMemory(config, 200.0, 1), 100)
+        config.attrib.update({ "big_batch_system":"singleMachine", "big_memory_threshold":"80", 
+                               "big_cpu_threshold":"2", "big_max_memory":"1000" })
+        self.assertEquals(getMaxJobMemory(config, 50, 1), 50)
+        self.assertEquals(getMaxJobMemory(config, 200, 1), 200)
+        self.assertEquals(getMaxJobMemory(config, 2000, 1), 1000)
+        self.assertEquals(getMaxJobMemory(config, 2000, 4), 1000)
+        config.attrib["max_memory"] = "60" #Jobs between 60 and the threshold can not be issued
+        self.assertEquals(getMaxJobMemory(config, 70, 1), 60)
+        config.attrib["big_max_memory"] = "70" #Nor those above the threshold, unless they need the big batch system's cpus
+        self.assertEquals(getMaxJobMemory(config, 200, 1), 60)
+        self.assertEquals(getMaxJobMemory(config, 200, 4), 70)
+    
+    def testJobGraph(self):
+        """Tests the job graph reports parents as their children finish, reuses the ids of removed jobs and finds the descendants of jobs.
+        """
+        jobGraph = JobGraph()
+        jobGraph.addJob("root")
+        childJobFiles = [ "child%i" % i for i in xrange(self.leafNumber) ]
+        jobGraph.addChildren("root", childJobFiles)
+        self.assertEquals(len(jobGraph), self.leafNumber + 1)
+        self.assertEquals(jobGraph.getNumberOfParents(), 1)
+        self.assertEquals(jobGraph.getChildCount("root"), self.leafNumber)
+        for childJobFile in childJobFiles[:-1]:
+            self.assertEquals(jobGraph.getParent(childJobFile), "root")
+            self.assertEquals(jobGraph.removeJob(childJobFile), None)
+        self.assertEquals(jobGraph.removeJob(childJobFiles[-1]), "root")
+        self.assertEquals(jobGraph.getNumberOfParents(), 0)
+        jobGraph.addChildren("root", [ "followOnChild" ])
+        self.assertEquals(len(jobGraph.jobFiles), self.leafNumber + 1)
+        self.assertEquals(jobGraph.removeJob("followOnChild"), "root")
+        self.assertEquals(jobGraph.getParent("root"), None)
+        self.assertEquals(jobGraph.removeJob("root"), None)
+        self.assertEquals(len(jobGraph), 0)
+        jobGraph.addJob("root")
+        jobGraph.addChildren("root", childJobFiles)
+        jobGraph.addChildren(childJobFiles[0], [ "grandChild" ])
+        self.assertEquals(sorted(jobGraph.getDescendants("root")), sorted(childJobFiles + [ "grandChild" ]))
+        self.assertEquals(jobGraph.getDescendants(childJobFiles[0]), [ "grandChild" ])
+        self.assertEquals(jobGraph.getDescendants("grandChild"), [])
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the monitoring of the resources used by a process and its descendants.
+"""
+
+import unittest
+import os
+import sys
+import time
+import subprocess
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.resourceMonitor import ResourceMonitor, readProcessStat, getProcessTree
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.testNo = TestStatus.getTestSetup(10, 100, 1000, 10000)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+    
+    def startProcess(self, pythonCode):
+        #A shell running python, so the python process is a descendant of the shell
+        return subprocess.Popen([ "sh", "-c", "%s -c '%s'; true" % (sys.executable, pythonCode) ])
+    
+    def waitForDescendant(self, process):
+        while len(getProcessTree(process.pid)) < 2:
+            time.sleep(0.01)
+    
+    def testReadProcessStat(self):
+        parentPid, startTime, cpuTime, memory, threads = readProcessStat(os.getpid())
+        self.assertEquals(parentPid, os.getppid())
+        self.assertTrue(memory > 0)
+        self.assertTrue(threads >= 1)
+        self.assertEquals(readProcessStat(0), None)
+    
+    def testMonitor(self):
+        """Tests the memory, cpu time and io of the descendants of a process are measured.
+        """
+        fileName = os.path.join(self.tempDir, "foo")
+        process = self.startProcess("import time\nx = \"x\"*100000000\nopen(\"%s\", \"w\").write(x[:10000000])\n"
+                                    "startTime = time.time()\nwhile time.time() - startTime < 1.0: pass" % fileName)
+        monitor = ResourceMonitor(pid=process.pid, interval=0.1)
+        monitor.start()
+        process.wait()
+        monitor.stop()
+        self.assertTrue(monitor.peakMemory >= 100000000)
+        self.assertTrue(monitor.peakThreads >= 2) #The shell and python
+        self.assertTrue(monitor.cpuTime > 0.5)
+        self.assertTrue(monitor.ioBytes >= 10000000)
+        self.assertFalse(monitor.memoryExceeded)
+    
+    def testMemoryLimit(self):
+        """Tests the descendants of a process using more memory than the limit are killed.
+        """
+        process = self.startProcess("x = \"x\"*200000000\nimport time\ntime.sleep(100)")
+        self.waitForDescendant(process)
+        monitor = ResourceMonitor(pid=process.pid, interval=0.1, memoryLimit=100000000)
+        startTime = time.time()
+        monitor.start()
+        process.wait()
+        monitor.stop()
+        self.assertTrue(time.time() - startTime < 10)
+        self.assertTrue(monitor.memoryExceeded)
+        self.assertTrue(monitor.peakMemory > 100000000)
+    
+    def testMemoryLimit_Stop(self):
+        """Tests the last sample taken when stopping the monitor records the memory limit being 
+        exceeded without interrupting the main thread, which may be handling a failed job.
+        """
+        monitor = ResourceMonitor(interval=100)
+        monitor.start()
+        self.assertTrue(monitor.interruptMain)
+        monitor.memoryLimit = 1
+        try:
+            monitor.stop()
+            time.sleep(0.1) #Gives a pending interrupt the chance to be raised
+        except KeyboardInterrupt:
+            self.fail("The main thread was interrupted by the last sample")
+        self.assertTrue(monitor.memoryExceeded)
+    
+    def testSample_Benchmark(self):
+        """Benchmarks the sampling of the resources used by a process.
+        """
+        monitor = ResourceMonitor()
+        startTime = time.time()
+        for i in xrange(self.testNo):
+            monitor.sample()
+        print "Sampling the resources of a process %i times took %f seconds" % (self.testNo, time.time() - startTime)
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Tests and benchmarks the warm slave batch system.
+"""
+
+import unittest
+import os
+import sys
+import time
+import threading
+import Queue
+import xml.etree.cElementTree as ET
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import parseSuiteTestOptions
+from sonLib.bioio import system
+from sonLib.bioio import getTempDirectory
+
+from jobTree.src.jobTreeWorker import runWorker
+from jobTree.batchSystems.warmSlave import WarmSlaveBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import AbstractBatchSystem
+from jobTree.batchSystems.abstractBatchSystem import JOB_QUEUED, JOB_RUNNING, JOB_FINISHED, JOB_VANISHED
+
+class ThreadBatchSystem(AbstractBatchSystem):
+    """Batch system that runs each worker issued to it in a thread, running its jobs with runJobFn.
+    """
+    def __init__(self, config, runJobFn):
+        AbstractBatchSystem.__init__(self, config, sys.maxint, sys.maxint)
+        self.runJobFn = runJobFn
+        self.jobIndex = 0
+        self.jobsRun = 0
+        self.resources = [] #The memory and cpu of the workers issued
+        self.outputQueue = Queue.Queue()
+
+    def issueJob(self, command, memory, cpu):
+        spoolDir, queueName, workerName, idleTimeout = command.split()[-4:]
+        self.resources.append((memory, cpu))
+        def runThread(jobID):
+            try:
+                jobsRun = runWorker(spoolDir, queueName, workerName, float(idleTimeout), self.runJobFn)
+                self.jobsRun += jobsRun
+            except WorkerDied:
+                pass
+            self.outputQueue.put((jobID, 0))
+        thread = threading.Thread(target=runThread, args=(self.jobIndex,))
+        thread.daemon = True
+        thread.start()
+        self.jobIndex += 1
+        return self.jobIndex - 1
+
+    def killJobs(self, jobIDs):
+        pass
+
+    def getUpdatedJobs(self, maxWait, maxCount):
+        return self.getAllFromQueueSafely(self.outputQueue, maxWait, maxCount)
+
+    def getRescueJobFrequency(self):
+        return sys.maxint
+
+class EventThreadBatchSystem(ThreadBatchSystem):
+    """Thread batch system that publishes the job events put in its list of job events.
+    """
+    def __init__(self, config, runJobFn):
+        ThreadBatchSystem.__init__(self, config, runJobFn)
+        self.jobEvents = []
+
+    def supportsJobEvents(self):
+        return True
+
+    def getJobEvents(self):
+        jobEvents = self.jobEvents
+        self.jobEvents = []
+        return jobEvents
+
+class WorkerDied(Exception):
+    pass
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.jobNumber = TestStatus.getTestSetup(100, 1000, 10000, 100000)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.config = ET.Element("config")
+        self.config.attrib["job_tree"] = self.tempDir
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def getUpdatedJobs(self, batchSystem, jobNumber):
+        updatedJobs = []
+        while len(updatedJobs) < jobNumber:
+            updatedJobs += batchSystem.getUpdatedJobs(10, jobNumber)
+        return dict(updatedJobs)
+
+    def testWarmSlaves(self):
+        """Tests and benchmarks running waves of jobs with the same workers.
+        """
+        jobFilesRun = []
+        def runJob(jobFile):
+            jobFilesRun.append(jobFile)
+            return 0
+        underlyingBatchSystem = ThreadBatchSystem(self.config, runJob)
+        batchSystem = WarmSlaveBatchSystem(self.config, underlyingBatchSystem, idleTimeout=0.5)
+        waveSize = 10
+        startTime = time.time()
+        for wave in xrange(self.jobNumber / waveSize):
+            jobIDs = batchSystem.issueJobs([ ("slave job%i" % (wave * waveSize + i), 1, 1) for i in xrange(waveSize) ])
+            self.assertEquals(self.getUpdatedJobs(batchSystem, waveSize), dict([ (jobID, 0) for jobID in jobIDs ]))
+        totalTime = time.time() - startTime
+        self.assertEquals(sorted(jobFilesRun), sorted([ "job%i" % i for i in xrange(self.jobNumber) ]))
+        self.assertTrue(underlyingBatchSystem.jobIndex < self.jobNumber / 2) #The workers run many jobs each
+        self.assertEquals(batchSystem.getIssuedJobIDs(), [])
+        
+        time.sleep(2.0) #The workers exit once idle
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 1), [])
+        self.assertEquals(batchSystem.workers, {})
+        self.assertEquals(underlyingBatchSystem.jobsRun, self.jobNumber)
+        print "Running %i jobs with %i warm slaves took %f seconds" % (self.jobNumber, underlyingBatchSystem.jobIndex, totalTime)
+
+    def testWarmSlaves_WorkerDies(self):
+        """Tests that the job a worker was running when it died is failed, and the others run by new workers.
+        """
+        def runJob(jobFile):
+            if jobFile == "job0":
+                raise WorkerDied()
+            return 1 if jobFile == "job1" else 0
+        batchSystem = WarmSlaveBatchSystem(self.config, ThreadBatchSystem(self.config, runJob), idleTimeout=0.5)
+        jobIDs = batchSystem.issueJobs([ ("slave job%i" % i, 1, 1) for i in xrange(3) ] + [ ("slave job3", 2, 1) ])
+        self.assertEquals(self.getUpdatedJobs(batchSystem, 4), { jobIDs[0]:1, jobIDs[1]:1, jobIDs[2]:0, jobIDs[3]:0 })
+        time.sleep(2.0)
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 1), [])
+        self.assertEquals(batchSystem.workers, {})
+
+    def testWarmSlaves_JobEvents(self):
+        """Tests the job events, published if the other batch system publishes them, in which jobs claimed 
+        by workers are running and the job of a worker the other batch system reports vanished is failed.
+        """
+        self.assertFalse(WarmSlaveBatchSystem(self.config, ThreadBatchSystem(self.config, None)).supportsJobEvents())
+        claimed = threading.Event()
+        def runJob(jobFile):
+            claimed.set()
+            threading.Event().wait() #The worker is lost while running the job
+        underlyingBatchSystem = EventThreadBatchSystem(self.config, runJob)
+        batchSystem = WarmSlaveBatchSystem(self.config, underlyingBatchSystem, idleTimeout=0.5)
+        self.assertTrue(batchSystem.supportsJobEvents())
+        jobID = batchSystem.issueJob("slave job0", 1, 1)
+        claimed.wait(10)
+        jobEvents = batchSystem.getJobEvents()
+        self.assertEquals([ (i[0], i[1]) for i in jobEvents ], [ (jobID, JOB_QUEUED), (jobID, JOB_RUNNING) ])
+        self.assertTrue(jobEvents[0][2] - 1 <= jobEvents[1][2] <= time.time()) #The time the job was claimed
+        underlyingBatchSystem.jobEvents.append((0, JOB_VANISHED, time.time()))
+        self.assertEquals([ (i[0], i[1]) for i in batchSystem.getJobEvents() ], [ (jobID, JOB_FINISHED) ])
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 1), [ (jobID, 1) ])
+        self.assertEquals(batchSystem.workers, {})
+        self.assertEquals(batchSystem.getIssuedJobIDs(), [])
+
+    def testWarmSlaves_FloatMemory(self):
+        """Tests jobs whose memory is a float, as set for jobs that have failed, see setupJobAfterFailure.
+        """
+        underlyingBatchSystem = ThreadBatchSystem(self.config, lambda jobFile : 0)
+        batchSystem = WarmSlaveBatchSystem(self.config, underlyingBatchSystem, idleTimeout=0.5)
+        jobIDs = batchSystem.issueJobs([ ("slave job0", 2147483648.0, 1), ("slave job1", 1, 1) ])
+        self.assertEquals(self.getUpdatedJobs(batchSystem, 2), { jobIDs[0]:0, jobIDs[1]:0 })
+        self.assertEquals(sorted(underlyingBatchSystem.resources), [ (1, 1), (2147483648.0, 1) ])
+        time.sleep(2.0)
+        self.assertEquals(batchSystem.getUpdatedJobs(0, 1), [])
+        self.assertEquals(batchSystem.workers, {})
+
+def main():
+    parseSuiteTestOptions()
+    sys.argv = sys.argv[:1]
+    unittest.main()
+
+if __name__ == '__main__':
+    main()